@@ -12,6 +12,10 @@ from annotinder.api.host import app_annotator_host
 from annotinder.api.users import app_annotator_users
 from annotinder.api.codingjob import app_annotator_codingjob
 from annotinder.api.guest import app_annotator_guest
+from annotinder.api.compression import CompressionMiddleware, COMPRESSION_MIN_SIZE
+from annotinder import mail, writer
+from annotinder.crud import crud_codingjob
+from annotinder.database import SessionLocal
 
 load_dotenv()
 
@@ -34,6 +38,16 @@ def startup_event():
   SECRET_KEY = os.getenv('SECRET_KEY') 
   if SECRET_KEY is None:
     raise NotImplementedError('A .env file with a SECRET_KEY needs to be created. You can run: "python -m annotinder create_env"')
+  # background ingests of a previous run of the server were interrupted
+  with SessionLocal() as db:
+    crud_codingjob.fail_stale_ingests(db)
+
+@app.on_event("shutdown")
+def shutdown_event():
+  # send mails that are still in the queue
+  mail.mail_queue.stop(timeout=30)
+  # commit writes that are still in the queue
+  writer.stop(timeout=30)
 
 app.include_router(app_annotator_host)
 app.include_router(app_annotator_users)
@@ -48,4 +62,7 @@ app.add_middleware(
   allow_headers=["*"],
 )
 
+if COMPRESSION_MIN_SIZE is not None:
+  app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
+
 
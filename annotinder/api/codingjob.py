@@ -1,27 +1,40 @@
 from typing import Optional
+import json
 import logging
 import re
 
-from fastapi import APIRouter, HTTPException, Response
+from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.params import Query, Body, Depends
+from fastapi.concurrency import run_in_threadpool
 
 
 from annotinder.api.common import _job, _jobuser
+from annotinder.api import compression
 from annotinder import unitserver
+from annotinder import ratelimit
+from annotinder import export
+from annotinder import events
 
 from sqlalchemy.orm import Session
 
-from annotinder.crud import crud_codingjob
-from annotinder.database import engine, get_db
+from annotinder.crud import crud_codingjob, crud_archive, crud_codebook, crud_jobset, crud_statistics
+from annotinder.database import engine, get_db, get_read_db
 from annotinder.auth import auth_user, check_admin, get_jobtoken
-from annotinder.models import User, JobSetUnit
+from annotinder.models import User
+from annotinder.utils import encode_cursor, decode_cursor, ndjson_chunks
 
 app_annotator_codingjob = APIRouter(
     prefix='/codingjob', tags=["annotator codingjob"])
 
+DEFAULT_PAGE_SIZE = 1000
+MAX_PAGE_SIZE = 10000
+
 
 @app_annotator_codingjob.post("", status_code=201)
-def create_job(title: str = Body(None, description='The title of the codingjob'),
+def create_job(background_tasks: BackgroundTasks,
+               response: Response,
+               title: str = Body(None, description='The title of the codingjob'),
                codebook: dict = Body(None, description='The codebook'),
                units: list = Body(None, description='The units'),
                rules: dict = Body(None, description='The rules'),
@@ -31,10 +44,14 @@ def create_job(title: str = Body(None, description='The title of the codingjob')
                    None, description='A list of codingjob jobsets. An array of objects, with keys: name, codebook, unit_set'),
                authorization: Optional[dict] = Body(
                    None, description='A dictionnary containing authorization settings'),
+               background: bool = Query(
+                   False, description='If true, return the job id immediately and create the job in the background'),
                user: User = Depends(auth_user),
                db: Session = Depends(get_db)):
     """
     Create a new codingjob. 
+    For large jobs, use background=true. The response (202) then only has the job id, and the progress
+    can be polled at GET /codingjob/{id}/ingest. Coders can open the job once its status is "done".
     """
     check_admin(user)
 
@@ -42,6 +59,13 @@ def create_job(title: str = Body(None, description='The title of the codingjob')
         raise HTTPException(
             status_code=400, detail='Codingjob is missing keys')
 
+    if background:
+        job = crud_codingjob.queue_codingjob(db, title=title, creator=user, n_units=len(units), authorization=authorization)
+        background_tasks.add_task(crud_codingjob.ingest_codingjob, db.get_bind(), job.id, codebook=codebook, jobsets=jobsets,
+                                  rules=rules, units=units, debriefing=debriefing, authorization=authorization)
+        response.status_code = 202
+        return dict(id=job.id, status='queued')
+
     try:
         job = crud_codingjob.create_codingjob(db, title=title, codebook=codebook, jobsets=jobsets,
                                               rules=rules, debriefing=debriefing, creator=user, units=units, authorization=authorization)
@@ -52,6 +76,62 @@ def create_job(title: str = Body(None, description='The title of the codingjob')
     return dict(id=job.id)
 
 
+@app_annotator_codingjob.get("/{job_id}/ingest")
+def get_ingest_status(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+    """
+    Get the status of a codingjob that is created in the background: queued, running, done or failed.
+    n_done is the number of units that have been added so far, and error says why the job failed.
+    If the server was restarted while the job was created, the job fails once it made no progress for INGEST_TIMEOUT_SECONDS.
+    """
+    check_admin(user)
+    crud_codingjob.fail_stale_ingests(db, job_id)
+    ingest = crud_codingjob.get_ingest(db, job_id)
+    if ingest is None:
+        raise HTTPException(status_code=404)
+    return dict(id=job_id, status=ingest.status, n_units=ingest.n_units, n_done=ingest.n_done,
+                error=ingest.error, created=ingest.created, finished=ingest.finished)
+
+
+@app_annotator_codingjob.delete("/{job_id}", status_code=204)
+def delete_job(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+    """
+    Delete a codingjob, including all its units and annotations
+    """
+    check_admin(user)
+    job = _job(db, job_id)
+    crud_codingjob.delete_codingjob(db, job)
+    return Response(status_code=204)
+
+
+@app_annotator_codingjob.post("/{job_id}/clone", status_code=201)
+def clone_job(job_id: int,
+              title: Optional[str] = Body(
+                  None, description="The title of the new codingjob. By default the same as the original"),
+              rules: Optional[dict] = Body(
+                  None, description="If given, these rules are used for all jobsets"),
+              authorization: Optional[dict] = Body(
+                  None, description="Authorization settings (restricted, users). By default the same as the original"),
+              user: User = Depends(auth_user),
+              db: Session = Depends(get_db)):
+    """
+    Create a copy of a codingjob with the same units and jobsets, but without coders and annotations, for instance
+    to run a job again with different rules or coders. The copy is made within the database, so this is fast
+    even for very large jobs.
+    """
+    check_admin(user)
+    job = _job(db, job_id)
+    if crud_archive.get_archive(db, job_id) is not None:
+        raise HTTPException(status_code=400, detail='A job in cold storage has to be restored before it can be cloned')
+    if crud_codingjob.ingest_pending(db, job_id):
+        raise HTTPException(status_code=400, detail='A job that is still being created cannot be cloned')
+    try:
+        clone = crud_codingjob.clone_codingjob(db, job, creator=user, title=title, rules=rules, authorization=authorization)
+    except Exception as e:
+        db.rollback()
+        raise e
+    return dict(id=clone.id)
+
+
 @app_annotator_codingjob.post("/{job_id}/settings", status_code=201)
 def set_job_settings(job_id: int,
                      user: User = Depends(auth_user),
@@ -65,6 +145,7 @@ def set_job_settings(job_id: int,
     Payload should be an object where every settings is a key. Only the
     settings that need to be changed have to be in the object. The
     returned object will always have all settings.
+    Unarchiving a job that is in cold storage restores its units and annotations.
     """
     check_admin(user)
     job = _job(db, job_id)
@@ -72,10 +153,83 @@ def set_job_settings(job_id: int,
         job.restricted = restricted
     if archived is not None:
         job.archived = archived
+        if not archived:
+            crud_archive.restore_job(db, job)
     db.commit()
     return dict(restricted=job.restricted, archived=job.archived)
 
 
+@app_annotator_codingjob.post("/{job_id}/jobset/{jobset_id}", status_code=201)
+def set_jobset_settings(job_id: int,
+                        jobset_id: int,
+                        user: User = Depends(auth_user),
+                        rules: Optional[dict] = Body(None, description="The new rules of the jobset"),
+                        codebook: Optional[dict] = Body(None, description="The new codebook of the jobset"),
+                        debriefing: Optional[dict] = Body(None, description="The new debriefing of the jobset"),
+                        db: Session = Depends(get_db)):
+    """
+    Change the rules, codebook or debriefing of a jobset. Only the settings that need to be changed have to be given.
+    Returns the jobset.
+    """
+    check_admin(user)
+    job = _job(db, job_id)
+    jobset = next((js for js in job.jobsets if js.id == jobset_id), None)
+    if jobset is None:
+        raise HTTPException(status_code=404)
+    jobset = crud_jobset.update_jobset(db, jobset, rules=rules, codebook=codebook, debriefing=debriefing)
+    return crud_codingjob.jobset_dict(db, jobset)
+
+
+@app_annotator_codingjob.post("/{job_id}/archive", status_code=201)
+def archive_job(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+    """
+    Archive a job and move its units and annotations to cold storage (a compressed archive), so that they
+    no longer take up space in the tables and indices used for coding. The job can still be exported,
+    and unarchiving it (see settings) restores everything.
+    """
+    check_admin(user)
+    job = _job(db, job_id)
+    archive = crud_archive.archive_job(db, job)
+    return dict(archived=job.archived, n_units=archive.n_units, n_annotations=archive.n_annotations,
+                compressed_size=archive.size)
+
+
+@app_annotator_codingjob.post("/{job_id}/units", status_code=201)
+async def append_job_units(job_id: int,
+                           request: Request,
+                           batch_size: int = Query(
+                               1000, ge=1, le=MAX_PAGE_SIZE, description="The number of units that is added per transaction"),
+                           user: User = Depends(auth_user),
+                           db: Session = Depends(get_db)):
+    """
+    Add units to an existing codingjob. The body is newline delimited JSON (application/x-ndjson), with one unit
+    per line in the same format as the units of a new job. Units can have a "jobsets" key with a list of jobset names,
+    otherwise they are added to all jobsets.
+    The body is read and added in batches, so uploads of any size can be made. If an upload fails halfway, the
+    units of the previous batches have been added, but repeating the upload is safe, because units with an id that
+    the job already has are skipped.
+    """
+    check_admin(user)
+    job = await run_in_threadpool(_job, db, job_id)
+    if await run_in_threadpool(crud_archive.get_archive, db, job_id) is not None:
+        raise HTTPException(status_code=400, detail='Units cannot be added to a job in cold storage')
+    if await run_in_threadpool(crud_codingjob.ingest_pending, db, job_id):
+        raise HTTPException(status_code=400, detail='Units cannot be added to a job that is still being created')
+
+    n_units, n_added = 0, 0
+    try:
+        async for units in ndjson_chunks(request.stream(), batch_size):
+            n_units += len(units)
+            n_added += await run_in_threadpool(crud_codingjob.append_units, db, job, units)
+    except ValueError as e:
+        await run_in_threadpool(db.rollback)
+        raise HTTPException(status_code=400, detail=f'{e} (added {n_added} units)')
+    except HTTPException as e:
+        await run_in_threadpool(db.rollback)
+        raise HTTPException(status_code=e.status_code, detail=f'{e.detail} (added {n_added} units)')
+    return dict(n_added=n_added, n_skipped=n_units - n_added)
+
+
 @app_annotator_codingjob.post("/{job_id}/users", status_code=204)
 def set_job_users(job_id: int,
                   user: User = Depends(auth_user),
@@ -99,46 +253,111 @@ def set_job_users(job_id: int,
 def get_job(job_id: int,
             annotations: bool = Query(
                 None, description="Boolean for whether or not to include annotations"),
+            page_size: int = Query(
+                None, ge=1, le=MAX_PAGE_SIZE, description="If given, return at most this many units (and annotations) per page"),
+            cursor: str = Query(
+                None, description="The next_cursor of the previous page"),
             user: User = Depends(auth_user),
-            db: Session = Depends(get_db)):
+            db: Session = Depends(get_read_db)):
     """
-    Return a single coding job definition
+    Return a single coding job definition.
+    For large jobs, units and annotations can be retrieved in pages by giving a page_size (or cursor).
+    The response then has a next_cursor, that can be used to get the next page. If next_cursor is None,
+    all units and annotations have been retrieved.
     """
     check_admin(user)
 
     job = _job(db, job_id)
-    units = crud_codingjob.get_units(db, job_id)
-
     cj = {
         "id": job_id,
         "title": job.title,
-        "jobsets": [js for js in job.jobsets],
+        "jobsets": [crud_codingjob.jobset_dict(db, js) for js in job.jobsets],
         "provenance": job.provenance,
-        "rules": job.rules,
-        "units": [u for u in units],
     }
+
+    if page_size is None and cursor is None:
+        cj['units'] = [crud_codingjob.unit_dict(db, u) for u in crud_codingjob.iter_units(db, job_id)]
+        if annotations:
+            cj['annotations'] = list(crud_codingjob.get_annotations(db, job_id))
+        return cj
+
+    if page_size is None:
+        page_size = DEFAULT_PAGE_SIZE
+    position = dict(job=job_id, unit=0, annotation=0)
+    if cursor is not None:
+        try:
+            position = decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+        if position.get('job') != job_id:
+            raise HTTPException(status_code=400, detail='Cursor does not belong to this codingjob')
+        if not all(isinstance(position.get(key), int) for key in ['unit', 'annotation']):
+            raise HTTPException(status_code=400, detail='Invalid cursor')
+
+    units = crud_codingjob.get_units_page(db, job_id, position['unit'], page_size)
+    cj['units'] = [crud_codingjob.unit_dict(db, u) for u in units]
+    done = len(units) < page_size
+    if len(units) > 0:
+        position['unit'] = units[-1].id
     if annotations:
-        cj['annotations'] = [
-            a for a in crud_codingjob.get_annotations(db, job_id)]
+        cj['annotations'] = list(crud_codingjob.get_annotations(db, job_id, position['annotation'], page_size))
+        done = done and len(cj['annotations']) < page_size
+        if len(cj['annotations']) > 0:
+            position['annotation'] = cj['annotations'][-1]['id']
 
+    cj['next_cursor'] = None if done else encode_cursor(position)
     return cj
 
 
+@app_annotator_codingjob.get("/{job_id}/stream")
+def stream_job(job_id: int,
+               annotations: bool = Query(
+                   None, description="Boolean for whether or not to include annotations"),
+               user: User = Depends(auth_user),
+               db: Session = Depends(get_read_db)):
+    """
+    Stream a single coding job definition as newline delimited JSON. The first line has the job details
+    ({"job": {...}}), followed by a line for every unit ({"unit": {...}}) and, if requested, every annotation ({"annotation": {...}}).
+    Units and annotations are read from the database in batches, so this also works for very large jobs.
+    """
+    check_admin(user)
+    job = _job(db, job_id)
+    details = {
+        "id": job_id,
+        "title": job.title,
+        "jobsets": [crud_codingjob.jobset_dict(db, js) for js in job.jobsets],
+        "provenance": job.provenance,
+    }
+
+    def lines():
+        yield json.dumps(dict(job=details), default=str) + '\n'
+        for u in crud_codingjob.iter_units(db, job_id):
+            yield json.dumps(dict(unit=crud_codingjob.unit_dict(db, u)), default=str) + '\n'
+        if annotations:
+            for a in crud_codingjob.iter_annotations(db, job_id):
+                yield json.dumps(dict(annotation=a), default=str) + '\n'
+
+    return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+
 @app_annotator_codingjob.get("/{job_id}/details")
-def get_job_details(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+def get_job_details(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_read_db)):
     """
     Return job details. Primarily for an admin to see progress and settings.
     """
     check_admin(user)
     job = _job(db, job_id)
-    n_total = crud_codingjob.get_units(db, job_id).count()
+    archive = crud_archive.get_archive(db, job_id)
+    if archive is not None:
+        n_total = archive.n_units
+        jobset_units = crud_archive.archived_jobset_units(db, archive)
+    else:
+        n_total = crud_codingjob.get_units(db, job_id).count()
     coders = crud_codingjob.get_job_coders(db, job_id)
 
-    js_details = []
-    for js in job.jobsets:
-        n_units = db.query(JobSetUnit).filter(
-            JobSetUnit.jobset_id == js.id).count()
-        js_details.append({"name": js.jobset, "n_units": n_units, "rules": js.rules})
+    if archive is None:
+        jobset_units = crud_codingjob.count_jobset_units(db, job_id)
+    js_details = [{"name": js.jobset, "n_units": jobset_units.get(js.id, 0), "rules": js.rules} for js in job.jobsets]
 
     data = {
         "id": job_id,
@@ -147,6 +366,7 @@ def get_job_details(job_id: int, user: User = Depends(auth_user), db: Session =
         "restricted": job.restricted,
         "created": job.created,
         "archived": job.archived,
+        "cold_storage": archive is not None,
         "n_total": n_total,
         "users": [coder.name for coder in coders]
     }
@@ -154,8 +374,45 @@ def get_job_details(job_id: int, user: User = Depends(auth_user), db: Session =
     return data
 
 
+@app_annotator_codingjob.get("/{job_id}/events")
+async def get_job_events(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+    """
+    Live progress of a job as server-sent events, as an alternative to polling the details. The first event
+    ("snapshot") has the number of units and the number of annotations per status for every jobset, e.g.
+    {"jobsets": {"3": {"name": "All", "n_units": 100, "IN_PROGRESS": 2, "DONE": 10}}}. After that, "progress"
+    events have the changes since the previous event, e.g. {"jobsets": {"3": {"IN_PROGRESS": -1, "DONE": 1}}}.
+    Changes are sent at most once per second, and a new snapshot is sent every minute (see events.py).
+    """
+    check_admin(user)
+    await run_in_threadpool(_job, db, job_id)
+
+    def snapshot():
+        try:
+            return crud_codingjob.get_job_progress(db, job_id)
+        finally:
+            # don't keep a connection while waiting for events
+            db.rollback()
+
+    stream = events.progress_stream(job_id, lambda: run_in_threadpool(snapshot))
+    return StreamingResponse(stream, media_type='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app_annotator_codingjob.get("/{job_id}/statistics")
+def get_job_statistics(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_read_db)):
+    """
+    Get statistics per jobset and per coder: the number of started, done and retry units, the total damage, and the
+    median number of seconds per unit. Statistics are cached for a few seconds, and then only the coders that made
+    changes are recomputed.
+    """
+    check_admin(user)
+    job = _job(db, job_id)
+    if crud_archive.get_archive(db, job_id) is not None:
+        raise HTTPException(status_code=400, detail='A job in cold storage has to be restored to compute statistics')
+    return crud_statistics.get_statistics(db, job)
+
+
 @app_annotator_codingjob.get("/{job_id}/annotations")
-def get_job_annotations(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+def get_job_annotations(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_read_db)):
     """
     Return a list with all annotations
     """
@@ -165,6 +422,29 @@ def get_job_annotations(job_id: int, user: User = Depends(auth_user), db: Sessio
     return data
 
 
+@app_annotator_codingjob.get("/{job_id}/annotations/export")
+def export_job_annotations(job_id: int,
+                           format: str = Query(
+                               'parquet', regex='^(parquet|arrow)$', description="parquet or arrow (Arrow IPC stream format)"),
+                           user: User = Depends(auth_user),
+                           db: Session = Depends(get_read_db)):
+    """
+    Export the annotations as a table with one row per coded value, with the columns annotation_id, jobset,
+    unit_id, coder_id, coder, status, variable, value, field, offset and length. Values that are not strings are
+    JSON encoded. Annotations are read and written in batches, so this also works for very large jobs.
+    """
+    check_admin(user)
+    _job(db, job_id)
+    try:
+        export.import_pyarrow()
+    except ImportError as e:
+        raise HTTPException(status_code=501, detail=str(e))
+    data = export.write_annotations(crud_codingjob.iter_annotations(db, job_id), format)
+    extension = 'parquet' if format == 'parquet' else 'arrows'
+    headers = {'Content-Disposition': f'attachment; filename="codingjob_{job_id}_annotations.{extension}"'}
+    return StreamingResponse(data, media_type=export.FORMATS[format], headers=headers)
+
+
 @app_annotator_codingjob.get("/{job_id}/token")
 def get_job_token(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
     """
@@ -181,16 +461,43 @@ def get_job_token(job_id: int, user: User = Depends(auth_user), db: Session = De
 
 
 @app_annotator_codingjob.get("/{job_id}/codebook")
-def get_codebook(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+def get_codebook(job_id: int, request: Request, user: User = Depends(auth_user), db: Session = Depends(get_db)):
     """
-    Get the codebook for a specific job
+    Get the codebook for a specific job.
+    The ETag is the hash of the codebook, so clients can use If-None-Match to only download it if it changed.
     """
     jobuser = _jobuser(db, user, job_id)
-    return jobuser.jobset.codebook
+    config = crud_jobset.get_config(db, jobuser.jobset)
+    if config.codebook_hash is None:
+        return config.codebook
+    return codebook_response(request, config.codebook_hash, crud_codebook.get_codebook(db, config.codebook_hash), max_age=0)
+
+
+@app_annotator_codingjob.get("/{job_id}/codebook/{codebook_hash}")
+def get_codebook_by_hash(job_id: int, codebook_hash: str, request: Request, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+    """
+    Get a codebook of a job by its hash (see the codebook_ref option of GET /codingjob/{job_id}/unit).
+    Codebooks never change, so clients can cache them indefinitely.
+    """
+    if user.is_admin:
+        _job(db, job_id)
+    else:
+        _jobuser(db, user, job_id)
+    if not crud_codebook.job_uses_codebook(db, job_id, codebook_hash):
+        raise HTTPException(status_code=404)
+    return codebook_response(request, codebook_hash, crud_codebook.get_codebook(db, codebook_hash))
+
+
+def codebook_response(request: Request, codebook_hash: str, codebook: dict, max_age: int = 31536000) -> Response:
+    headers = {'ETag': f'"{codebook_hash}"'}
+    headers['Cache-Control'] = f'private, max-age={max_age}, immutable' if max_age else 'private, no-cache'
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(codebook, headers=headers)
 
 
 @app_annotator_codingjob.get("/{job_id}/progress")
-def get_progress(job_id, user: User = Depends(auth_user), db: Session = Depends(get_db)):
+def get_progress(job_id: int, user: User = Depends(auth_user), db: Session = Depends(get_db)):
     """
     Get a user's progress on a specific job.
     """
@@ -200,16 +507,21 @@ def get_progress(job_id, user: User = Depends(auth_user), db: Session = Depends(
 
 
 @app_annotator_codingjob.get("/{job_id}/unit")
-def get_unit(job_id,
+def get_unit(job_id: int,
+             request: Request,
              index: int = Query(
                  None, description="The index of unit set for a particular user"),
+             codebook_ref: bool = Query(
+                 False, description="If true, a unit specific codebook is given as unit.codebook_hash instead of unit.codebook. Get it with GET /codingjob/{job_id}/codebook/{hash}"),
              user: User = Depends(auth_user), db: Session = Depends(get_db)):
     """
     Retrieve a single unit to be coded.
     If ?index=i is specified, seek a specific unit. Otherwise, return the next unit to code
     """
+    ratelimit.coder_units.hit(user.id)
     jobuser = _jobuser(db, user, job_id)
-    return crud_codingjob.get_unit(db, jobuser, index)
+    unit = crud_codingjob.get_unit(db, jobuser, index, codebook_ref)
+    return compression.unit_response(request, unit, codebook_ref)
 
 
 @app_annotator_codingjob.post("/{job_id}/unit/{unit_id}/annotation", status_code=200)
@@ -229,9 +541,12 @@ def post_annotation(job_id: int,
       "status": "DONE"|"IN_PROGRESS"
     }
     """
+    ratelimit.coder_units.hit(coder.id)
     ann = crud_codingjob.get_unit_annotation(db, job_id, unit_id, coder.id)
     if not ann:
         raise HTTPException(status_code=404)
+    if crud_codingjob.is_archived(db, job_id):
+        raise HTTPException(status_code=404, detail="This codingjob is archived")
     if ann.codingjob_id != job_id:
         raise HTTPException(status_code=400)
     if not annotation:
@@ -242,7 +557,7 @@ def post_annotation(job_id: int,
 
 
 @app_annotator_codingjob.get("")
-def get_all_jobs(user: User = Depends(auth_user), db: Session = Depends(get_db)):
+def get_all_jobs(user: User = Depends(auth_user), db: Session = Depends(get_read_db)):
     """
     Get a list of all codingjobs
     """
@@ -266,10 +581,12 @@ def get_debriefing(job_id: int,
         raise HTTPException(
             status_code=404, detail='Can only get debrief information once job is completed')
 
-    debriefing = jobuser.jobset.debriefing
+    debriefing = crud_jobset.get_config(db, jobuser.jobset).debriefing
     if debriefing is None:
         return None
 
+    # the configuration is shared between requests, so don't change it
+    debriefing = dict(debriefing)
     debriefing['user_id'] = re.sub('jobuser_[0-9]+_', '', user.name)
     return debriefing
 
@@ -0,0 +1,218 @@
+"""
+Compression of HTTP responses.
+
+The CompressionMiddleware compresses responses larger than COMPRESSION_MIN_SIZE bytes (default 1024, or "off")
+with the best encoding that the client accepts: zstd (if zstandard is installed), br (if brotli is installed) or gzip.
+Streaming responses (e.g., exports) are compressed while they are streamed.
+
+Units are served to many coders (especially in crowd coding jobs), so the compressed unit content is cached
+(see unit_response). The response for a coder is then made by appending the (small) coder specific part to the
+cached compressed content: for gzip as extra deflate blocks, and for zstd as an extra frame.
+"""
+
+import json
+import os
+import struct
+import zlib
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
+
+from annotinder.cache import LRUCache
+from annotinder.compression import zstandard
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+load_dotenv()
+
+COMPRESSION_MIN_SIZE = os.getenv('COMPRESSION_MIN_SIZE', '1024')
+COMPRESSION_MIN_SIZE = None if COMPRESSION_MIN_SIZE == 'off' else int(COMPRESSION_MIN_SIZE)
+
+# supported encodings, in order of preference
+ENCODINGS = [e for e, available in [('zstd', zstandard is not None), ('br', brotli is not None), ('gzip', True)] if available]
+# content types that are already compressed, or that have to be sent as they are produced
+SKIP_CONTENT_TYPES = ('text/event-stream', 'application/vnd.apache.parquet')
+
+GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+
+
+def negotiate(accept_encoding: str, encodings=ENCODINGS) -> Optional[str]:
+    """
+    Choose the encoding with the highest q value in the Accept-Encoding header, preferring the order of encodings
+    """
+    accepted = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        accepted[name.strip()] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class Encoder:
+    """
+    Streaming compressor for a content encoding
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = encoding
+        if encoding == 'zstd':
+            self.compressor = zstandard.ZstdCompressor(level=3).compressobj()
+        elif encoding == 'br':
+            self.compressor = brotli.Compressor(quality=4)
+        else:
+            self.compressor = zlib.compressobj(5, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        if self.encoding == 'br':
+            return self.compressor.process(data)
+        return self.compressor.compress(data)
+
+    def finish(self) -> bytes:
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = 1024):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        encoding = None
+        if scope['type'] == 'http':
+            encoding = negotiate(Headers(scope=scope).get('accept-encoding', ''))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        await CompressionResponder(self.app, encoding, self.minimum_size)(scope, receive, send)
+
+
+class CompressionResponder:
+    """
+    Compresses a single response. The start message is held until the first part of the body is known,
+    because whether the response is compressed depends on its size.
+    """
+
+    def __init__(self, app, encoding: str, minimum_size: int):
+        self.app = app
+        self.encoding = encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.encoder = None
+        self.passthrough = False
+
+    async def __call__(self, scope, receive, send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message):
+        if message['type'] == 'http.response.start':
+            self.start_message = message
+            return
+        if message['type'] != 'http.response.body' or self.passthrough:
+            await self.send(message)
+            return
+
+        body, more_body = message.get('body', b''), message.get('more_body', False)
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(raw=start['headers'])
+            if ('content-encoding' in headers or headers.get('content-type', '').startswith(SKIP_CONTENT_TYPES)
+                    or (not more_body and len(body) < self.minimum_size)):
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            self.encoder = Encoder(self.encoding)
+            headers['Content-Encoding'] = self.encoding
+            headers.add_vary_header('Accept-Encoding')
+            if more_body:
+                del headers['Content-Length']
+                data = self.encoder.compress(body)
+            else:
+                data = self.encoder.compress(body) + self.encoder.finish()
+                headers['Content-Length'] = str(len(data))
+            await self.send(start)
+            await self.send(dict(type='http.response.body', body=data, more_body=more_body))
+            return
+
+        data = self.encoder.compress(body)
+        if not more_body:
+            data += self.encoder.finish()
+        await self.send(dict(type='http.response.body', body=data, more_body=more_body))
+
+
+class CompressedUnit:
+    """
+    The compressed start of a unit response ('{"unit":' + content), that can be completed with the rest of the response
+    """
+
+    def __init__(self, encoding: str, head: bytes):
+        self.encoding = encoding
+        self.size = len(head)
+        if encoding == 'gzip':
+            # raw deflate blocks, ending with a sync flush so that more blocks can follow
+            compressor = zlib.compressobj(5, zlib.DEFLATED, -15)
+            self.data = GZIP_HEADER + compressor.compress(head) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.crc = zlib.crc32(head)
+        else:
+            self.data = zstandard.ZstdCompressor(level=3).compress(head)
+
+    def complete(self, tail: bytes) -> bytes:
+        if self.encoding == 'gzip':
+            compressor = zlib.compressobj(5, zlib.DEFLATED, -15)
+            trailer = struct.pack('<II', zlib.crc32(tail, self.crc), (self.size + len(tail)) & 0xffffffff)
+            return self.data + compressor.compress(tail) + compressor.flush() + trailer
+        # a zstd stream can consist of multiple frames
+        return self.data + zstandard.ZstdCompressor(level=3).compress(tail)
+
+
+unit_cache = LRUCache('compressed_units', int(os.getenv('COMPRESSED_UNIT_CACHE_BYTES', 64 * 1024 * 1024)), lambda unit: 100 + len(unit.data))
+UNIT_ENCODINGS = [e for e in ENCODINGS if e in ('zstd', 'gzip')]
+
+
+def _json(data) -> bytes:
+    # the same serialization as JSONResponse
+    return json.dumps(data, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+def unit_response(request: Request, unit: dict, codebook_ref: bool = False) -> Response:
+    """
+    Respond with a unit served to a coder (see crud_codingjob.get_unit). The unit content is the same for every coder,
+    so its compressed form is cached, and only the rest of the response (index, annotation, etc.) is compressed per request.
+    """
+    encoding = negotiate(request.headers.get('accept-encoding', ''), UNIT_ENCODINGS)
+    if 'unit' not in unit or encoding is None or COMPRESSION_MIN_SIZE is None:
+        return JSONResponse(jsonable_encoder(unit))
+
+    key = (unit['id'], codebook_ref, encoding)
+    compressed = unit_cache.get(key)
+    if compressed is None:
+        head = b'{"unit":' + _json(jsonable_encoder(unit['unit']))
+        if len(head) < COMPRESSION_MIN_SIZE:
+            return JSONResponse(jsonable_encoder(unit))
+        compressed = CompressedUnit(encoding, head)
+        unit_cache.put(key, compressed)
+
+    rest = jsonable_encoder({k: v for k, v in unit.items() if k != 'unit'})
+    tail = b',' + _json(rest)[1:] if len(rest) > 0 else b'}'
+    return Response(compressed.complete(tail), media_type='application/json',
+                    headers={'Content-Encoding': encoding, 'Vary': 'Accept-Encoding'})
@@ -1,6 +1,6 @@
 import hashlib
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Request, status
 from fastapi.params import Query, Depends
 
 from sqlalchemy.orm import Session
@@ -9,6 +9,7 @@ from annotinder.crud import crud_user
 from annotinder.database import engine, get_db
 from annotinder.auth import verify_jobtoken, get_token
 from annotinder.models import User
+from annotinder import ratelimit
 
 
 app_annotator_guest = APIRouter(prefix='/guest', tags=["annotator guest"])
@@ -17,13 +18,16 @@ app_annotator_guest = APIRouter(prefix='/guest', tags=["annotator guest"])
 ## create another version that authenticates via token, and then only adds jobuser without creating new user
 
 @app_annotator_guest.get("/jobtoken")
-def redeem_job_token(token: str = Query(None, description="A token for getting access to a specific coding job"),
+def redeem_job_token(request: Request,
+                     token: str = Query(None, description="A token for getting access to a specific coding job"),
                      user_id: str = Query(None, description="Optional, a user ID"),
                      db: Session = Depends(get_db)):
     """
     Convert a job token into a 'normal' token.
     Should be called with a token and optional user_id argument
     """
+    ratelimit.jobtoken_ip.hit(ratelimit.client_ip(request))
+    ratelimit.jobtoken.hit(token)
     job = verify_jobtoken(db, token)
     if not job:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Job token not valid")
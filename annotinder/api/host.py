@@ -6,6 +6,8 @@ from sqlalchemy.orm import Session
 from annotinder.database import engine, get_db
 from annotinder.models import User
 from annotinder.crud import crud_user
+from annotinder.auth import auth_user, check_admin
+from annotinder import cache, mail, writer
 
 load_dotenv()
 
@@ -40,4 +42,13 @@ def setup(username: str = Body(None, description="Username"),
     if users > 0:
         raise HTTPException(status_code=404, detail="First admin already created")
     crud_user.register_user(db, username, email, password, admin=True)
-    return Response(status_code=204)
\ No newline at end of file
+    return Response(status_code=204)
+
+
+@app_annotator_host.get("/metrics")
+def get_metrics(user: User = Depends(auth_user)):
+    """
+    Get metrics about the internal queues, caches and group commits of this server process (admin only)
+    """
+    check_admin(user)
+    return dict(mail=mail.mail_queue.metrics(), caches=cache.metrics(), writer=writer.metrics())
@@ -7,20 +7,24 @@ from fastapi import Request, APIRouter, HTTPException, status, Response
 from fastapi.responses import RedirectResponse
 from fastapi.params import Body, Depends, Query
 from fastapi.security import OAuth2PasswordRequestForm
+from email_validator import validate_email, EmailNotValidError
 from sqlalchemy.orm import Session
 
 from annotinder import models
 from annotinder.crud import crud_user
-from annotinder.database import engine, get_db
+from annotinder.database import engine, get_db, get_read_db
 from annotinder.auth import verify_jobtoken, auth_user, check_admin, get_token
 from annotinder.models import User, CodingJob
 
 from annotinder import mail
+from annotinder import ratelimit
 
 models.Base.metadata.create_all(bind=engine)
 
 app_annotator_users = APIRouter(prefix="/users", tags=["annotator users"])
 
+MAX_USERS_PAGE = 1000
+
 
 ## test cookie
 # @app_annotator_users.get("/me/check_cookie", status_code=200)
@@ -40,32 +44,30 @@ app_annotator_users = APIRouter(prefix="/users", tags=["annotator users"])
 
 
 @app_annotator_users.post("/me/token", status_code=200)
-def get_my_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+def get_my_token(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     """
     Get a token via password login
     """
-    u = crud_user.get_user_by_email(db, form_data.username)
-
-    if u.failed_logins >= 5:
-        time_since_block = datetime.now() - datetime.fromtimestamp(u.failed_login_timestamp)
-        minutes = math.floor(time_since_block.total_seconds() / 60)
-        ## !!!!!! minutes now set to 0 for testing. Set to 15 in production
-        if minutes < 0:
-            raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
-                            detail="Too many failed login attempts. You can try again in {minutes} minutes".format(minutes=15-minutes))
-        u.failed_logins = 0   
+    ip = ratelimit.client_ip(request)
+    ratelimit.login_ip.check(ip)
+    try:
+        # normalized for the rate limit per email address. No deliverability check (DNS lookup) on every login attempt
+        email = validate_email(form_data.username, check_deliverability=False).email
+    except EmailNotValidError:
+        email = None
+    if email is not None:
+        ratelimit.login_email.check(email)
 
     user = crud_user.verify_password(
-        db, email=form_data.username, password=form_data.password)
+        db, email=email, password=form_data.password) if email is not None else None
     if not user:
-        u.failed_login_timestamp = math.floor(datetime.now().timestamp())
-        u.failed_logins = u.failed_logins + 1
-        db.commit()
+        if email is not None:
+            ratelimit.login_email.hit(email)
+        ratelimit.login_ip.hit(ip)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect username or password")
     
-    u.failed_logins = 0
-    db.commit()
+    ratelimit.login_email.reset(email)
     return dict(token=get_token(user))
 
 
@@ -134,24 +136,27 @@ def create_admin(email: str,
 
 
 @app_annotator_users.get("")
-def get_users(offset: int = Query(None, description="Offset in User table"),
-              n: int = Query(None, description="Number of users"),
-              
+def get_users(offset: int = Query(None, ge=0, description="Offset in User table"),
+              n: int = Query(MAX_USERS_PAGE, ge=1, le=MAX_USERS_PAGE, description="Number of users"),
+              after: int = Query(None, description="Only return users with an id higher than this. Use the last_id of the previous page for fast pagination"),
+              search: str = Query(None, description="Only return users where the name or email starts with this string"),
+              approximate_total: bool = Query(False, description="Estimate the total number of users instead of counting them (faster for large user tables)"),
               user: User = Depends(auth_user), 
-              db: Session = Depends(get_db)):
+              db: Session = Depends(get_read_db)):
     """
     Get a list of all users
     """
     check_admin(user)
-    return crud_user.get_users(db, offset, n)
+    return crud_user.get_users(db, offset=offset, n=n, after=after, search=search, approximate_total=approximate_total)
     
 
-@app_annotator_users.post("", status_code=204)
+@app_annotator_users.post("", status_code=200)
 def add_users(users: list = Body(None, description="An array of dictionaries with the keys: name, email, password, admin", embed=True),  # notice the embed, because users is (currently) only key in body
               user: User = Depends(auth_user),
               db: Session = Depends(get_db)):
     """
     Create new users.
+    Returns an array with for every user the name, email, id and status ("created", "exists", "duplicate" or "invalid")
     """
 
     check_admin(user)
@@ -159,11 +164,7 @@ def add_users(users: list = Body(None, description="An array of dictionaries wit
     if users is None:
         raise HTTPException(status_code=404, detail='Body needs to have users')
 
-
-    for user in users:
-        u = crud_user.register_user(
-            db, user['name'], user['email'], user.get('password', None), user.get('admin', False))
-    return Response(status_code=204)
+    return crud_user.register_users(db, users)
 
 
 @app_annotator_users.get("/me/codingjob")
@@ -177,19 +178,15 @@ def get_my_jobs(user: User = Depends(auth_user), db: Session = Depends(get_db)):
 
 
 @app_annotator_users.get("/{email}/magiclink", status_code=200)
-def request_magic_link(email: str, db: Session = Depends(get_db)):
+def request_magic_link(request: Request, email: str, db: Session = Depends(get_db)):
     """
     Logging in to a registered account has two routes (if the email address exists).
     If the user doesn't have a password, immediately send a login link via email.
     If the user does have a password, return 
     """
+    ratelimit.magic_link_ip.hit(ratelimit.client_ip(request))
     u = crud_user.get_user_by_email(db, email)
-    
-    if u.tmp_login_secret is not None:
-        minutes_ago = datetime.now() - timedelta(minutes=10)
-        if u.tmp_login_secret['expires'] > minutes_ago.timestamp():
-            raise HTTPException(status_code=429,
-                            detail="Can only send magic link once every 10 minutes")
+    ratelimit.magic_link.hit(u.email)
     
     secret = "%06d" % random.randint(0,999999)
     expires_date = datetime.now() + timedelta(minutes=20)
@@ -2,7 +2,8 @@ import os
 import json
 import logging
 import math
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
@@ -23,6 +24,8 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/users/me/token")
 
 load_dotenv()
 ENV_SECRET_KEY = os.getenv('SECRET_KEY') 
+# number of threads for hashing passwords in bulk (bcrypt releases the GIL, so these run in parallel)
+HASH_WORKERS = int(os.getenv('HASH_WORKERS', min(4, os.cpu_count() or 1)))
 
 def secret_key():
     if ENV_SECRET_KEY is None:
@@ -61,6 +64,14 @@ def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt()).decode("utf-8")
 
 
+def hash_passwords(passwords: List[Optional[str]]) -> List[Optional[str]]:
+    """
+    Hash a list of passwords concurrently on a bounded pool of threads. Empty passwords give None
+    """
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        return list(pool.map(lambda password: hash_password(password) if password else None, passwords))
+
+
 def verify_password(password: str, db_password: str):  
     if password is None or db_password is None: 
         return False
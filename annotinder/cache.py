@@ -0,0 +1,76 @@
+"""
+In-process caches. Every cache registers itself by name, so that its metrics are listed in GET /host/metrics
+"""
+
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+caches = {}
+
+
+class LRUCache:
+    """
+    Least recently used cache that holds at most max_bytes bytes, as estimated by sizeof(value).
+    Values larger than max_bytes are not cached.
+    """
+
+    def __init__(self, name: str, max_bytes: int, sizeof: Callable[[Any], int] = len):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.values = OrderedDict()  # key -> (value, size)
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        caches[name] = self
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.lock:
+            item = self.values.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.values.move_to_end(key)
+            return item[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        size = self.sizeof(value)
+        with self.lock:
+            old = self.values.pop(key, None)
+            if old is not None:
+                self.n_bytes -= old[1]
+            if size > self.max_bytes:
+                return
+            self.values[key] = (value, size)
+            self.n_bytes += size
+            while self.n_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.values.popitem(last=False)
+                self.n_bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """
+        Remove all values for which predicate(key, value) is true, and return the number of removed values
+        """
+        with self.lock:
+            keys = [key for key, (value, _) in self.values.items() if predicate(key, value)]
+            for key in keys:
+                self.n_bytes -= self.values.pop(key)[1]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.values.clear()
+            self.n_bytes = 0
+
+    def metrics(self) -> dict:
+        return dict(size=len(self.values), bytes=self.n_bytes, max_bytes=self.max_bytes, hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+def metrics() -> dict:
+    return {name: cache.metrics() for name, cache in caches.items()}
@@ -0,0 +1,51 @@
+"""
+Compression codecs for data that is stored compressed (e.g., archived coding jobs).
+zstd is used if the zstandard package is installed (pip install annotinder[zstd]), otherwise zlib.
+The codec is stored together with the data, so data compressed with either codec can always be read
+(as long as zstandard is installed for zstd data).
+"""
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'zlib'
+
+
+def _check(codec: str) -> None:
+    if codec not in ('zstd', 'zlib'):
+        raise ValueError(f'Unknown compression codec: {codec}')
+    if codec == 'zstd' and zstandard is None:
+        raise ValueError('The zstandard package is required for zstd compressed data')
+
+
+def compressobj(codec: str = DEFAULT_CODEC, level: int = 6):
+    """
+    Get a streaming compressor, with compress(data) and flush() methods
+    """
+    _check(codec)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compressobj()
+    return zlib.compressobj(level)
+
+
+def decompressobj(codec: str):
+    """
+    Get a streaming decompressor, with a decompress(data) method
+    """
+    _check(codec)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompressobj()
+    return zlib.decompressobj()
+
+
+def compress(data: bytes, codec: str = DEFAULT_CODEC, level: int = 6) -> bytes:
+    c = compressobj(codec, level)
+    return c.compress(data) + c.flush()
+
+
+def decompress(data: bytes, codec: str) -> bytes:
+    return decompressobj(codec).decompress(data)
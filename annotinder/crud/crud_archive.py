@@ -0,0 +1,198 @@
+import json
+from datetime import datetime
+from typing import Iterable, List, Optional
+
+from sqlalchemy import DateTime, insert
+from sqlalchemy.orm import Session
+
+from annotinder import compression, partitions
+from annotinder.crud import crud_unit
+from annotinder.models import CodingJob, JobSet, JobSetUnit, Unit, Annotation, JobArchive, JobArchiveChunk, User
+from annotinder.utils import chunks, dialect_insert
+
+# the tables that are moved to cold storage, in the order in which they are archived and restored
+ARCHIVED_TABLES = (('unit', Unit), ('jobsetunit', JobSetUnit), ('annotation', Annotation))
+
+
+def get_archive(db: Session, codingjob_id: int) -> Optional[JobArchive]:
+    return db.query(JobArchive).filter(JobArchive.codingjob_id == codingjob_id).first()
+
+
+def _job_rows(db: Session, job: CodingJob, kind: str, batch_size: int = 1000) -> Iterable[dict]:
+    """
+    Iterate over the rows of one of the archived tables for a job, as dictionaries, fetching them in batches
+    """
+    model = dict(ARCHIVED_TABLES)[kind]
+    query = db.query(*model.__table__.columns)
+    if model is Annotation:
+        # so that the annotations of an archived job can be listed without reading the archived units
+        query = query.add_columns(Unit.external_id.label('unit_external_id')).outerjoin(Unit, Unit.id == Annotation.unit_id)
+    query = query.filter(_job_filter(job, model)).order_by(model.id)
+    after = 0
+    while True:
+        rows = query.filter(model.id > after).limit(batch_size).all()
+        for row in rows:
+            yield row._asdict()
+        if len(rows) < batch_size:
+            return
+        after = rows[-1].id
+
+
+def _job_filter(job: CodingJob, model):
+    if model is JobSetUnit:
+        return JobSetUnit.jobset_id.in_([js.id for js in job.jobsets])
+    return model.codingjob_id == job.id
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def archive_job(db: Session, job: CodingJob, batch_size: int = 1000) -> JobArchive:
+    """
+    Move the units, jobsetunits and annotations of a job to cold storage. The rows are written to compressed
+    chunks of batch_size rows in a single transaction, after which they are deleted from the hot tables in batches
+    of batch_size rows (each batch in a separate transaction, so that coders on other jobs are not blocked).
+    If a previous archive_job was interrupted during the deletion, calling it again finishes the deletion.
+    Coders cannot open the job or change annotations once it is archived, so this is committed first.
+    """
+    job.archived = True
+    db.commit()
+    archive = get_archive(db, job.id)
+    if archive is None:
+        # lock the job, so that updates of coders that saw the job before it was archived are done (and archived) first
+        if db.get_bind().dialect.name == 'sqlite':
+            # SQLite ignores FOR UPDATE, so instead take the write lock of the database before reading
+            db.commit()
+            db.connection().exec_driver_sql('BEGIN IMMEDIATE')
+        db.query(CodingJob.id).filter(CodingJob.id == job.id).with_for_update().one()
+        archive = JobArchive(codingjob_id=job.id, codec=compression.DEFAULT_CODEC, n_units=0, n_annotations=0, size=0)
+        db.add(archive)
+        db.flush()
+        for kind, model in ARCHIVED_TABLES:
+            for batch in chunks(_job_rows(db, job, kind, batch_size), batch_size):
+                data = ''.join(json.dumps(row, default=_json_default) + '\n' for row in batch).encode('utf-8')
+                data = compression.compress(data, archive.codec)
+                db.execute(insert(JobArchiveChunk.__table__).values(codingjob_id=job.id, kind=kind, min_id=batch[0]['id'],
+                                                                    max_id=batch[-1]['id'], data=data))
+                archive.size += len(data)
+                if kind == 'unit':
+                    archive.n_units += len(batch)
+                if kind == 'annotation':
+                    archive.n_annotations += len(batch)
+    db.commit()
+    delete_job_rows(db, job, batch_size)
+    return archive
+
+
+def delete_job_rows(db: Session, job: CodingJob, batch_size: int = 1000) -> None:
+    """
+    Delete the annotations, jobsetunits and units of a job, in batches of batch_size rows that are each committed
+    separately. If the tables are partitioned by codingjob, the partitions of the job are dropped instead.
+    """
+    crud_unit.invalidate_job(job.id)
+    partitions.drop_partitions(db, job.id)
+    for kind, model in reversed(ARCHIVED_TABLES):
+        while True:
+            ids = [row.id for row in db.query(model.id).filter(_job_filter(job, model)).limit(batch_size)]
+            if len(ids) == 0:
+                break
+            db.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+
+
+def delete_archive(db: Session, codingjob_id: int) -> None:
+    """
+    Delete the archive of a job (without committing)
+    """
+    db.query(JobArchiveChunk).filter(JobArchiveChunk.codingjob_id == codingjob_id).delete(synchronize_session=False)
+    db.query(JobArchive).filter(JobArchive.codingjob_id == codingjob_id).delete(synchronize_session=False)
+
+
+def restore_job(db: Session, job: CodingJob) -> None:
+    """
+    Move an archived job back from cold storage into the hot tables, with the original ids.
+    This is done in a single transaction, and rows that are still in the hot tables are skipped.
+    """
+    archive = get_archive(db, job.id)
+    if archive is not None:
+        partitions.create_partitions(db, job.id)
+        for kind, model in ARCHIVED_TABLES:
+            columns = {c.key for c in model.__table__.columns}
+            datetime_columns = [c.key for c in model.__table__.columns if isinstance(c.type, DateTime)]
+            primary_key = [c.name for c in model.__table__.primary_key]
+            for chunk in iter_chunks(db, archive, kind):
+                batch = [{key: value for key, value in row.items() if key in columns} for row in chunk]
+                for row in batch:
+                    # jobsetunits archived before they had a codingjob_id
+                    if row.get('codingjob_id') is None:
+                        row['codingjob_id'] = job.id
+                    for column in datetime_columns:
+                        if row.get(column) is not None:
+                            row[column] = datetime.fromisoformat(row[column])
+                db.execute(dialect_insert(db, model.__table__).values(batch).on_conflict_do_nothing(index_elements=primary_key))
+        delete_archive(db, job.id)
+    job.archived = False
+    db.commit()
+
+
+def iter_chunks(db: Session, archive: JobArchive, kind: str, after: int = 0) -> Iterable[List[dict]]:
+    """
+    Iterate over the chunks of one of the archived tables of a job, as lists of rows ordered by id. Only the chunks
+    with rows that have an id higher than after are read (and only those rows are returned). Chunks are read one by one,
+    so that memory use doesn't depend on the size of the archive.
+    """
+    chunk_ids = [min_id for min_id, in (db.query(JobArchiveChunk.min_id)
+                                          .filter(JobArchiveChunk.codingjob_id == archive.codingjob_id,
+                                                  JobArchiveChunk.kind == kind, JobArchiveChunk.max_id > after)
+                                          .order_by(JobArchiveChunk.min_id))]
+    for min_id in chunk_ids:
+        data = (db.query(JobArchiveChunk.data)
+                  .filter(JobArchiveChunk.codingjob_id == archive.codingjob_id, JobArchiveChunk.kind == kind,
+                          JobArchiveChunk.min_id == min_id)
+                  .scalar())
+        lines = compression.decompress(bytes(data), archive.codec).splitlines()
+        rows = [row for row in map(json.loads, lines) if row['id'] > after]
+        if len(rows) > 0:
+            yield rows
+
+
+def iter_archive(db: Session, archive: JobArchive, kind: str, after: int = 0) -> Iterable[dict]:
+    """
+    Iterate over the rows of one of the archived tables of a job with an id higher than after, ordered by id
+    """
+    for chunk in iter_chunks(db, archive, kind, after):
+        yield from chunk
+
+
+def archived_units(db: Session, archive: JobArchive, after: int = 0) -> Iterable[Unit]:
+    """
+    Iterate over the units in an archive (as transient Unit objects), ordered by id
+    """
+    for row in iter_archive(db, archive, 'unit', after):
+        yield Unit(**row)
+
+
+def archived_annotations(db: Session, archive: JobArchive, after: int = 0, batch_size: int = 1000) -> Iterable[dict]:
+    """
+    Iterate over the annotations in an archive, in the same format as crud_codingjob.get_annotations
+    """
+    jobsets = dict(db.query(JobSet.id, JobSet.jobset).filter(JobSet.codingjob_id == archive.codingjob_id))
+    for batch in chunks(iter_archive(db, archive, 'annotation', after), batch_size):
+        coders = dict(db.query(User.id, User.name).filter(User.id.in_({a['coder_id'] for a in batch})))
+        for a in batch:
+            yield {"id": a['id'], "jobset": jobsets.get(a['jobset_id']), "unit_id": a['unit_external_id'],
+                   "coder_id": a['coder_id'], "coder": coders.get(a['coder_id']), "annotation": a['annotation'],
+                   "status": a['status']}
+
+
+def archived_jobset_units(db: Session, archive: JobArchive) -> dict:
+    """
+    Count the units per jobset in an archive
+    """
+    counts = {}
+    for row in iter_archive(db, archive, 'jobsetunit'):
+        counts[row['jobset_id']] = counts.get(row['jobset_id'], 0) + 1
+    return counts
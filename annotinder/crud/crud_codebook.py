@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from annotinder.cache import LRUCache
+from annotinder.models import Codebook, JobSet, Unit
+from annotinder.utils import dialect_insert
+
+load_dotenv()
+
+
+def _sizeof(codebook: dict) -> int:
+    return 100 + len(json.dumps(codebook))
+
+
+# codebooks are content addressed (the hash changes if the codebook changes), so cached codebooks never have to be invalidated
+cache = LRUCache('codebooks', int(os.getenv('CODEBOOK_CACHE_BYTES', 16 * 1024 * 1024)), _sizeof)
+
+
+def codebook_hash(codebook: dict) -> str:
+    """
+    The sha256 hash of the codebook in canonical JSON (sorted keys, no whitespace)
+    """
+    data = json.dumps(codebook, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def store_codebook(db: Session, codebook: dict) -> str:
+    """
+    Store a codebook (if it isn't stored yet), and return its hash. It is only added to the cache once it is read,
+    so that the cache never has codebooks of transactions that were rolled back
+    """
+    h = codebook_hash(codebook)
+    db.execute(dialect_insert(db, Codebook.__table__).values(hash=h, codebook=codebook).on_conflict_do_nothing(index_elements=['hash']))
+    return h
+
+
+def get_codebook(db: Session, codebook_hash: str) -> dict:
+    codebook = cache.get(codebook_hash)
+    if codebook is None:
+        codebook = db.query(Codebook.codebook).filter(Codebook.hash == codebook_hash).scalar()
+        if codebook is None:
+            raise HTTPException(status_code=404)
+        cache.put(codebook_hash, codebook)
+    return codebook
+
+
+def job_uses_codebook(db: Session, codingjob_id: int, codebook_hash: str) -> bool:
+    """
+    Check whether a codebook is used by a jobset or unit of a job
+    """
+    for model in [JobSet, Unit]:
+        if db.query(model.id).filter(model.codingjob_id == codingjob_id, model.codebook_hash == codebook_hash).first() is not None:
+            return True
+    return False
+
+
+def jobset_codebook(db: Session, jobset: JobSet) -> dict:
+    """
+    Get the codebook of a jobset. Jobsets created before codebooks were stored by hash have the codebook in the jobset itself
+    """
+    if jobset.codebook_hash is None:
+        return jobset.codebook
+    return get_codebook(db, jobset.codebook_hash)
+
+
+def unit_content(db: Session, unit: Unit, codebook_ref: bool = False) -> dict:
+    """
+    Get the unit content. If the unit has its own codebook, this is included as "codebook", or if codebook_ref is True
+    only its hash is included as "codebook_hash" (so that clients can get the codebook once via GET /codingjob/{job_id}/codebook/{hash})
+    """
+    if unit.codebook_hash is None:
+        return unit.unit
+    if codebook_ref:
+        return {**unit.unit, 'codebook_hash': unit.codebook_hash}
+    return {**unit.unit, 'codebook': get_codebook(db, unit.codebook_hash)}
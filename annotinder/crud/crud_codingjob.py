@@ -1,42 +1,241 @@
+import json
 import logging
+import os
 from typing import Optional, Tuple
-from sqlalchemy import true, func
+from sqlalchemy import bindparam, column, exists, true, func, insert, literal, select, table, text, update
 
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, undefer
 
-from annotinder.models import User, Unit, CodingJob, Annotation, JobUser, JobSetUnit, JobSet
+from annotinder.models import User, Unit, CodingJob, Annotation, JobUser, JobSetUnit, JobSet, JobIngest
 from annotinder.crud.conditionals import check_conditionals, invalid_conditionals
-from annotinder import unitserver
+from annotinder.crud.saturation import saturation_rules, update_saturation
+from annotinder.crud import crud_archive, crud_codebook, crud_jobset, crud_unit
+from annotinder import events, unitserver, partitions, writer
+from annotinder.utils import chunks, dialect_insert
 
 import datetime
+from itertools import islice
 from typing import List, Iterable, Optional
 
+from dotenv import load_dotenv
 from fastapi import HTTPException
 
+load_dotenv()
+
+# background ingests that made no progress for this long are considered interrupted (e.g., by a server restart)
+INGEST_TIMEOUT_SECONDS = float(os.getenv('INGEST_TIMEOUT_SECONDS', 600))
+
 
 def create_codingjob(db: Session, title: str, codebook: dict, jobsets: list, rules: dict, creator: User, units: List[dict],
                      debriefing: Optional[dict] = None, authorization: Optional[dict] = None) -> int:
 
     if authorization is None:
         authorization = {}
-    restricted = authorization.get('restricted', False)
+    job = new_codingjob(db, title, creator, authorization)
+
+    add_units(db, job, units)
+    add_jobsets(db, job=job, jobsets=jobsets, codebook=codebook, rules=rules, debriefing=debriefing)
+    set_job_coders(db, codingjob_id=job.id, names=authorization.get('users', []), commit=False)
+
+    # Only commits at this point, so create_codingjob can be wrapped in a try/except that rolls back changes on fail
+    db.commit()
+    return job
 
-    job = CodingJob(title=title, creator=creator, restricted=restricted)
+
+def new_codingjob(db: Session, title: str, creator: User, authorization: dict) -> CodingJob:
+    """
+    Add an (empty) codingjob without committing. If the tables are partitioned, the partitions of the job are
+    created first (and committed separately, see partitions.create_partitions)
+    """
+    job = CodingJob(title=title, creator=creator, restricted=authorization.get('restricted', False))
+    if partitions.is_partitioned(db):
+        job.id = partitions.new_codingjob_id(db)
+        partitions.create_partitions(db, job.id)
     db.add(job)
     db.flush()
     db.refresh(job)
+    return job
 
-    add_units(db, job, units)
-    add_jobsets(db, job=job, jobsets=jobsets, codebook=codebook, rules=rules, debriefing=debriefing)
-    set_job_coders(db, codingjob_id=job.id, names=authorization.get('users', []))
 
-    # Only commits at this point, so create_codingjob can be wrapped in a try/except that rolls back changes on fail
+def queue_codingjob(db: Session, title: str, creator: User, n_units: int, authorization: Optional[dict] = None) -> CodingJob:
+    """
+    Create a codingjob that is filled in the background by ingest_codingjob. Until that is done, coders cannot open the job.
+    """
+    job = new_codingjob(db, title, creator, authorization or {})
+    db.add(JobIngest(codingjob_id=job.id, status='queued', n_units=n_units, n_done=0, updated=datetime.datetime.now()))
     db.commit()
     return job
 
 
+def ingest_codingjob(bind, codingjob_id: int, codebook: dict, jobsets: list, rules: dict, units: List[dict],
+                     debriefing: Optional[dict] = None, authorization: Optional[dict] = None, chunk_size: int = 1000) -> None:
+    """
+    Add the units, jobsets and coders of a job created with queue_codingjob. This is meant to run as a background task,
+    so it uses its own session on the given engine (bind). Background tasks run in the server process after the response
+    is sent, so if the server is restarted the ingest is interrupted (see fail_stale_ingests).
+    Units are added in chunks of chunk_size that are committed separately, to report progress and keep transactions short.
+    The jobsets and coders are added in the last transaction, together with setting the status to done, so that coders
+    can only open the job once it is complete. If anything fails, the units added so far are deleted and the status is
+    set to failed, with the error.
+    """
+    if authorization is None:
+        authorization = {}
+    with Session(bind=bind, autoflush=False) as db:
+        job = db.query(CodingJob).filter(CodingJob.id == codingjob_id).one()
+        ingest = get_ingest(db, codingjob_id)
+        try:
+            _ingest_progress(db, codingjob_id, status='running')
+            db.commit()
+            for batch in chunks(units, chunk_size):
+                add_units(db, job, batch)
+                _ingest_progress(db, codingjob_id, n_done=JobIngest.n_done + len(batch))
+                db.commit()
+            add_jobsets(db, job=job, jobsets=jobsets, codebook=codebook, rules=rules, debriefing=debriefing)
+            set_job_coders(db, codingjob_id=job.id, names=authorization.get('users', []), commit=False)
+            _ingest_progress(db, codingjob_id, status='done', finished=datetime.datetime.now())
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logging.exception(f'Could not ingest codingjob {codingjob_id}')
+            crud_archive.delete_job_rows(db, job)
+            ingest.status = 'failed'
+            ingest.error = str(e.detail) if isinstance(e, HTTPException) else str(e)
+            ingest.finished = datetime.datetime.now()
+            db.commit()
+
+
+def _ingest_progress(db: Session, codingjob_id: int, **values) -> None:
+    """
+    Update the status of an ingest that is still queued or running. If it was marked as failed in the meantime
+    (by fail_stale_ingests), the ingest is stopped
+    """
+    n = (db.query(JobIngest).filter(JobIngest.codingjob_id == codingjob_id, JobIngest.status.in_(['queued', 'running']))
+         .update(dict(updated=datetime.datetime.now(), **values), synchronize_session=False))
+    if n == 0:
+        raise Exception('The ingest was interrupted')
+
+
+def fail_stale_ingests(db: Session, codingjob_id: Optional[int] = None) -> int:
+    """
+    Mark background ingests that made no progress for INGEST_TIMEOUT_SECONDS as failed, and delete the units added so far.
+    This is done when the server starts and when the status of an ingest is requested. Returns the number of failed ingests
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(seconds=INGEST_TIMEOUT_SECONDS)
+    stale = (db.query(JobIngest.codingjob_id)
+             .filter(JobIngest.status.in_(['queued', 'running']), JobIngest.updated < cutoff))
+    if codingjob_id is not None:
+        stale = stale.filter(JobIngest.codingjob_id == codingjob_id)
+    n = 0
+    for row in stale.all():
+        # only one server process marks the ingest as failed, and an ingest that is still running stops at its next chunk
+        failed = (db.query(JobIngest)
+                  .filter(JobIngest.codingjob_id == row.codingjob_id, JobIngest.status.in_(['queued', 'running']), JobIngest.updated < cutoff)
+                  .update(dict(status='failed', error='The ingest was interrupted', finished=datetime.datetime.now()), synchronize_session=False))
+        db.commit()
+        if failed:
+            logging.warning(f'Background ingest of codingjob {row.codingjob_id} was interrupted')
+            crud_archive.delete_job_rows(db, db.query(CodingJob).filter(CodingJob.id == row.codingjob_id).one())
+            n += 1
+    return n
+
+
+def get_ingest(db: Session, codingjob_id: int) -> Optional[JobIngest]:
+    return db.query(JobIngest).filter(JobIngest.codingjob_id == codingjob_id).first()
+
+
+def is_archived(db: Session, codingjob_id: int) -> bool:
+    return db.query(CodingJob.id).filter(CodingJob.id == codingjob_id, CodingJob.archived == True).first() is not None
+
+
+def ingest_pending(db: Session, codingjob_id: int) -> bool:
+    """
+    Check whether a job is still being created in the background (or failed to be)
+    """
+    return db.query(JobIngest.codingjob_id).filter(JobIngest.codingjob_id == codingjob_id, JobIngest.status != 'done').first() is not None
+
+
+def clone_codingjob(db: Session, job: CodingJob, creator: User, title: Optional[str] = None, rules: Optional[dict] = None,
+                    authorization: Optional[dict] = None) -> CodingJob:
+    """
+    Create a new codingjob with the same units and jobsets (but no coders or annotations), and commit.
+    The units and jobsetunits are copied within the database with INSERT ... SELECT, so they are never loaded in Python,
+    and codebooks (stored by hash) are shared. If rules are given, they replace the rules of all jobsets.
+    If authorization is not given, the clone is restricted to the same coders as the original (if that is restricted).
+    """
+    if authorization is None:
+        authorization = {'restricted': job.restricted}
+        if job.restricted:
+            authorization['users'] = [u.name for u in get_job_coders(db, job.id)]
+    clone = new_codingjob(db, title or job.title, creator, authorization)
+    clone.provenance = dict(cloned_from=job.id)
+
+    # the ids of the copies are assigned up front, so that the jobsetunits can be mapped by the id of the original unit
+    unit_ids = _clone_unit_ids(db, job.id)
+    unit_columns = ['external_id', 'unit', 'codebook_hash', 'conditionals', 'unit_type', 'position']
+    units = (select(unit_ids.c.new_id, literal(clone.id), *[Unit.__table__.c[c] for c in unit_columns])
+             .join(unit_ids, unit_ids.c.old_id == Unit.id)
+             .where(Unit.codingjob_id == job.id))
+    db.execute(insert(Unit).from_select(['id', 'codingjob_id', *unit_columns], units))
+
+    for jobset in sorted(job.jobsets, key=lambda js: js.id):
+        db_jobset = JobSet(codingjob=clone, jobset=jobset.jobset, codebook=jobset.codebook, codebook_hash=jobset.codebook_hash,
+                           rules=rules if rules is not None else jobset.rules, debriefing=jobset.debriefing,
+                           weight=jobset.weight)
+        db.add(db_jobset)
+        db.flush()
+        jobset_units = (select(literal(clone.id), literal(db_jobset.id), unit_ids.c.new_id, JobSetUnit.fixed_index,
+                               JobSetUnit.unit_type, JobSetUnit.has_conditionals, literal(False))
+                        .select_from(JobSetUnit)
+                        .join(unit_ids, unit_ids.c.old_id == JobSetUnit.unit_id)
+                        .where(JobSetUnit.codingjob_id == job.id, JobSetUnit.jobset_id == jobset.id)
+                        .order_by(JobSetUnit.id))
+        db.execute(insert(JobSetUnit).from_select(
+            ['codingjob_id', 'jobset_id', 'unit_id', 'fixed_index', 'unit_type', 'has_conditionals', 'blocked'], jobset_units))
+
+    db.execute(text('DROP TABLE clone_unit_ids'))
+    set_job_coders(db, codingjob_id=clone.id, names=authorization.get('users', []), commit=False)
+    db.commit()
+    return clone
+
+
+def _clone_unit_ids(db: Session, codingjob_id: int):
+    """
+    Create the temporary table clone_unit_ids, with the ids of the units of a job (old_id) and new ids for their copies (new_id).
+    The table is dropped when the transaction is rolled back, otherwise the caller has to drop it.
+    """
+    db.execute(text('CREATE TEMPORARY TABLE clone_unit_ids (old_id INTEGER PRIMARY KEY, new_id INTEGER NOT NULL)'))
+    if db.get_bind().dialect.name == 'postgresql':
+        new_id = "nextval(pg_get_serial_sequence('unit', 'id'))"
+    else:
+        # SQLite has no sequences, so the ids follow the highest id that was ever used. The transaction already
+        # holds the write lock (the clone itself was inserted), so no other transaction can take these ids
+        has_sequence = db.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'")).first() is not None
+        last_id = db.execute(text('SELECT max(id) FROM unit')).scalar() or 0
+        if has_sequence:
+            last_id = max(last_id, db.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'unit'")).scalar() or 0)
+        new_id = f'{int(last_id)} + row_number() OVER (ORDER BY id)'
+    db.execute(text(f'INSERT INTO clone_unit_ids (old_id, new_id) SELECT id, {new_id} FROM unit WHERE codingjob_id = :codingjob_id'),
+               dict(codingjob_id=codingjob_id))
+    return table('clone_unit_ids', column('old_id'), column('new_id'))
+
+
+def delete_codingjob(db: Session, job: CodingJob) -> None:
+    """
+    Delete a codingjob, including its units, annotations, coders and archive
+    """
+    crud_archive.delete_job_rows(db, job)
+    crud_jobset.invalidate_job(job.id)
+    db.query(JobUser).filter(JobUser.codingjob_id == job.id).delete(synchronize_session=False)
+    db.query(JobSet).filter(JobSet.codingjob_id == job.id).delete(synchronize_session=False)
+    crud_archive.delete_archive(db, job.id)
+    db.query(JobIngest).filter(JobIngest.codingjob_id == job.id).delete(synchronize_session=False)
+    db.query(CodingJob).filter(CodingJob.id == job.id).delete(synchronize_session=False)
+    db.commit()
+
+
 def add_units(db: Session, job: CodingJob, units: List[dict]) -> None:
     unit_list = []
+    codebooks = {}
     for u in units:
         unit_type = u.get('type', 'code')
         if unit_type not in ['train', 'test', 'code', 'survey']:
@@ -46,8 +245,16 @@ def add_units(db: Session, job: CodingJob, units: List[dict]) -> None:
         if position not in ['pre', 'post', None]:
             raise HTTPException(status_code=400,
                                 detail='Invalid position ("{position}"). Has to be "pre", "post" or None'.format(position=position))
+        # unit specific codebooks are stored separately (once per distinct codebook), and referenced by hash
+        content, codebook_hash = u['unit'], None
+        if isinstance(content, dict) and content.get('codebook') is not None:
+            content = {k: v for k, v in content.items() if k != 'codebook'}
+            key = json.dumps(u['unit']['codebook'], sort_keys=True)
+            if key not in codebooks:
+                codebooks[key] = crud_codebook.store_codebook(db, u['unit']['codebook'])
+            codebook_hash = codebooks[key]
         unit_list.append(Unit(
-            codingjob_id=job.id, external_id=u['id'], unit=u['unit'], unit_type=unit_type, position=position, conditionals=u.get('conditionals')))
+            codingjob_id=job.id, external_id=u['id'], unit=content, codebook_hash=codebook_hash, unit_type=unit_type, position=position, conditionals=u.get('conditionals')))
 
     db.bulk_save_objects(unit_list)
     db.flush()
@@ -72,32 +279,121 @@ def add_jobsets(db: Session, job: CodingJob, jobsets: list, codebook: dict, rule
             jobset['rules'] = rules
         if 'debriefing' not in jobset:
             jobset['debriefing'] = debriefing
+        if not isinstance(jobset.get('weight', 1), (int, float)) or jobset.get('weight', 1) <= 0:
+            raise HTTPException(
+                status_code=400, detail='jobset weight must be a positive number')
     if len({s['name'] for s in jobsets}) < len(jobsets):
         raise HTTPException(
             status_code=400, detail='jobset items must have unique names')
 
+    units, conditional_units = job_units(db, job)
     for jobset in jobsets:
         db_jobset = JobSet(
-            codingjob=job, jobset=jobset['name'], codebook=jobset['codebook'], rules=jobset['rules'], debriefing=jobset['debriefing'])
+            codingjob=job, jobset=jobset['name'], codebook_hash=crud_codebook.store_codebook(db, jobset['codebook']), rules=jobset['rules'], debriefing=jobset['debriefing'],
+            weight=jobset.get('weight', 1))
         db.add(db_jobset)
         db.flush()
         db.refresh(db_jobset)
 
         unit_set = []
         for position in ['pre', None, 'post']:
-            for unit in prepare_unit_sets(db, jobset, position, job, db_jobset):
+            for unit in prepare_unit_sets(db, jobset, position, job, db_jobset, units, conditional_units):
                 unit_set.append(unit)
 
         db.bulk_save_objects(unit_set)
         db.flush()
 
 
-def prepare_unit_sets(db, jobset, position, job, db_jobset):
+def job_units(db: Session, job: CodingJob, external_ids: Optional[List[str]] = None) -> Tuple[dict, dict]:
+    """
+    Get the units of a job for creating jobsets, with a fixed number of queries: a dict of external id to (id, position)
+    for all units (in order of id), and a dict of id to Unit (including its content) for the units with conditionals.
+    If external_ids is given, only get the units with these ids.
+    """
+    query = db.query(Unit).filter(Unit.codingjob_id == job.id)
+    if external_ids is not None:
+        query = query.filter(Unit.external_id.in_(external_ids))
+    conditional_units = {u.id: u for u in query.options(undefer(Unit.unit)).filter(Unit.conditionals.isnot(None))}
+    units = {}
+    for id, external_id, position in query.with_entities(Unit.id, Unit.external_id, Unit.position).order_by(Unit.id):
+        # if multiple units have the same external id, use the first one. Ids in jobsets can also be given as numbers
+        units.setdefault(str(external_id), (id, position))
+    return units, conditional_units
+
+
+def append_units(db: Session, job: CodingJob, units: List[dict]) -> int:
+    """
+    Add units to an existing job, and commit. Units can have a "jobsets" key with the names of the jobsets they should
+    be added to, otherwise they are added to all jobsets.
+    Units with an id that the job already has are skipped, so that an interrupted upload can simply be repeated.
+    Pre units are added after the existing pre units, and post units after the existing post units (which are moved
+    forward). Returns the number of units that were added.
+    """
+    jobsets = (db.query(JobSet)
+                 .filter(JobSet.codingjob_id == job.id)
+                 .order_by(JobSet.id)
+                 .with_for_update()
+                 .all())
+    jobset_names = {str(js.jobset) for js in jobsets}
+    if not all(isinstance(u, dict) for u in units):
+        raise HTTPException(status_code=400, detail='Every unit must be an object')
+
+    new_units = []
+    existing = {external_id for external_id, in db.query(Unit.external_id).filter(Unit.codingjob_id == job.id, Unit.external_id.in_([str(u.get('id')) for u in units]))}
+    for u in units:
+        if 'id' not in u or 'unit' not in u:
+            raise HTTPException(status_code=400, detail='Every unit must have an id and unit')
+        if str(u['id']) in existing:
+            continue
+        unknown = {str(name) for name in u.get('jobsets') or []} - jobset_names
+        if len(unknown) > 0:
+            raise HTTPException(status_code=400, detail='Unit {id} has unknown jobsets ({jobsets})'.format(id=u['id'], jobsets=', '.join(unknown)))
+        existing.add(str(u['id']))
+        new_units.append(u)
+    if len(new_units) == 0:
+        db.commit()
+        return 0
+
+    add_units(db, job, new_units)
+    unit_ids, conditional_units = job_units(db, job, [str(u['id']) for u in new_units])
+
+    for db_jobset in jobsets:
+        jobset = {'name': db_jobset.jobset, 'codebook': crud_codebook.jobset_codebook(db, db_jobset)}
+        for position in ['pre', None, 'post']:
+            ids_key = 'ids' if position is None else position + '_ids'
+            jobset[ids_key] = [u['id'] for u in new_units if u.get('position') == position and
+                               (u.get('jobsets') is None or str(db_jobset.jobset) in {str(name) for name in u['jobsets']})]
+
+        # pre units have indices 0, 1, ..., and post units ..., -2, -1 (relative to the end)
+        jobset_units = db.query(JobSetUnit).filter(JobSetUnit.codingjob_id == job.id, JobSetUnit.jobset_id == db_jobset.id)
+        n_pre = jobset_units.filter(JobSetUnit.fixed_index >= 0).count()
+        n_post = len(jobset['post_ids'])
+        if n_post > 0:
+            (jobset_units.filter(JobSetUnit.fixed_index < 0)
+                .update({JobSetUnit.fixed_index: JobSetUnit.fixed_index - n_post}, synchronize_session=False))
+        if n_post > 0 or len(jobset['pre_ids']) > 0:
+            # the fixed indices are part of the cached jobset configuration (see crud_jobset)
+            db_jobset.version = JobSet.version + 1
+
+        unit_set = []
+        for position in ['pre', None, 'post']:
+            for unit in prepare_unit_sets(db, jobset, position, job, db_jobset, unit_ids, conditional_units):
+                if position == 'pre':
+                    unit.fixed_index += n_pre
+                unit_set.append(unit)
+        db.bulk_save_objects(unit_set)
+
+    db.commit()
+    return len(new_units)
+
+
+def prepare_unit_sets(db, jobset, position, job, db_jobset, units, conditional_units):
     """
     Units are organized in sets relating to positions.
     - pre: units shown at the start of a job. Typically survey/experiment questions.
     - None: units with no fixed positions. Position is based on ruleset
     - post: units shown at the end of a job
+    units and conditional_units are the dicts returned by job_units
     """
     if position is None:
         ids_key = 'ids'
@@ -105,11 +401,7 @@ def prepare_unit_sets(db, jobset, position, job, db_jobset):
         ids_key = position + '_ids'
     if ids_key not in jobset or jobset[ids_key] is None:
         # if no id set is specified, use all units of this type
-        units = (db.query(Unit.external_id)
-            .filter(Unit.codingjob_id == job.id, Unit.position == position)
-            .order_by(Unit.id)
-            .all())
-        ids = [u.external_id for u in units]
+        ids = [ext_id for ext_id, (id, unit_position) in units.items() if unit_position == position]
     else:
         ids = jobset[ids_key]
 
@@ -120,77 +412,122 @@ def prepare_unit_sets(db, jobset, position, job, db_jobset):
         if position == 'post':
             fixed_index = i - len(ids)
 
-        unit = db.query(Unit).filter(
-            Unit.codingjob_id == job.id, Unit.external_id == ext_id).first()
+        if str(ext_id) not in units:
+            raise HTTPException(status_code=400, detail='Jobset {name} has an unknown unit id ({id})'.format(name=jobset['name'], id=ext_id))
+        unit_id = units[str(ext_id)][0]
+        unit = conditional_units.get(unit_id)
 
         # If unit has conditionals, verify that they are possible given the codebook
-        try:
-            invalid_variables = invalid_conditionals(
-                unit, jobset['codebook'])
-        except Exception as e:
-            logging.error(e)
-            invalid_variables = ['unknown problem']
-        if len(invalid_variables) > 0:
-            raise HTTPException(
-                status_code=400, detail='A unit (id = {id}) has impossible conditionals ({invalid})'.format(id=ext_id, invalid=', '.join(invalid_variables)))
+        if unit is not None:
+            try:
+                codebook = jobset['codebook']
+                if unit.codebook_hash is not None:
+                    codebook = crud_codebook.get_codebook(db, unit.codebook_hash)
+                invalid_variables = invalid_conditionals(unit, codebook)
+            except Exception as e:
+                logging.error(e)
+                invalid_variables = ['unknown problem']
+            if len(invalid_variables) > 0:
+                raise HTTPException(
+                    status_code=400, detail='A unit (id = {id}) has impossible conditionals ({invalid})'.format(id=ext_id, invalid=', '.join(invalid_variables)))
 
-        yield JobSetUnit(jobset_id=db_jobset.id, unit_id=unit.id, fixed_index=fixed_index, has_conditionals=unit.conditionals is not None)
+        yield JobSetUnit(codingjob_id=job.id, jobset_id=db_jobset.id, unit_id=unit_id, fixed_index=fixed_index, has_conditionals=unit is not None)
 
 
 def get_job_coders(db, codingjob_id: int) -> Iterable[str]:
     return db.query(User).outerjoin(JobUser).filter(JobUser.codingjob_id == codingjob_id, JobUser.can_code == True)
 
 
-def set_job_coders(db: Session, codingjob_id: int, names: Iterable[str], only_add: bool = False) -> Iterable[str]:
+def set_job_coders(db: Session, codingjob_id: int, names: Iterable[str], only_add: bool = False, commit: bool = True) -> Iterable[str]:
     """
     Sets the users that can code the codingjob (if the codingjob is restricted).
     If only_add is True, the provided list of names is only added, and current users that are not in this list are kept.
     Returns an array with all users.
+    This is done with a fixed number of set based queries (regardless of the number of names), and a single commit.
     """
     if len(names) == 0:
         return []
     names = set(names)
-    existing_jobusers = get_job_coders(db, codingjob_id)
-    existing_names = set([ju.name for ju in existing_jobusers])
-
-    for name in names:
-        if name in existing_names:
-            continue
-        user = db.query(User).filter(User.name == name).first()
-        if not user:
-            user = User(name=name)
-            db.add(user)
-            db.commit()
-            db.refresh(user)
-
-        jobuser = db.query(JobUser).filter(
-            JobUser.user_id == user.id, JobUser.codingjob_id == codingjob_id).first()
-        if jobuser is None:
-            jobuser = JobUser(
-                user_id=user.id, codingjob_id=codingjob_id, can_code=True, can_edit=False)
-            db.add(jobuser)
-        else:
-            jobuser.can_code = True
-        db.commit()
-        db.refresh(jobuser)
+    existing_names = set(name for name, in get_job_coders(db, codingjob_id).with_entities(User.name))
+    new_names = names - existing_names
+
+    if len(new_names) > 0:
+        # If multiple users have the same name, use the first one
+        user_ids = {}
+        for batch in chunks(new_names, 1000):
+            for user_id, name in db.query(func.min(User.id), User.name).filter(User.name.in_(batch)).group_by(User.name):
+                user_ids[name] = user_id
+
+        missing = [name for name in new_names if name not in user_ids]
+        for batch in chunks(missing, 1000):
+            db.execute(insert(User).values([dict(name=name) for name in batch]))
+            for user_id, name in db.query(func.min(User.id), User.name).filter(User.name.in_(batch)).group_by(User.name):
+                user_ids[name] = user_id
+
+        for batch in chunks(list(user_ids.values()), 1000):
+            jobusers = [dict(user_id=user_id, codingjob_id=codingjob_id, can_code=True, can_edit=False) for user_id in batch]
+            db.execute(dialect_insert(db, JobUser).values(jobusers)
+                       .on_conflict_do_update(index_elements=['user_id', 'codingjob_id'], set_=dict(can_code=True)))
 
     if only_add:
         names = names.union(existing_names)
     else:
-        rm_names = existing_names - names
-        for rm_name in rm_names:
-            user = db.query(User).filter(User.name == rm_name).first()
-            jobuser = db.query(JobUser).filter(
-                JobUser.user_id == user.id, JobUser.codingjob_id == codingjob_id).first()
-            if jobuser is not None:
-                jobuser.can_code = False
+        coders = (db.query(JobUser.id, User.name).join(User, User.id == JobUser.user_id)
+                    .filter(JobUser.codingjob_id == codingjob_id, JobUser.can_code == True))
+        rm_jobuser_ids = [jobuser_id for jobuser_id, name in coders if name not in names]
+        for batch in chunks(rm_jobuser_ids, 1000):
+            (db.query(JobUser)
+               .filter(JobUser.id.in_(batch))
+               .update({JobUser.can_code: False}, synchronize_session=False))
+
+    if commit:
         db.commit()
-
     return list(names)
 
 
 def get_units(db: Session, codingjob_id: int) -> Iterable[Unit]:
-    return db.query(Unit).filter(Unit.codingjob_id == codingjob_id).order_by(Unit.id)
+    return db.query(Unit).options(undefer(Unit.unit)).filter(Unit.codingjob_id == codingjob_id).order_by(Unit.id)
+
+
+def get_units_page(db: Session, codingjob_id: int, after: int = 0, n: Optional[int] = None) -> List[Unit]:
+    """
+    Get units by keyset pagination: the first n units with an id higher than after.
+    For jobs in cold storage, the units are read from the archive.
+    """
+    archive = crud_archive.get_archive(db, codingjob_id)
+    if archive is not None:
+        return list(islice(crud_archive.archived_units(db, archive, after), n))
+    units = get_units(db, codingjob_id).filter(Unit.id > after)
+    if n is not None:
+        units = units.limit(n)
+    return units.all()
+
+
+def iter_units(db: Session, codingjob_id: int, batch_size: int = 1000) -> Iterable[Unit]:
+    """
+    Iterate over all units of a job, fetching them in batches so that memory use doesn't depend on the job size
+    """
+    archive = crud_archive.get_archive(db, codingjob_id)
+    if archive is not None:
+        yield from crud_archive.archived_units(db, archive)
+        return
+    after = 0
+    while True:
+        units = get_units_page(db, codingjob_id, after, batch_size)
+        yield from units
+        if len(units) < batch_size:
+            return
+        after = units[-1].id
+
+
+def unit_dict(db: Session, unit: Unit) -> dict:
+    return {"id": unit.id, "codingjob_id": unit.codingjob_id, "external_id": unit.external_id, "unit": crud_codebook.unit_content(db, unit),
+            "conditionals": unit.conditionals, "unit_type": unit.unit_type, "position": unit.position}
+
+
+def jobset_dict(db: Session, jobset: JobSet) -> dict:
+    return {"id": jobset.id, "codingjob_id": jobset.codingjob_id, "jobset": jobset.jobset, "codebook": crud_codebook.jobset_codebook(db, jobset),
+            "rules": jobset.rules, "debriefing": jobset.debriefing}
 
 
 def get_jobs(db: Session) -> list:
@@ -204,26 +541,89 @@ def get_jobs(db: Session) -> list:
     return data
 
 
-def get_annotations(db: Session, job_id: int):
-    ann_unit_coder = (db.query(Annotation, Unit, User, JobSet).join(Unit)
-                     .join(User)
-                     .join(JobSet)
-                     .filter(Unit.codingjob_id == job_id)
-                     .order_by(Annotation.id)
-                     .all())
-    for annotation, unit, user, jobset in ann_unit_coder:
-        yield {"jobset": jobset.jobset, "unit_id": unit.external_id, "coder_id": user.id, "coder": user.name, "annotation": annotation.annotation, "status": annotation.status}
+def count_jobset_units(db: Session, codingjob_id: int) -> dict:
+    """
+    Count the units of every jobset of a job (in a single query)
+    """
+    return dict(db.query(JobSetUnit.jobset_id, func.count(JobSetUnit.id))
+                  .filter(JobSetUnit.codingjob_id == codingjob_id)
+                  .group_by(JobSetUnit.jobset_id))
 
 
-def get_unit(db: Session, jobuser: JobUser, index: Optional[int]): 
-    
+def get_job_progress(db: Session, codingjob_id: int) -> dict:
+    """
+    Count the units, and the annotations per status, of every jobset of a job
+    """
+    n_units = count_jobset_units(db, codingjob_id)
+    jobsets = {js.id: {'name': js.jobset, 'n_units': n_units.get(js.id, 0)} for js in db.query(JobSet.id, JobSet.jobset).filter(JobSet.codingjob_id == codingjob_id)}
+    n_annotations = (db.query(Annotation.jobset_id, Annotation.status, func.count(Annotation.id))
+                       .filter(Annotation.codingjob_id == codingjob_id)
+                       .group_by(Annotation.jobset_id, Annotation.status))
+    for jobset_id, status, n in n_annotations:
+        jobsets[jobset_id][status] = n
+    return {'jobsets': {str(id): counts for id, counts in jobsets.items()}}
+
+
+def get_annotations(db: Session, job_id: int, after: int = 0, n: Optional[int] = None):
+    """
+    Get the annotations of a job. Can be paginated with after (the last seen annotation id) and n
+    """
+    archive = crud_archive.get_archive(db, job_id)
+    if archive is not None:
+        yield from islice(crud_archive.archived_annotations(db, archive, after), n)
+        return
+    ann_unit_coder = (db.query(Annotation, Unit.external_id, User.id, User.name, JobSet.jobset)
+                     .join(Unit, Annotation.unit_id == Unit.id)
+                     .join(User, Annotation.coder_id == User.id)
+                     .join(JobSet, Annotation.jobset_id == JobSet.id)
+                     .filter(Annotation.codingjob_id == job_id, Annotation.id > after)
+                     .order_by(Annotation.id))
+    if n is not None:
+        ann_unit_coder = ann_unit_coder.limit(n)
+    for annotation, unit_id, coder_id, coder, jobset in ann_unit_coder.all():
+        yield {"id": annotation.id, "jobset": jobset, "unit_id": unit_id, "coder_id": coder_id, "coder": coder,
+               "annotation": annotation.annotation, "status": annotation.status}
+
+
+def iter_annotations(db: Session, job_id: int, batch_size: int = 1000):
+    """
+    Iterate over all annotations of a job, fetching them in batches
+    """
+    archive = crud_archive.get_archive(db, job_id)
+    if archive is not None:
+        yield from crud_archive.archived_annotations(db, archive, batch_size=batch_size)
+        return
+    after = 0
+    while True:
+        annotations = list(get_annotations(db, job_id, after, batch_size))
+        yield from annotations
+        if len(annotations) < batch_size:
+            return
+        after = annotations[-1]['id']
+
+
+# the writes of coders, that are executed in group commits (see writer.py)
+INSERT_ANNOTATION = insert(Annotation.__table__)
+# annotations of archived jobs are not updated. The job is locked (FOR KEY SHARE), so that archive_job waits for
+# updates that saw the job before it was archived (see crud_archive.archive_job)
+UPDATE_ANNOTATION = (update(Annotation.__table__)
+                     .where(Annotation.__table__.c.codingjob_id == bindparam('b_codingjob_id'), Annotation.__table__.c.id == bindparam('b_id'),
+                            exists(select(CodingJob.__table__.c.id)
+                                   .where(CodingJob.__table__.c.id == bindparam('b_codingjob_id'), CodingJob.__table__.c.archived.isnot(True))
+                                   .with_for_update(read=True, key_share=True))))
+
+
+def get_unit(db: Session, jobuser: JobUser, index: Optional[int], codebook_ref: bool = False):
+    """
+    Serve a unit to a coder. If codebook_ref is True, a unit specific codebook is referenced by its hash instead of included
+    """
     u, index = unitserver.serve_unit(db, jobuser, index=index)
     if u is None:
         if index is None:
             raise HTTPException(status_code=404)
         else:
             return {'index': index}
-    unit = {'id': u.id, 'unit': u.unit, 'index': index}
+    unit = {'id': u.id, 'unit': crud_codebook.unit_content(db, u, codebook_ref), 'index': index}
 
     a = get_unit_annotation(db, jobuser.codingjob_id, u.id, jobuser.user_id)
     if a:
@@ -242,10 +642,10 @@ def get_unit(db: Session, jobuser: JobUser, index: Optional[int]):
         # same units (because they wouldn't be annotated yet). Note that it doesn't matter that
         # much if the coder then doesn't actually finish the unit, as long as rules for blocking
         # units that have enough annotations/agreement look only at completed units
-        ann = Annotation(unit_id=u.id, codingjob_id=jobuser.codingjob_id, coder_id=jobuser.user_id, annotation=[], jobset_id=jobuser.jobset_id,
-                         status='IN_PROGRESS', damage=0, unit_index=index)
-        db.add(ann)
-        db.commit()
+        values = dict(unit_id=u.id, codingjob_id=jobuser.codingjob_id, coder_id=jobuser.user_id, annotation=[], jobset_id=jobuser.jobset_id,
+                      status='IN_PROGRESS', damage=0, unit_index=index)
+        writer.execute(db, INSERT_ANNOTATION, values)
+        events.bus.publish(values['codingjob_id'], values['jobset_id'], None, 'IN_PROGRESS')
 
     return unit
 
@@ -263,14 +663,12 @@ def set_annotation(db: Session, ann: Annotation, coder: User, annotation: list,
         raise HTTPException(status_code=400, detail={
                             "error": "Status has to be 'DONE' or 'IN_PROGRESS'"})
 
-    # update annotation
-    ann.annotation = annotation
-    ann.modified = datetime.datetime.now()
-    ann.status = status
-        
+    old_status = ann.status
     report = {"damage": {}, "evaluation": {}}
-    if ann.unit.conditionals is not None:       
-        damage, evaluation = check_conditionals(ann.unit, annotation)
+    damage_changed = False
+    unit = crud_unit.load_unit(db, ann.unit_id)
+    if unit.conditionals is not None:       
+        damage, evaluation = check_conditionals(unit, annotation)
 
         report['evaluation'] = evaluation
         # force a status based on conditionals results. Also, store certain reports actions
@@ -283,12 +681,11 @@ def set_annotation(db: Session, ann: Annotation, coder: User, annotation: list,
                 # not implemented. could block entire job? could be usefull for screening (e.g., minimum age).
                 status = 'RETRY'
                 None
-        ann.status = status
 
         # If damage changed, process the JobUser's total damage
         if ann.damage != damage:
             jobuser = get_jobuser(db, coder, ann.codingjob_id)
-            jobset = jobuser.jobset
+            jobset = crud_jobset.get_config(db, jobuser.jobset)
             if not jobset.rules.get('heal_damage', False):
                 # the heal_damage rule determines whether damage can be healed if an annotator changes the annotation
                 damage = max(ann.damage, damage)
@@ -296,8 +693,23 @@ def set_annotation(db: Session, ann: Annotation, coder: User, annotation: list,
             db.flush()
             total_damage = update_damage(db, jobuser, jobset.id, coder.id)
             report['damage'] = create_damage_report(damage, total_damage, jobset.rules)
-   
-    db.commit()
+            damage_changed = True
+
+    codingjob_id, jobset_id, unit_id = ann.codingjob_id, ann.jobset_id, ann.unit_id
+    params = dict(b_codingjob_id=codingjob_id, b_id=ann.id, annotation=annotation, modified=datetime.datetime.now(), status=status)
+    # a changed damage has to be committed together with the annotation, so then it can't be part of a group commit
+    group = not damage_changed
+    jobset = crud_jobset.get_config(db, db.query(JobSet).filter(JobSet.id == jobset_id).first()) if status == 'DONE' else None
+    if jobset is not None and saturation_rules(jobset.rules):
+        # If the unit is completed, check whether it is now saturated (given the jobset rules),
+        # so that it is no longer served to new coders
+        def save(session):
+            session.execute(UPDATE_ANNOTATION, params)
+            update_saturation(session, jobset, unit_id)
+        writer.write(db, save, group=group)
+    else:
+        writer.execute(db, UPDATE_ANNOTATION, params, group=group)
+    events.bus.publish(codingjob_id, jobset_id, old_status, status)
  
     return report
 
@@ -307,7 +719,7 @@ def update_damage(db: Session, jobuser: JobUser, jobset_id: int, coder_id: int):
     if job.rules has max_damage, also check total damage to determine if coder has to be disqualified from job.
     """
     total_damage = (db.query(func.sum(Annotation.damage))
-                      .filter(Annotation.jobset_id == jobset_id, 
+                      .filter(Annotation.codingjob_id == jobuser.codingjob_id, Annotation.jobset_id == jobset_id,
                               Annotation.coder_id == coder_id).scalar())
     if total_damage is None:
         total_damage = 0
@@ -337,32 +749,64 @@ def create_damage_report(damage: float, total_damage: float, rules: dict):
 
     return damage_report
 
-def get_jobuser(db: Session, user: User, job_id: int) -> Tuple[JobSet, JobUser]:
-    jobuser = db.query(JobUser).filter(JobUser.codingjob_id ==
-                                       job_id, JobUser.user_id == user.id).first()
-    if jobuser is not None:
+def get_jobuser(db: Session, user: User, job_id: int) -> JobUser:
+    jobuser, archived = (db.query(JobUser, CodingJob.archived).join(CodingJob, CodingJob.id == JobUser.codingjob_id)
+                         .filter(JobUser.codingjob_id == job_id, JobUser.user_id == user.id).first()) or (None, False)
+    if archived:
+        raise HTTPException(status_code=404, detail="This codingjob is archived")
+    if jobuser is not None and jobuser.jobset_id is not None:
         return jobuser
     
-    # If user is not yet a jobuser, check if allowed to be
-    if user.restricted_job is not None and user.restricted_job != job_id:
-        raise HTTPException(status_code=401, detail="User is only allowed to code job {restricted_job}".format(restricted_job=user.restricted_job))
-    job = db.query(CodingJob).filter(CodingJob.id == job_id).first()
-    if job.restricted:
-        raise HTTPException(status_code=401, detail="This is a restricted codingjob, and this coder doesn't have access")
-
-    # if user is allowed, pick a jobset
-    jobsets = db.query(JobSet).filter(JobSet.codingjob_id == job_id).order_by(JobSet.id)
-    n_jobsets = jobsets.count()
-    if n_jobsets == 1:
-        jobset = jobsets[0]
-    else:
-        # better to look for the jobset with least coders!!
-        current_users = db.query(JobUser).filter(
-            JobUser.codingjob_id == job_id).count()
-        next_jobset_index = current_users % n_jobsets
-        jobset = jobsets[next_jobset_index]
+    # If user is not yet a jobuser, check if allowed to be. (Users added with set_job_coders are 
+    # already jobusers, but are only assigned a jobset when they first open the job)
+    if jobuser is None:
+        if user.restricted_job is not None and user.restricted_job != job_id:
+            raise HTTPException(status_code=401, detail="User is only allowed to code job {restricted_job}".format(restricted_job=user.restricted_job))
+        job = db.query(CodingJob).filter(CodingJob.id == job_id).first()
+        if job is None:
+            raise HTTPException(status_code=404)
+        if job.archived:
+            raise HTTPException(status_code=404, detail="This codingjob is archived")
+        if job.restricted:
+            raise HTTPException(status_code=401, detail="This is a restricted codingjob, and this coder doesn't have access")
+    if ingest_pending(db, job_id):
+        raise HTTPException(status_code=404, detail="This codingjob is not available yet")
+
+    return assign_jobset(db, user, job_id)
+
+
+def assign_jobset(db: Session, user: User, job_id: int) -> JobUser:
+    """
+    Assign a user to the jobset with the least coders (that can code) relative to its weight.
+    The jobsets of the job are locked while assigning, so that simultaneous new coders are
+    spread evenly, and a user that opens a job in multiple requests at once is only assigned once.
+    """
+    if db.get_bind().dialect.name == 'sqlite':
+        # SQLite ignores FOR UPDATE, so instead take the write lock of the database before reading
+        db.commit()
+        db.connection().exec_driver_sql('BEGIN IMMEDIATE')
+    jobsets = (db.query(JobSet.id, JobSet.weight)
+                 .filter(JobSet.codingjob_id == job_id)
+                 .order_by(JobSet.id)
+                 .with_for_update()
+                 .all())
+    if len(jobsets) == 0:
+        raise HTTPException(status_code=404, detail="Codingjob has no jobsets")
+
+    # another request might have assigned this user while we waited for the lock
+    jobuser = (db.query(JobUser)
+                 .filter(JobUser.codingjob_id == job_id, JobUser.user_id == user.id)
+                 .populate_existing()
+                 .first())
+    if jobuser is not None and jobuser.jobset_id is not None:
+        db.commit()
+        return jobuser
+
+    n_coders = dict(db.query(JobUser.jobset_id, func.count(JobUser.id))
+                      .filter(JobUser.codingjob_id == job_id, JobUser.jobset_id != None, JobUser.can_code == True)
+                      .group_by(JobUser.jobset_id))
+    jobset = min(jobsets, key=lambda js: (n_coders.get(js.id, 0) / (js.weight or 1), js.id))
 
-    # assign jobset to user
     if jobuser is None:
         jobuser = JobUser(user_id=user.id, codingjob_id=job_id, jobset_id=jobset.id)
         db.add(jobuser)
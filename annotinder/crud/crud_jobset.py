@@ -0,0 +1,97 @@
+import json
+import os
+from typing import Dict, NamedTuple, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+
+from annotinder.cache import LRUCache
+from annotinder.crud import crud_codebook
+from annotinder.models import Annotation, JobSet, JobSetUnit
+
+load_dotenv()
+
+
+class JobSetConfig(NamedTuple):
+    """
+    The decoded configuration of a jobset (version is JobSet.version when it was read)
+    """
+    id: int
+    codingjob_id: int
+    version: int
+    rules: dict
+    codebook_hash: Optional[str]
+    codebook: Optional[dict]  # only for jobsets created before codebooks were stored by hash
+    debriefing: Optional[dict]
+    # the units with a fixed index, by index. Pre units have indices 0, 1, ..., post units ..., -2, -1 (relative to the end)
+    pre_units: Dict[int, int]
+    post_units: Dict[int, int]
+
+
+def _sizeof(config: JobSetConfig) -> int:
+    return (200 + len(json.dumps(config.rules)) + len(json.dumps(config.codebook)) + len(json.dumps(config.debriefing))
+            + 100 * (len(config.pre_units) + len(config.post_units)))
+
+
+cache = LRUCache('jobsets', int(os.getenv('JOBSET_CACHE_BYTES', 16 * 1024 * 1024)), _sizeof)
+
+
+def get_config(db: Session, jobset: JobSet) -> JobSetConfig:
+    """
+    Get the configuration of a jobset. The configuration columns of JobSet are deferred, so this
+    only reads and decodes them if the cached configuration is missing or has an older version.
+    Changing which units have a fixed index (see crud_codingjob.append_units) also increments the version.
+    """
+    config = cache.get(jobset.id)
+    # (SQLite databases created before jobset ids were never reused can reuse the id of a deleted jobset in a new job)
+    if config is None or config.version != jobset.version or config.codingjob_id != jobset.codingjob_id:
+        rules, codebook, debriefing = (db.query(JobSet.rules, JobSet.codebook, JobSet.debriefing)
+                                       .filter(JobSet.id == jobset.id).one())
+        fixed_units = (db.query(JobSetUnit.fixed_index, JobSetUnit.unit_id)
+                       .filter(JobSetUnit.codingjob_id == jobset.codingjob_id, JobSetUnit.jobset_id == jobset.id,
+                               JobSetUnit.fixed_index != None)
+                       .all())
+        config = JobSetConfig(jobset.id, jobset.codingjob_id, jobset.version, rules, jobset.codebook_hash, codebook, debriefing,
+                              pre_units={i: unit_id for i, unit_id in fixed_units if i >= 0},
+                              post_units={i: unit_id for i, unit_id in fixed_units if i < 0})
+        cache.put(jobset.id, config)
+    return config
+
+
+def get_codebook(db: Session, config: JobSetConfig) -> dict:
+    if config.codebook_hash is None:
+        return config.codebook
+    return crud_codebook.get_codebook(db, config.codebook_hash)
+
+
+def update_jobset(db: Session, jobset: JobSet, rules: Optional[dict] = None, codebook: Optional[dict] = None,
+                  debriefing: Optional[dict] = None) -> JobSet:
+    """
+    Change the rules, codebook or debriefing of a jobset. This increments the version of the jobset,
+    so that the cached configuration is replaced in every server process.
+    The ruleset cannot be changed once coders have started, because the rulesets order the units differently,
+    so the units that coders already coded would no longer match their position (unit_index).
+    """
+    if rules is not None:
+        if rules.get('ruleset') not in ['crowdcoding', 'fixedset']:
+            raise HTTPException(status_code=400, detail='rules.ruleset has to be "crowdcoding" or "fixedset"')
+        started = (db.query(Annotation.id)
+                   .filter(Annotation.codingjob_id == jobset.codingjob_id, Annotation.jobset_id == jobset.id).first() is not None)
+        if started and rules['ruleset'] != jobset.rules.get('ruleset'):
+            raise HTTPException(status_code=400, detail='The ruleset cannot be changed after coders have started')
+        jobset.rules = rules
+    if codebook is not None:
+        jobset.codebook_hash = crud_codebook.store_codebook(db, codebook)
+        jobset.codebook = None
+    if debriefing is not None:
+        jobset.debriefing = debriefing
+    jobset.version = JobSet.version + 1
+    db.commit()
+    db.refresh(jobset)
+    cache.invalidate(lambda jobset_id, config: jobset_id == jobset.id)
+    return jobset
+
+
+def invalidate_job(codingjob_id: int) -> None:
+    cache.invalidate(lambda jobset_id, config: config.codingjob_id == codingjob_id)
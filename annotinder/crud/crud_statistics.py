@@ -0,0 +1,144 @@
+import os
+import statistics
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import case, extract, func, null, select
+from sqlalchemy.orm import Session
+
+from annotinder.models import Annotation, CodingJob, JobSet, User
+from annotinder.crud import crud_codingjob
+
+load_dotenv()
+
+# statistics are recomputed at most once per STATISTICS_CACHE_SECONDS. Only the coders that made changes since the
+# previous refresh are recomputed, except every STATISTICS_FULL_REFRESH_SECONDS, when everything is recomputed
+STATISTICS_CACHE_SECONDS = float(os.getenv('STATISTICS_CACHE_SECONDS', 10))
+STATISTICS_FULL_REFRESH_SECONDS = float(os.getenv('STATISTICS_FULL_REFRESH_SECONDS', 600))
+# annotations modified up to this long before the latest modification are also considered new, because
+# annotations are not necessarily committed in the order of their timestamps
+WATERMARK_MARGIN = timedelta(seconds=60)
+
+
+class JobStatistics:
+    def __init__(self):
+        self.coders = {}  # (jobset_id, coder_id) -> coder statistics
+        self.watermark = None  # the latest modified timestamp of the annotations
+        self.refreshed = 0
+        self.fully_refreshed = 0
+        # concurrent requests for the same job refresh the statistics one at a time
+        self.lock = threading.Lock()
+
+
+class StatisticsCache:
+    """
+    Least recently used cache of the statistics of max_size codingjobs
+    """
+
+    def __init__(self, max_size: int = 64):
+        self.max_size = max_size
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, codingjob_id: int) -> JobStatistics:
+        with self.lock:
+            stats = self.jobs.get(codingjob_id)
+            if stats is None:
+                stats = self.jobs[codingjob_id] = JobStatistics()
+            self.jobs.move_to_end(codingjob_id)
+            while len(self.jobs) > self.max_size:
+                self.jobs.popitem(last=False)
+            return stats
+
+    def invalidate(self, codingjob_id: int) -> None:
+        with self.lock:
+            self.jobs.pop(codingjob_id, None)
+
+
+cache = StatisticsCache(int(os.getenv('STATISTICS_CACHE_SIZE', 64)))
+
+
+def _seconds_between(db: Session, later, earlier):
+    if db.get_bind().dialect.name == 'sqlite':
+        return (func.julianday(later) - func.julianday(earlier)) * 86400
+    return extract('epoch', later - earlier)
+
+
+def coder_statistics(db: Session, codingjob_id: int, since=None) -> dict:
+    """
+    Compute the statistics per jobset and coder in a single grouped query: the number of started, done and retry units,
+    the total damage, and the median number of seconds per unit (the time between finishing a unit and finishing
+    the previous one). If since is given, only get the coders that modified annotations after this timestamp.
+    """
+    in_progress = Annotation.status == 'IN_PROGRESS'
+    previous = func.lag(Annotation.modified).over(partition_by=(Annotation.jobset_id, Annotation.coder_id, in_progress),
+                                                  order_by=Annotation.modified)
+    seconds = case((in_progress, null()), else_=_seconds_between(db, Annotation.modified, previous))
+    annotations = (select(Annotation.jobset_id, Annotation.coder_id, Annotation.status, Annotation.damage, seconds.label('seconds'))
+                   .where(Annotation.codingjob_id == codingjob_id))
+    if since is not None:
+        changed = select(Annotation.coder_id).where(Annotation.codingjob_id == codingjob_id, Annotation.modified >= since)
+        annotations = annotations.where(Annotation.coder_id.in_(changed))
+    a = annotations.subquery()
+
+    postgres = db.get_bind().dialect.name == 'postgresql'
+    # SQLite has no median, so there we get all times and compute it here
+    median = func.percentile_cont(0.5).within_group(a.c.seconds) if postgres else func.group_concat(a.c.seconds)
+    query = (select(a.c.jobset_id, a.c.coder_id, User.name, func.count(), func.sum(case((a.c.status == 'DONE', 1), else_=0)),
+                    func.sum(case((a.c.status == 'RETRY', 1), else_=0)), func.coalesce(func.sum(a.c.damage), 0), median)
+             .join(User, User.id == a.c.coder_id)
+             .group_by(a.c.jobset_id, a.c.coder_id, User.name))
+
+    coders = {}
+    for jobset_id, coder_id, name, started, done, retry, damage, median_seconds in db.execute(query):
+        if not postgres:
+            times = [float(s) for s in median_seconds.split(',')] if median_seconds else []
+            median_seconds = statistics.median(times) if times else None
+        coders[(jobset_id, coder_id)] = dict(coder_id=coder_id, coder=name, jobset_id=jobset_id, started=started, done=done,
+                                             retry=retry, damage=damage, median_seconds=median_seconds)
+    return coders
+
+
+def refresh(db: Session, codingjob_id: int, stats: JobStatistics) -> None:
+    """
+    Update the statistics of a job. Call this while holding stats.lock
+    """
+    now = time.monotonic()
+    watermark, n_annotations = (db.query(func.max(Annotation.modified), func.count())
+                                .filter(Annotation.codingjob_id == codingjob_id).one())
+    full = stats.watermark is None or now - stats.fully_refreshed >= STATISTICS_FULL_REFRESH_SECONDS
+    if not full and watermark is not None and watermark > stats.watermark - WATERMARK_MARGIN:
+        stats.coders = {**stats.coders, **coder_statistics(db, codingjob_id, since=stats.watermark - WATERMARK_MARGIN)}
+    # deleted annotations are not found by the incremental update, but then the number of annotations doesn't add up
+    if full or sum(c['started'] for c in stats.coders.values()) != n_annotations:
+        stats.coders = coder_statistics(db, codingjob_id)
+        stats.fully_refreshed = now
+    if watermark is not None:
+        stats.watermark = watermark
+    stats.refreshed = now
+
+
+def get_statistics(db: Session, job: CodingJob) -> dict:
+    """
+    Get the statistics of a codingjob per jobset and per coder. Totals per jobset are computed from the coder
+    statistics, and the median_seconds of a jobset is the median of the median_seconds of its coders.
+    """
+    stats = cache.get(job.id)
+    with stats.lock:
+        if time.monotonic() - stats.refreshed >= STATISTICS_CACHE_SECONDS:
+            refresh(db, job.id, stats)
+        coders = sorted(stats.coders.values(), key=lambda c: (c['jobset_id'], c['coder_id']))
+
+    n_units = crud_codingjob.count_jobset_units(db, job.id)
+    jobsets = []
+    for jobset_id, name in db.query(JobSet.id, JobSet.jobset).filter(JobSet.codingjob_id == job.id).order_by(JobSet.id):
+        jobset_coders = [c for c in coders if c['jobset_id'] == jobset_id]
+        medians = [c['median_seconds'] for c in jobset_coders if c['median_seconds'] is not None]
+        jobsets.append(dict(id=jobset_id, name=name, n_units=n_units.get(jobset_id, 0), n_coders=len(jobset_coders),
+                            **{key: sum(c[key] for c in jobset_coders) for key in ['started', 'done', 'retry', 'damage']},
+                            median_seconds=statistics.median(medians) if medians else None))
+    return dict(jobsets=jobsets, coders=coders)
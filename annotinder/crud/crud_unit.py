@@ -0,0 +1,53 @@
+import json
+import os
+from typing import NamedTuple, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy.orm import Session, undefer
+
+from annotinder.cache import LRUCache
+from annotinder.models import Unit
+
+load_dotenv()
+
+
+class CachedUnit(NamedTuple):
+    """
+    A read-only copy of a Unit row, with its content decoded. Units never change once they are added to a job,
+    so they can be shared between requests.
+    """
+    id: int
+    codingjob_id: int
+    external_id: str
+    unit: Optional[dict]
+    codebook_hash: Optional[str]
+    conditionals: Optional[list]
+    unit_type: str
+    position: Optional[str]
+
+
+def _sizeof(unit: CachedUnit) -> int:
+    # the decoded unit takes more memory than its JSON, but it's a good enough estimate to bound the cache size
+    return 200 + len(json.dumps(unit.unit)) + len(json.dumps(unit.conditionals))
+
+
+cache = LRUCache('units', int(os.getenv('UNIT_CACHE_BYTES', 64 * 1024 * 1024)), _sizeof)
+
+
+def load_unit(db: Session, unit_id: int) -> Optional[CachedUnit]:
+    """
+    Get a unit by id, from the cache if possible
+    """
+    unit = cache.get(unit_id)
+    if unit is None:
+        row = db.query(Unit).options(undefer(Unit.unit)).filter(Unit.id == unit_id).first()
+        if row is None:
+            return None
+        unit = CachedUnit(row.id, row.codingjob_id, row.external_id, row.unit, row.codebook_hash, row.conditionals,
+                          row.unit_type, row.position)
+        cache.put(unit_id, unit)
+    return unit
+
+
+def invalidate_job(codingjob_id: int) -> None:
+    cache.invalidate(lambda unit_id, unit: unit.codingjob_id == codingjob_id)
@@ -1,15 +1,16 @@
 import logging
-from typing import Optional
+from typing import List, Optional
 from email_validator import validate_email, EmailNotValidError
 
 from fastapi import HTTPException, status
 
-from sqlalchemy import func
+from sqlalchemy import func, or_, insert
 from sqlalchemy.orm import Session
 
-from annotinder.models import User, CodingJob, JobSet, JobUser
+from annotinder.models import User, CodingJob, JobSet, JobUser, JobIngest
 from annotinder import auth
 from annotinder import unitserver
+from annotinder.utils import chunks, estimate_count
 
 def safe_email(email: str):
     try:
@@ -70,6 +71,58 @@ def register_user(db: Session, username: str, email: str, password: Optional[str
     return db_user
 
 
+def register_users(db: Session, users: List[dict]) -> List[dict]:
+    """
+    Register many users at once. users is a list of dictionaries with the keys name, email, and optionally password and admin.
+    Existing accounts are looked up in one query, passwords are hashed concurrently, and all new users are inserted
+    in a single transaction. Returns a list with the result for every user, in the same order, where status
+    is "created", "exists", "duplicate" (same email occurs earlier in the list) or "invalid".
+    """
+    results = []
+    new = {}
+    for user in users:
+        result = dict(name=user.get('name'), email=user.get('email'))
+        results.append(result)
+        if not user.get('name') or not user.get('email'):
+            result.update(status='invalid', detail='User needs a name and email address')
+            continue
+        try:
+            email = validate_email(user['email']).email
+        except EmailNotValidError:
+            result.update(status='invalid', detail='{email} is not a valid email address'.format(email=user['email']))
+            continue
+        if email in new:
+            result.update(status='duplicate', email=email)
+            continue
+        result['email'] = email
+        new[email] = user
+
+    existing = {}
+    for batch in chunks(list(new), 1000):
+        for u in db.query(User.id, User.email).filter(User.email.in_(batch)):
+            existing[u.email] = u.id
+            new.pop(u.email)
+
+    hpasswords = auth.hash_passwords([user.get('password') for user in new.values()])
+    rows = [dict(name=user['name'], email=email, is_admin=bool(user.get('admin', False)), password=hpassword)
+            for (email, user), hpassword in zip(new.items(), hpasswords)]
+    user_ids = {}
+    for batch in chunks(rows, 1000):
+        db.execute(insert(User).values(batch))
+        for u in db.query(User.id, User.email).filter(User.email.in_([row['email'] for row in batch])):
+            user_ids[u.email] = u.id
+    db.commit()
+
+    for result in results:
+        if 'status' in result:
+            continue
+        if result['email'] in existing:
+            result.update(status='exists', id=existing[result['email']])
+        else:
+            result.update(status='created', id=user_ids[result['email']])
+    return results
+
+
 def get_user(db: Session, user_id: int) -> User:
     u = db.query(User).filter(User.id == user_id).first()
     if u is None:
@@ -97,17 +150,34 @@ def change_password(db: Session, email: str, password: str):
         db.commit()
 
 
-def get_users(db: Session, offset: int, n: int) -> list:
+def get_users(db: Session, offset: Optional[int] = None, n: Optional[int] = None, after: Optional[int] = None,
+              search: Optional[str] = None, approximate_total: bool = False) -> dict:
     """
-    Retrieve list of registered users (only to be used in admin endpoints)
+    Retrieve list of registered users (only to be used in admin endpoints).
+    Users are ordered by id, and can be paginated with after (the last seen user id, preferred for large tables) or offset.
+    search filters on users whose name or email starts with the given string.
+    If approximate_total is True, the total is estimated by the query planner instead of counted (only for PostgreSQL).
     """
-    users = db.query(User).filter(User.restricted_job == None).order_by(User.id).offset(offset)
-    total = users.count()
-    if offset is not None: users.offset(offset)
-    if n is not None: users.limit(n)
+    users = db.query(User).filter(User.restricted_job == None)
+    if search:
+        prefix = search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        users = users.filter(or_(User.name.like(prefix, escape='\\'), User.email.like(prefix, escape='\\')))
+
+    total = estimate_count(db, users) if approximate_total else None
+    is_estimate = total is not None
+    if total is None:
+        total = users.count()
+
+    users = users.order_by(User.id)
+    if after is not None: users = users.filter(User.id > after)
+    if offset is not None: users = users.offset(offset)
+    if n is not None: users = users.limit(n)
+    users = users.all()
     return {
-        "users": [{"id": u.id, "is_admin": u.is_admin, "name": u.name} for u in users.all()],
-        "total": total
+        "users": [{"id": u.id, "is_admin": u.is_admin, "name": u.name} for u in users],
+        "total": total,
+        "total_is_estimate": is_estimate,
+        "last_id": users[-1].id if len(users) > 0 else None
     }
 
 
@@ -125,15 +195,19 @@ def get_user_jobs(db: Session, user: User):
             CodingJob.restricted == True, JobUser.user_id == user.id, JobUser.can_code == True).order_by(CodingJob.id).all()
         jobs = open_jobs + restricted_jobs
 
+    # jobs that are still being created in the background
+    pending = {id for id, in db.query(JobIngest.codingjob_id).filter(JobIngest.status != 'done')}
+
     jobs_with_progress = []
     for job in jobs:
-        if job.archived:
+        if job.archived or job.id in pending:
             continue
         data = {"id": job.id, "title": job.title, "created": job.created,
                 "creator": job.creator.name, "archived": job.archived}
 
         jobuser = db.query(JobUser).filter(JobUser.codingjob_id == job.id, JobUser.user_id == user.id).first()
-        if jobuser is not None:
+        # coders added with set_job_coders only get a jobset (and progress) when they first open the job
+        if jobuser is not None and jobuser.jobset_id is not None:
             progress_report = unitserver.get_progress_report(db, jobuser)
             data["n_total"] = progress_report['n_total']
             data["n_coded"] = progress_report['n_coded']
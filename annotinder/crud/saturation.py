@@ -0,0 +1,87 @@
+import json
+from collections import Counter
+from typing import List
+
+from sqlalchemy.orm import Session
+
+from annotinder.crud.crud_jobset import JobSetConfig
+from annotinder.models import Annotation, JobSetUnit
+
+
+def saturation_rules(rules: dict) -> dict:
+    """
+    Get the saturation settings from a jobset's rules. A unit is saturated if either:
+    - coders_per_unit: the unit has been completed (DONE) by this many coders
+    - saturation_agreement: the unit has been completed by at least saturation_min_coders (default 2) coders,
+      and the agreement between these coders is at least this value (0 to 1)
+    """
+    if rules is None:
+        return {}
+    saturation = {}
+    if rules.get('coders_per_unit') is not None:
+        saturation['coders_per_unit'] = int(rules['coders_per_unit'])
+    if rules.get('saturation_agreement') is not None:
+        saturation['agreement'] = float(rules['saturation_agreement'])
+        saturation['min_coders'] = int(rules.get('saturation_min_coders', 2))
+    return saturation
+
+
+def agreement(annotations: List[list]) -> float:
+    """
+    Agreement between coders on a unit. For every variable we take the proportion of coders that
+    gave the most common answer (the full set of values, fields and spans a coder gave for this variable).
+    The agreement on the unit is the agreement on the variable that coders disagree on most.
+    """
+    if len(annotations) == 0:
+        return 0
+
+    coder_answers = []
+    for annotation in annotations:
+        answers = {}
+        for a in annotation or []:
+            answer = json.dumps([a.get('value'), a.get('field'), a.get('offset'), a.get('length')], sort_keys=True)
+            answers.setdefault(a.get('variable'), set()).add(answer)
+        coder_answers.append(answers)
+
+    variables = {variable for answers in coder_answers for variable in answers}
+    unit_agreement = 1.0
+    for variable in variables:
+        values = Counter(frozenset(answers.get(variable, set())) for answers in coder_answers)
+        most_common = values.most_common(1)[0][1]
+        unit_agreement = min(unit_agreement, most_common / len(coder_answers))
+    return unit_agreement
+
+
+def is_saturated(annotations: List[list], saturation: dict) -> bool:
+    n_done = len(annotations)
+    if 'coders_per_unit' in saturation and n_done >= saturation['coders_per_unit']:
+        return True
+    if 'agreement' in saturation and n_done >= saturation['min_coders']:
+        return agreement(annotations) >= saturation['agreement']
+    return False
+
+
+def update_saturation(db: Session, jobset: JobSetConfig, unit_id: int) -> bool:
+    """
+    Check whether a unit is saturated given the jobset rules, and if so block it from new assignments.
+    This is done incrementally whenever a coder finishes a unit, so that only this unit's annotations have to be checked.
+    Only DONE annotations count, so units that coders opened but didn't finish stay available.
+    Units with fixed positions (pre/post) are never blocked, because every coder needs to see them.
+    Returns True if the unit got blocked.
+    """
+    saturation = saturation_rules(jobset.rules)
+    if not saturation:
+        return False
+
+    annotations = (db.query(Annotation.annotation)
+                   .filter(Annotation.codingjob_id == jobset.codingjob_id, Annotation.jobset_id == jobset.id,
+                           Annotation.unit_id == unit_id, Annotation.status == 'DONE')
+                   .all())
+    if not is_saturated([a.annotation for a in annotations], saturation):
+        return False
+
+    n_blocked = (db.query(JobSetUnit)
+                 .filter(JobSetUnit.codingjob_id == jobset.codingjob_id, JobSetUnit.jobset_id == jobset.id, JobSetUnit.unit_id == unit_id,
+                         JobSetUnit.fixed_index == None, JobSetUnit.blocked == False)
+                 .update({JobSetUnit.blocked: True}, synchronize_session=False))
+    return n_blocked > 0
@@ -1,4 +1,9 @@
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -9,15 +14,41 @@ load_dotenv()
 
 ## railway injects its own DB URL
 DATABASE_URL = os.getenv('DATABASE_URL')
+## For single node deployments (and fast local testing) an embedded SQLite database can be used
+if DATABASE_URL is None and os.getenv('SQLITE_PATH'):
+  DATABASE_URL = f"sqlite:///{os.getenv('SQLITE_PATH')}"
 if DATABASE_URL is None:
   DB_HOST = os.getenv('POSTGRES_HOST')
   DB_NAME = os.getenv('POSTGRES_NAME') 
   DB_PW = os.getenv('POSTGRES_PASSWORD')
   DATABASE_URL = f"postgresql://{DB_NAME}:{DB_PW}@{DB_HOST}/annotinder"
 
-engine = create_engine(
-  DATABASE_URL, connect_args={}
-)
+
+def sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Settings for every SQLite connection. WAL lets readers continue while a coder's annotation is written,
+    and with synchronous=NORMAL commits don't wait for an fsync (a crash can lose the last commits, but not corrupt the DB)
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")  # 64MB
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256MB
+    cursor.close()
+
+
+def create_db_engine(url: str):
+    if url.startswith('sqlite'):
+        # connections are shared between the threads of the FastAPI threadpool, and wait up to 30 seconds for locks
+        db_engine = create_engine(url, connect_args={'check_same_thread': False, 'timeout': 30})
+        event.listen(db_engine, 'connect', sqlite_pragmas)
+        return db_engine
+    return create_engine(url, connect_args={})
+
+
+engine = create_db_engine(DATABASE_URL)
 
 if not database_exists(engine.url):
     create_database(engine.url)
@@ -37,3 +68,74 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+class ReadReplica:
+    """
+    An optional read-only database (e.g., a PostgreSQL streaming replica) for admin and export queries,
+    so that these don't compete with coders for connections to the primary database.
+    Sessions fall back to the primary database if the replica cannot be reached, or if it lags behind
+    more than max_lag seconds. This is checked at most once every check_interval seconds.
+    """
+
+    def __init__(self, url: str, max_lag: float = 30, check_interval: float = 5):
+        self.engine = create_db_engine(url)
+        self.SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=self.engine)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.last_check = 0
+        self.is_available = False
+        self.lock = threading.Lock()
+
+    def lag(self) -> float:
+        """
+        Seconds that the replica is behind on the primary. 0 if it is still receiving WAL from the primary, and has
+        replayed everything it received. If it is disconnected, it can't know what it misses, so then this is the time
+        since the last replayed transaction (the status of the WAL receiver is only visible to roles with pg_read_all_stats,
+        for other roles a running WAL receiver is assumed to be streaming)
+        """
+        if self.engine.dialect.name != 'postgresql':
+            return 0
+        with self.engine.connect() as con:
+            lag = con.execute(text("""
+                SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0
+                            WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn()
+                                 AND EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE coalesce(status, 'streaming') = 'streaming') THEN 0
+                            ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END""")).scalar()
+        return float(lag) if lag is not None else float('inf')
+
+    def available(self) -> bool:
+        with self.lock:
+            if time.monotonic() - self.last_check < self.check_interval:
+                return self.is_available
+            self.last_check = time.monotonic()
+            try:
+                lag = self.lag()
+                self.is_available = lag <= self.max_lag
+                if not self.is_available:
+                    logging.warning(f"Read replica lags {lag:.1f} seconds behind, using primary database")
+            except SQLAlchemyError as e:
+                logging.warning(f"Read replica not available, using primary database ({e})")
+                self.is_available = False
+            return self.is_available
+
+    def session(self):
+        if self.available():
+            return self.SessionLocal()
+        return SessionLocal()
+
+
+READ_DATABASE_URL = os.getenv('READ_DATABASE_URL')
+read_replica = None
+if READ_DATABASE_URL is not None:
+  read_replica = ReadReplica(READ_DATABASE_URL, max_lag=float(os.getenv('READ_MAX_LAG', 30)))
+
+def get_read_db():
+    """
+    Like get_db, but uses the read replica (if configured and up to date). Only for endpoints that don't write
+    """
+    try:
+        db = read_replica.session() if read_replica is not None else SessionLocal()
+        yield db
+    finally:
+        db.close()
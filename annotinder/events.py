@@ -0,0 +1,135 @@
+"""
+Live progress updates of coding jobs, for admin dashboards (see GET /codingjob/{id}/events).
+
+Whenever the status of an annotation changes (a coder starts or finishes a unit), this is published on an in-process
+event bus, after the change is committed. Subscribers (one per open event stream) don't keep a list of events, but
+add them up into a single delta: the change in the number of annotations per jobset and status. Streams send this
+delta at most once every EVENT_INTERVAL seconds, so a burst of annotations becomes a single update.
+
+Events are only shared within a process, so with multiple workers a stream only sees the annotations handled by its
+own worker. Streams therefore also send a full snapshot (counted in the database) every EVENT_SNAPSHOT_INTERVAL seconds.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EVENT_INTERVAL = float(os.getenv('EVENT_INTERVAL', 1))
+EVENT_SNAPSHOT_INTERVAL = float(os.getenv('EVENT_SNAPSHOT_INTERVAL', 60))
+
+
+class Subscription:
+    """
+    Receives the status changes of the annotations of one codingjob. Changes can be added from any thread,
+    and are read from the event loop on which the subscription was made.
+    """
+
+    def __init__(self, bus: 'EventBus', codingjob_id: int, loop: asyncio.AbstractEventLoop):
+        self.bus = bus
+        self.codingjob_id = codingjob_id
+        self.loop = loop
+        self.delta = {}
+        self.lock = threading.Lock()
+        self.ready = asyncio.Event()
+
+    def add(self, jobset_id: int, old_status: Optional[str], new_status: str) -> None:
+        with self.lock:
+            counts = self.delta.setdefault(str(jobset_id), defaultdict(int))
+            if old_status is not None:
+                counts[old_status] -= 1
+            counts[new_status] += 1
+        try:
+            self.loop.call_soon_threadsafe(self.ready.set)
+        except RuntimeError:
+            # the event loop is closed
+            pass
+
+    async def get(self, timeout: Optional[float] = None) -> dict:
+        """
+        Wait (at most timeout seconds) for changes, and return the delta since the previous get.
+        Counts that added up to zero are left out, so the delta can be empty.
+        """
+        try:
+            await asyncio.wait_for(self.ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self.ready.clear()
+        with self.lock:
+            delta, self.delta = self.delta, {}
+        delta = {jobset: {status: n for status, n in counts.items() if n != 0} for jobset, counts in delta.items()}
+        return {jobset: counts for jobset, counts in delta.items() if len(counts) > 0}
+
+    def close(self) -> None:
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    def __init__(self):
+        self.subscriptions = defaultdict(set)
+        self.lock = threading.Lock()
+
+    def subscribe(self, codingjob_id: int) -> Subscription:
+        """
+        Subscribe to the events of a codingjob. Has to be called from a running event loop
+        """
+        subscription = Subscription(self, codingjob_id, asyncio.get_running_loop())
+        with self.lock:
+            self.subscriptions[codingjob_id].add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.codingjob_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if len(subscriptions) == 0:
+                    del self.subscriptions[subscription.codingjob_id]
+
+    def publish(self, codingjob_id: int, jobset_id: int, old_status: Optional[str], new_status: str) -> None:
+        """
+        Publish that the status of an annotation changed (old_status is None for a new annotation)
+        """
+        if old_status == new_status or codingjob_id not in self.subscriptions:
+            return
+        with self.lock:
+            subscriptions = list(self.subscriptions.get(codingjob_id, ()))
+        for subscription in subscriptions:
+            subscription.add(jobset_id, old_status, new_status)
+
+
+bus = EventBus()
+
+
+def format_event(event: str, data: dict) -> str:
+    return f'event: {event}\ndata: {json.dumps(data, default=str)}\n\n'
+
+
+async def progress_stream(codingjob_id: int, snapshot: Callable[[], Awaitable[dict]],
+                          interval: float = EVENT_INTERVAL, snapshot_interval: float = EVENT_SNAPSHOT_INTERVAL) -> AsyncIterator[str]:
+    """
+    Server-sent events with the progress of a codingjob: a "snapshot" event (the result of snapshot()) at the start and
+    every snapshot_interval seconds, and in between "progress" events with the changes, at most once every interval seconds
+    """
+    subscription = bus.subscribe(codingjob_id)
+    try:
+        yield format_event('snapshot', await snapshot())
+        last_snapshot = time.monotonic()
+        while True:
+            delta = await subscription.get(timeout=max(0, last_snapshot + snapshot_interval - time.monotonic()))
+            if time.monotonic() - last_snapshot >= snapshot_interval:
+                # the snapshot already includes the changes
+                yield format_event('snapshot', await snapshot())
+                last_snapshot = time.monotonic()
+            elif len(delta) > 0:
+                yield format_event('progress', dict(jobsets=delta))
+                await asyncio.sleep(interval)
+    finally:
+        subscription.close()
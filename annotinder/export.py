@@ -0,0 +1,124 @@
+"""
+Columnar (Parquet / Arrow IPC) exports. These need pyarrow (pip install annotinder[export]), which is imported
+only when an export is made.
+"""
+
+import json
+from typing import Iterable, Iterator, Optional
+
+from annotinder.utils import chunks
+
+# one row per value in an annotation
+ANNOTATION_COLUMNS = ['annotation_id', 'jobset', 'unit_id', 'coder_id', 'coder', 'status',
+                      'variable', 'value', 'field', 'offset', 'length']
+FORMATS = {'parquet': 'application/vnd.apache.parquet', 'arrow': 'application/vnd.apache.arrow.stream'}
+
+
+def import_pyarrow():
+    """
+    Import pyarrow, or raise an ImportError with installation instructions
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('Columnar exports require pyarrow. Install it with: pip install annotinder[export]')
+    return pyarrow
+
+
+def _string(value) -> Optional[str]:
+    return value if value is None or isinstance(value, str) else json.dumps(value)
+
+
+def _integer(value) -> Optional[int]:
+    """
+    Annotations are stored as given by the client, so offsets and lengths can have any type. Use null if they are not integers
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and value.strip().lstrip('-').isdigit():
+        return int(value)
+    return None
+
+
+def flatten_annotation(annotation: dict) -> Iterator[dict]:
+    """
+    Flatten an annotation (as returned by crud_codingjob.get_annotations) into one row per value.
+    Values that are not strings (e.g., numbers or lists) are JSON encoded, so that the column has a single type.
+    """
+    for value in annotation['annotation'] or []:
+        if not isinstance(value, dict):
+            value = dict(value=value)
+        yield dict(annotation_id=annotation['id'], jobset=annotation['jobset'], unit_id=annotation['unit_id'],
+                   coder_id=annotation['coder_id'], coder=annotation['coder'], status=annotation['status'],
+                   variable=_string(value.get('variable')), value=_string(value.get('value')),
+                   field=_string(value.get('field')), offset=_integer(value.get('offset')), length=_integer(value.get('length')))
+
+
+class _Sink:
+    """
+    Write-only file object that collects what pyarrow writes, so that it can be streamed in pieces
+    """
+    closed = False
+
+    def __init__(self):
+        self.data = []
+        self.position = 0
+
+    def write(self, data) -> int:
+        self.data.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def writable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return False
+
+    def drain(self) -> bytes:
+        data, self.data = b''.join(self.data), []
+        return data
+
+
+def annotation_schema():
+    pa = import_pyarrow()
+    int_columns = {'annotation_id', 'coder_id', 'offset', 'length'}
+    return pa.schema([(c, pa.int64() if c in int_columns else pa.string()) for c in ANNOTATION_COLUMNS])
+
+
+def write_annotations(annotations: Iterable[dict], format: str = 'parquet', batch_size: int = 10000) -> Iterator[bytes]:
+    """
+    Flatten annotations and write them as Parquet or Arrow IPC (stream format), yielding the output after every
+    batch of batch_size rows (a Parquet row group or Arrow record batch), so that the export never has to be in memory.
+    """
+    pa = import_pyarrow()
+    schema = annotation_schema()
+    sink = _Sink()
+    if format == 'parquet':
+        writer = pa.parquet.ParquetWriter(sink, schema, compression='zstd')
+    elif format == 'arrow':
+        writer = pa.ipc.new_stream(sink, schema)
+    else:
+        raise ValueError(f'Unknown export format: {format}')
+
+    rows = (row for annotation in annotations for row in flatten_annotation(annotation))
+    for batch in chunks(rows, batch_size):
+        columns = {c: [row[c] for row in batch] for c in ANNOTATION_COLUMNS}
+        writer.write_batch(pa.RecordBatch.from_pydict(columns, schema=schema))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
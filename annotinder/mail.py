@@ -1,9 +1,14 @@
 import os
+import logging
+import queue
 import smtplib
 import ssl
+import threading
+import time
 from datetime import datetime
 from dotenv import load_dotenv
 from email.mime.text import MIMEText
+from typing import Callable, Optional
 
 load_dotenv()
 
@@ -12,17 +17,147 @@ PASSWORD = os.getenv('EMAIL_PASSWORD')    # Your app password goes here
 SENDER = os.getenv('EMAIL_ADDRESS')    # Your e-mail address
 PORT = os.getenv('EMAIL_PORT', '')
 if PORT == '': PORT = 465
+# set EMAIL_SSL=false to use a plain SMTP connection (e.g., a local SMTP server for testing)
+SSL = os.getenv('EMAIL_SSL', 'true').lower() != 'false'
 
-def send_email(to: str, subject: str, body: str) -> None:
-    msg = MIMEText(body, 'html')
-    msg['Subject'] = subject
-    msg['From'] = 'AnnoTinder <{email}>'.format(email=SENDER)
-    msg['To'] = to
-   
-    with smtplib.SMTP_SSL(os.getenv('EMAIL_SMTP'), port=PORT, context=CTX) as server:
-        #server.set_debuglevel(1)
+
+def connect() -> smtplib.SMTP:
+    """
+    Open an authenticated connection to the SMTP server
+    """
+    if SSL:
+        server = smtplib.SMTP_SSL(os.getenv('EMAIL_SMTP'), port=PORT, context=CTX)
+    else:
+        server = smtplib.SMTP(os.getenv('EMAIL_SMTP'), port=PORT)
+    #server.set_debuglevel(1)
+    if PASSWORD:
         server.login(SENDER, PASSWORD)
-        server.sendmail(SENDER, to, msg.as_string())
+    return server
+
+
+class Mail:
+    def __init__(self, to: str, subject: str, body: str):
+        msg = MIMEText(body, 'html')
+        msg['Subject'] = subject
+        msg['From'] = 'AnnoTinder <{email}>'.format(email=SENDER)
+        msg['To'] = to
+        self.to = to
+        self.message = msg.as_string()
+        self.attempts = 0
+
+
+class MailQueue:
+    """
+    Outbound mail queue. Mails are sent by a background thread, so that requests don't have to wait for the SMTP server.
+    The thread keeps its authenticated connection open while there are mails to send (and closes it after idle_timeout seconds),
+    and sends everything that is in the queue over this connection. If sending fails, the connection is reopened and the
+    mail is retried with exponential backoff (backoff * 2^attempt seconds), up to max_retries times.
+    """
+
+    def __init__(self, connect: Callable[[], smtplib.SMTP] = connect, max_retries: int = 5, backoff: float = 1,
+                 idle_timeout: float = 30):
+        self.connect = connect
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self.queue = queue.Queue()
+        self.server = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.n_sent = 0
+        self.n_failed = 0
+        self.n_retries = 0
+        self.n_connections = 0
+
+    def put(self, to: str, subject: str, body: str) -> None:
+        self.queue.put(Mail(to, subject, body))
+        self.start()
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self._run, name='mailqueue', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Send the mails that are still in the queue, and stop the background thread
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.queue.put(None)  # wake up the thread if it is waiting for mail
+            self.thread.join(timeout)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until the queue is empty. Returns False if the timeout passed first
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks > 0:
+            if deadline is not None and time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def metrics(self) -> dict:
+        return dict(queued=self.queue.qsize(), sent=self.n_sent, failed=self.n_failed, retries=self.n_retries,
+                    connections=self.n_connections, connected=self.server is not None)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                mail = self.queue.get(timeout=0.1 if self.stopping.is_set() else self.idle_timeout)
+            except queue.Empty:
+                self._disconnect()
+                if self.stopping.is_set():
+                    return
+                continue
+            try:
+                if mail is not None:
+                    self._send(mail)
+            finally:
+                self.queue.task_done()
+
+    def _send(self, mail: Mail) -> None:
+        while True:
+            try:
+                if self.server is None:
+                    self.server = self.connect()
+                    self.n_connections += 1
+                self.server.sendmail(SENDER, mail.to, mail.message)
+                self.n_sent += 1
+                return
+            except (smtplib.SMTPException, OSError) as e:
+                self._disconnect()
+                mail.attempts += 1
+                if mail.attempts > self.max_retries:
+                    logging.error(f"Could not send mail to {mail.to}: {e}")
+                    self.n_failed += 1
+                    return
+                self.n_retries += 1
+                logging.warning(f"Sending mail to {mail.to} failed ({e}), retrying")
+                time.sleep(self.backoff * 2 ** (mail.attempts - 1))
+
+    def _disconnect(self) -> None:
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self.server = None
+
+
+mail_queue = MailQueue()
+
+
+def send_email(to: str, subject: str, body: str) -> None:
+    """
+    Add an email to the mail queue. It will be sent in the background
+    """
+    mail_queue.put(to, subject, body)
 
 magic_link_template = """\
 <div style="display: flex; flex-direction: column;">
@@ -49,3 +184,4 @@ def send_magic_link(name: str, email:str, secret: str):
 if __name__ == '__main__':
     #send_email('kasperwelbers@gmail.com', 'test', 'Dit. En dit heeft ook <a href="www.google.com">een link naar Google</a>')
     send_magic_link('Kasper','kasperwelbers@gmail.com', 'super secret')
+    mail_queue.stop()
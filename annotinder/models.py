@@ -1,9 +1,19 @@
 import json
-from sqlalchemy import func, Boolean, Column, ForeignKey, Integer, String, Float, DateTime, ForeignKeyConstraint
+import os
+from dotenv import load_dotenv
+from sqlalchemy import func, Boolean, Column, ForeignKey, Integer, String, Float, DateTime, ForeignKeyConstraint, Index, UniqueConstraint, LargeBinary, DDL, event
 from sqlalchemy.types import TypeDecorator
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, deferred
 
+from annotinder import compression
 from annotinder.database import Base, engine
+from annotinder.partitions import PARTITION_BY_JOB, PARTITION_ARGS
+
+load_dotenv()
+
+# unit content larger than this many bytes is stored compressed. Set to "off" to disable compression
+UNIT_COMPRESSION_THRESHOLD = os.getenv('UNIT_COMPRESSION_THRESHOLD', '2048')
+UNIT_COMPRESSION_THRESHOLD = None if UNIT_COMPRESSION_THRESHOLD == 'off' else int(UNIT_COMPRESSION_THRESHOLD)
 
 class JsonString(TypeDecorator):
     """Enables JSON storage by encoding and decoding on the fly."""
@@ -20,6 +30,48 @@ class JsonString(TypeDecorator):
             return None
         return json.loads(value)
 
+class CompressedJson(TypeDecorator):
+    """
+    JSON storage as binary, that is compressed if it is larger than threshold bytes (None means never).
+    Compressed values start with a null byte and a codec tag, so they can't be confused with plain JSON.
+    Values stored as text (before the column was binary) can still be read.
+    """
+    impl = LargeBinary
+    cache_ok = True
+    codec_tags = {'zstd': b'\x00z', 'zlib': b'\x00d'}
+    # fast settings, because units are decompressed whenever they are served
+    levels = {'zstd': 3, 'zlib': 1}
+
+    def __init__(self, threshold=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        data = json.dumps(value).encode('utf-8')
+        if self.threshold is not None and len(data) > self.threshold:
+            codec = compression.DEFAULT_CODEC
+            data = self.codec_tags[codec] + compression.compress(data, codec, self.levels[codec])
+        return data
+
+    def result_processor(self, dialect, coltype):
+        # skip the LargeBinary result processor, which fails on values that are still stored as text
+        return lambda value: self.process_result_value(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return json.loads(value)
+        value = bytes(value)
+        for codec, tag in self.codec_tags.items():
+            if value.startswith(tag):
+                value = compression.decompress(value[len(tag):], codec)
+                break
+        return json.loads(value)
+
+
 class User(Base):
     __tablename__ = 'user'
 
@@ -38,6 +90,12 @@ class User(Base):
 
     codingjobs = relationship("CodingJob", back_populates="creator")
 
+    # pattern_ops indices so that prefix searches (LIKE 'abc%') on name and email can use an index in PostgreSQL
+    __table_args__ = (
+        Index('ix_user_name_prefix', 'name', postgresql_ops={'name': 'varchar_pattern_ops'}),
+        Index('ix_user_email_prefix', 'email', postgresql_ops={'email': 'varchar_pattern_ops'}),
+    )
+
 
 class CodingJob(Base):
     __tablename__ = 'codingjob'
@@ -55,20 +113,39 @@ class CodingJob(Base):
     jobusers = relationship("JobUser", back_populates="codingjob")
 
 
+class Codebook(Base):
+    """
+    Codebooks are stored once, by the sha256 hash of their content, and referenced by jobsets and units
+    """
+    __tablename__ = 'codebook'
+
+    hash = Column(String, primary_key=True)
+    codebook = Column(JsonString)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+
+
 class JobSet(Base):
     __tablename__ = 'jobset'
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     codingjob_id = Column(Integer, ForeignKey("codingjob.id"), index=True)
     jobset = Column(String)
-    codebook = Column(JsonString)
-    rules = Column(JsonString)
-    debriefing = Column(JsonString, nullable=True)
+    # the configuration is only loaded when it is used. Use crud_jobset.get_config, which caches it by version
+    codebook = deferred(Column(JsonString, nullable=True), group='config')  # only for jobsets created before codebooks were stored by hash
+    codebook_hash = Column(String, ForeignKey("codebook.hash"), nullable=True)
+    rules = deferred(Column(JsonString), group='config')
+    debriefing = deferred(Column(JsonString, nullable=True), group='config')
+    version = Column(Integer, default=0)  # incremented whenever the configuration changes
+    weight = Column(Float, default=1)  # relative share of new coders assigned to this jobset
 
     codingjob = relationship("CodingJob", back_populates="jobsets")
     jobsetunits = relationship('JobSetUnit')
     jobusers = relationship("JobUser", back_populates="jobset")
 
+    # never reuse ids in SQLite, because the configuration is cached by jobset id (see crud_jobset).
+    # This only applies to tables created with this setting; SQLite cannot add it to existing tables
+    __table_args__ = {'sqlite_autoincrement': True}
+
 
 
 class Unit(Base):
@@ -77,17 +154,25 @@ class Unit(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     codingjob_id = Column(Integer, ForeignKey("codingjob.id"), index=True)
     external_id = Column(String, index=True)
-    unit = Column(JsonString, nullable=True)
+    # unit content can be large, so it is compressed, and only loaded (and decompressed) when it is used
+    unit = deferred(Column(CompressedJson(UNIT_COMPRESSION_THRESHOLD), nullable=True))
+    codebook_hash = Column(String, ForeignKey("codebook.hash"), nullable=True)  # unit specific codebook
     conditionals = Column(JsonString, nullable=True)
     unit_type = Column(String)
     position = Column(String)
 
     annotation = relationship("Annotation", back_populates='unit')
 
+    # never reuse ids in SQLite, so that units of an archived job can be restored with their original ids
+    # (only for tables created with this setting, see JobSet)
+    __table_args__ = {'sqlite_autoincrement': True}
+
 
 class JobSetUnit(Base):
     __tablename__ = 'jobsetunit'
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    # if the table is partitioned by codingjob (see partitions.py), the partition key has to be part of the primary key
+    codingjob_id = Column(Integer, ForeignKey("codingjob.id"), index=True, primary_key=PARTITION_BY_JOB)
     jobset_id = Column(Integer, ForeignKey("jobset.id"), index=True)
     unit_id = Column(Integer, ForeignKey("unit.id"), index=True)
     fixed_index = Column(Integer, default=None, index=True)
@@ -95,6 +180,8 @@ class JobSetUnit(Base):
     has_conditionals = Column(Boolean, default=False)
     blocked = Column(Boolean, default=False) # block a unit from new assignments (e.g., coded enough, marked as irrelevant)
 
+    __table_args__ = {'sqlite_autoincrement': True, **PARTITION_ARGS}
+
 
 class JobUser(Base):
     __tablename__ = 'jobuser'
@@ -113,12 +200,15 @@ class JobUser(Base):
     codingjob = relationship('CodingJob', back_populates="jobusers")
     jobset = relationship("JobSet", back_populates="jobusers")
 
+    # a user can only be a coder on a codingjob once. Also used for upserting coders (ON CONFLICT)
+    __table_args__ = (UniqueConstraint('user_id', 'codingjob_id', name='uq_jobuser_user_codingjob'),)
+
 
 class Annotation(Base):
     __tablename__ = 'annotation'
 
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
-    codingjob_id = Column(Integer, ForeignKey('codingjob.id'), index=True)
+    codingjob_id = Column(Integer, ForeignKey('codingjob.id'), index=True, primary_key=PARTITION_BY_JOB)
     unit_id = Column(Integer, ForeignKey('unit.id'), index=True)
     coder_id = Column(Integer, ForeignKey('user.id'), index=True)
     jobset_id = Column(Integer, ForeignKey('jobset.id'), index=True)
@@ -132,6 +222,57 @@ class Annotation(Base):
 
     unit = relationship('Unit', back_populates='annotation')
 
+    __table_args__ = {'sqlite_autoincrement': True, **PARTITION_ARGS}
+
+
+class JobArchive(Base):
+    """
+    Cold storage for archived coding jobs. The units, jobsetunits and annotations of the job are removed from
+    their tables, and stored in JobArchiveChunks.
+    """
+    __tablename__ = 'jobarchive'
+
+    codingjob_id = Column(Integer, ForeignKey('codingjob.id'), primary_key=True)
+    codec = Column(String)
+    n_units = Column(Integer)
+    n_annotations = Column(Integer)
+    size = Column(Integer)  # compressed size of all chunks in bytes
+    created = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class JobArchiveChunk(Base):
+    """
+    Consecutive rows (by id) of one of the archived tables of a job, as compressed newline delimited JSON.
+    Every chunk is compressed separately, so that reading a page of rows only decompresses the chunks that have them.
+    """
+    __tablename__ = 'jobarchivechunk'
+
+    codingjob_id = Column(Integer, ForeignKey('jobarchive.codingjob_id'), primary_key=True)
+    kind = Column(String, primary_key=True)  # unit, jobsetunit or annotation
+    min_id = Column(Integer, primary_key=True)
+    max_id = Column(Integer)
+    data = deferred(Column(LargeBinary))
+
+
+class JobIngest(Base):
+    """
+    Status of a codingjob that is created in the background. The job is only visible to coders once its status is "done".
+    """
+    __tablename__ = 'jobingest'
+
+    codingjob_id = Column(Integer, ForeignKey('codingjob.id'), primary_key=True)
+    status = Column(String, default='queued')  # queued, running, done or failed
+    n_units = Column(Integer)
+    n_done = Column(Integer, default=0)  # number of units that have been ingested
+    error = Column(String, nullable=True)
+    created = Column(DateTime(timezone=True), server_default=func.now())
+    updated = Column(DateTime(timezone=True), nullable=True)  # last progress, to detect ingests that were interrupted
+    finished = Column(DateTime(timezone=True), nullable=True)
+
+
+# unit content is already compressed, so PostgreSQL shouldn't try to compress it again
+event.listen(Unit.__table__, 'after_create', DDL('ALTER TABLE unit ALTER COLUMN unit SET STORAGE EXTERNAL').execute_if(dialect='postgresql'))
+
 
 ## use these in __main__, because otherwise sqlalchemy 'sometimes' cannot create the tables in time...
 Base.metadata.create_all(bind=engine)
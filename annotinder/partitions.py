@@ -0,0 +1,166 @@
+"""
+Optional partitioning of the annotation and jobsetunit tables by codingjob (PostgreSQL only).
+
+Enable by setting PARTITION_BY_JOB=true before the database tables are created. Both tables are then created as
+LIST partitioned tables, and every codingjob gets its own partition of each table, which is created before the job
+and dropped when the job is deleted or moved to cold storage. Queries that filter on codingjob_id only
+touch the partition of that job, so they don't slow down as the number of jobs grows.
+
+Creating and dropping partitions must not block coders on other jobs. CREATE TABLE ... PARTITION OF and DROP TABLE
+would take an ACCESS EXCLUSIVE lock on the parent tables, so partitions are created as separate tables that are
+then attached (which only takes a SHARE UPDATE EXCLUSIVE lock, that doesn't conflict with reads and writes),
+and detached concurrently and truncated before they are dropped (see drop_detached). Detaching concurrently is not possible if the tables have
+a default partition, so they don't have one: every job needs its partitions (see create_partitions).
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from annotinder.database import engine
+
+load_dotenv()
+
+PARTITION_BY_JOB = os.getenv('PARTITION_BY_JOB', 'false').lower() == 'true' and engine.dialect.name == 'postgresql'
+PARTITIONED_TABLES = ('annotation', 'jobsetunit')
+
+# table args for the partitioned tables. Note that the partition key (codingjob_id) then has to be part of the primary key
+PARTITION_ARGS = {'postgresql_partition_by': 'LIST (codingjob_id)'} if PARTITION_BY_JOB else {}
+
+_is_partitioned: Optional[bool] = None
+
+
+def is_partitioned(db: Session) -> bool:
+    """
+    Check whether the tables are actually partitioned. They are not if PARTITION_BY_JOB was enabled for an existing database
+    """
+    global _is_partitioned
+    if not PARTITION_BY_JOB:
+        return False
+    if _is_partitioned is None:
+        _is_partitioned = db.execute(text("SELECT count(*) FROM pg_partitioned_table WHERE partrelid = 'annotation'::regclass")).scalar() > 0
+    return _is_partitioned
+
+
+def partition_name(table: str, codingjob_id: int) -> str:
+    return f'{table}_job_{int(codingjob_id)}'
+
+
+def new_codingjob_id(db: Session) -> int:
+    """
+    Get the id for a new codingjob from its sequence, so that the partitions of the job can be created before the job
+    """
+    return db.execute(text("SELECT nextval(pg_get_serial_sequence('codingjob', 'id'))")).scalar()
+
+
+def create_partitions(db: Session, codingjob_id: int, lock_timeout: float = 0.2, attempts: int = 5) -> bool:
+    """
+    Create the partitions for a codingjob (if they don't exist yet), in a separate short transaction that is committed
+    immediately. Attaching a partition also adds the foreign keys of the parent table, which briefly blocks writes to
+    the tables they refer to (e.g., codingjob), so this has to be called before the transaction of db writes to these
+    tables (for a new job, use new_codingjob_id). Waiting for locks is limited to lock_timeout seconds, and retried
+    attempts times, after which a 503 error is raised.
+    Returns False if the tables are not partitioned.
+    """
+    if not is_partitioned(db):
+        return False
+    for attempt in range(attempts):
+        try:
+            with db.get_bind().connect() as con, con.begin():
+                con.execute(text(f"SET LOCAL lock_timeout = '{int(lock_timeout * 1000)}ms'"))
+                for table in PARTITIONED_TABLES:
+                    name = partition_name(table, codingjob_id)
+                    pending = con.execute(text("SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(:name)"),
+                                          dict(name=name)).scalar()
+                    if pending is False:
+                        continue
+                    if pending:
+                        con.execute(text(f'ALTER TABLE {table} DETACH PARTITION {name} FINALIZE'))
+                    # (without defaults, because rows are inserted via the parent table, and the id default would depend on its sequence)
+                    con.execute(text(f'CREATE TABLE {name} (LIKE {table})'))
+                    con.execute(text(f'ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES IN ({int(codingjob_id)})'))
+            return True
+        except OperationalError as e:
+            logging.warning(f'Could not create partitions for codingjob {codingjob_id} (attempt {attempt + 1}): {e}')
+            time.sleep(lock_timeout * (attempt + 1))
+    raise HTTPException(status_code=503, detail='The database is busy, please try again')
+
+
+def drop_partitions(db: Session, codingjob_id: int) -> bool:
+    """
+    Remove the partitions of a codingjob, removing all its annotations and jobsetunits at once. The transaction of db is
+    committed first. The partitions are detached concurrently, which does not block queries on the parent tables
+    (but waits until the transactions that use them have finished), and then renamed and truncated.
+    Returns False if the tables are not partitioned or the partitions could not be detached, in which case rows may
+    be left in the partitions (and they can be deleted in batches).
+    """
+    if not is_partitioned(db):
+        return False
+    db.commit()
+    # DETACH PARTITION CONCURRENTLY cannot run inside a transaction
+    with db.get_bind().connect().execution_options(isolation_level='AUTOCOMMIT') as con:
+        try:
+            for table in PARTITIONED_TABLES:
+                name = partition_name(table, codingjob_id)
+                pending = con.execute(text("SELECT inhdetachpending FROM pg_inherits WHERE inhrelid = to_regclass(:name)"),
+                                      dict(name=name)).scalar()
+                if pending is not None:
+                    # if a previous detach was interrupted, it has to be finalized
+                    con.execute(text(f'ALTER TABLE {table} DETACH PARTITION {name} {"FINALIZE" if pending else "CONCURRENTLY"}'))
+                if con.execute(text("SELECT to_regclass(:name)"), dict(name=name)).scalar() is not None:
+                    # a new partition for the job (e.g., when it is restored from cold storage) has to be a new table
+                    detached = f'detached_{name}_{time.time_ns()}'
+                    con.execute(text(f'ALTER TABLE {name} RENAME TO {detached}'))
+                    con.execute(text(f'TRUNCATE {detached}'))
+        except OperationalError as e:
+            logging.warning(f'Could not detach partitions of codingjob {codingjob_id}: {e}')
+            return False
+        drop_detached(con)
+    return True
+
+
+def drop_detached(con, lock_timeout: float = 0.05) -> None:
+    """
+    Drop the (empty) tables of detached partitions. Dropping a table also drops its foreign keys, which needs an
+    ACCESS EXCLUSIVE lock on the tables they refer to (e.g., unit and user). Queries on these tables would queue behind
+    the DROP while it waits for this lock, so it only waits lock_timeout seconds. Tables that cannot be dropped
+    now are dropped the next time.
+    """
+    detached = con.execute(text("SELECT relname FROM pg_class WHERE relkind = 'r' AND relname ~ :pattern"),
+                           dict(pattern=f"^detached_({'|'.join(PARTITIONED_TABLES)})_job_[0-9]+_[0-9]+$")).scalars().all()
+    for name in detached:
+        try:
+            con.execute(text(f"SET lock_timeout = '{int(lock_timeout * 1000)}ms'"))
+            con.execute(text(f'DROP TABLE IF EXISTS {name}'))
+        except OperationalError:
+            logging.info(f'Could not drop {name} yet')
+        finally:
+            con.execute(text("RESET lock_timeout"))
+
+
+def scanned_tables(db: Session, query) -> set:
+    """
+    Get the names of the tables (and partitions) that PostgreSQL plans to scan for a query. Used to verify that
+    queries on the partitioned tables are pruned to the partition of a single job.
+    """
+    compiled = query.statement.compile(dialect=db.get_bind().dialect)
+    plan = db.connection().exec_driver_sql('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    tables = set()
+    def collect(node):
+        if 'Relation Name' in node:
+            tables.add(node['Relation Name'])
+        for child in node.get('Plans', []):
+            collect(child)
+    collect(plan[0]['Plan'])
+    return tables
@@ -0,0 +1,197 @@
+"""
+Rate limiting without touching the database.
+
+Limits use a sliding window counter: the count of the current fixed window plus the count of the previous
+window, weighted by how much of the previous window still overlaps with the sliding window. This needs only
+two counters per key. The counters are kept in a backend, which can be set with the RATELIMIT_BACKEND env variable:
+- memory: counters are kept in the process (default). With multiple workers, every worker counts separately.
+- shared: counters are kept in an SQLite file in shared memory (RATELIMIT_PATH, default /dev/shm), shared by all workers on the machine.
+- off: no rate limiting
+
+Limits per IP address use the address of the client. Behind a proxy (e.g., Railway, or nginx in front of gunicorn),
+the server has to take this from the forwarded headers of the proxy: uvicorn and gunicorn do this for proxies
+in FORWARDED_ALLOW_IPS (default 127.0.0.1, use * if the server can only be reached via the proxy). Otherwise
+all clients have the address of the proxy, and share a single limit. Clients behind the same NAT (e.g., a classroom)
+also share a limit. All limits can be set with env variables (see the limiters below, and the env template).
+"""
+
+import math
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Optional, Tuple
+
+from dotenv import load_dotenv
+from fastapi import HTTPException, Request
+
+load_dotenv()
+
+
+class MemoryBackend:
+    """
+    Keeps counters in a dictionary. If there are more than max_keys counters, expired counters are removed.
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.counters = {}
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+
+    def get(self, key: str, window: int, amount: int = 0) -> Tuple[int, int]:
+        """
+        Add amount to the counter of the current window (window is the index of the current window) and
+        return the counts of the previous and current window.
+        """
+        with self.lock:
+            current_window, previous, current = self.counters.get(key, (window, 0, 0))
+            if current_window == window - 1:
+                previous, current = current, 0
+            elif current_window != window:
+                previous, current = 0, 0
+            current += amount
+            if amount > 0:
+                self.counters[key] = (window, previous, current)
+                if len(self.counters) > self.max_keys:
+                    self.counters = {k: v for k, v in self.counters.items() if v[0] >= window - 1}
+            return previous, current
+
+    def reset(self, key: str) -> None:
+        with self.lock:
+            self.counters.pop(key, None)
+
+
+class SharedBackend:
+    """
+    Keeps counters in an SQLite database file, so that they are shared by all processes on the same machine.
+    By default the file is created in /dev/shm, so it lives in memory.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        if path is None:
+            directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+            path = os.path.join(directory, 'annotinder_ratelimit.db')
+        self.path = path
+        self.local = threading.local()
+        self.n_updates = 0
+        with self.connection() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS counter (key TEXT PRIMARY KEY, window INTEGER, previous INTEGER, current INTEGER)')
+
+    def connection(self) -> sqlite3.Connection:
+        if not hasattr(self.local, 'connection'):
+            con = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=OFF')
+            self.local.connection = con
+        return self.local.connection
+
+    def get(self, key: str, window: int, amount: int = 0) -> Tuple[int, int]:
+        con = self.connection()
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            row = con.execute('SELECT window, previous, current FROM counter WHERE key = ?', (key,)).fetchone()
+            current_window, previous, current = row if row is not None else (window, 0, 0)
+            if current_window == window - 1:
+                previous, current = current, 0
+            elif current_window != window:
+                previous, current = 0, 0
+            current += amount
+            if amount > 0:
+                con.execute('INSERT OR REPLACE INTO counter (key, window, previous, current) VALUES (?, ?, ?, ?)',
+                            (key, window, previous, current))
+                self.n_updates += 1
+                if self.n_updates % 1000 == 0:
+                    # windows differ per limiter, so only remove counters that are certainly expired
+                    con.execute('DELETE FROM counter WHERE window < ?', (window - 2,))
+            con.execute('COMMIT')
+        except Exception:
+            con.execute('ROLLBACK')
+            raise
+        return previous, current
+
+    def reset(self, key: str) -> None:
+        self.connection().execute('DELETE FROM counter WHERE key = ?', (key,))
+
+
+def get_backend():
+    backend = os.getenv('RATELIMIT_BACKEND', 'memory')
+    if backend == 'off':
+        return None
+    if backend == 'shared':
+        return SharedBackend(os.getenv('RATELIMIT_PATH'))
+    return MemoryBackend()
+
+
+class RateLimiter:
+    """
+    Allow at most limit hits per key in a sliding window of window seconds.
+    """
+
+    def __init__(self, name: str, limit: int, window: int, backend=None):
+        self.name = name
+        self.limit = limit
+        self.window = window
+        self.backend = backend
+
+    def count(self, key, amount: int = 0) -> Tuple[float, int]:
+        """
+        Returns the (estimated) number of hits in the sliding window, and the seconds until the current window ends
+        """
+        now = time.time()
+        window = int(now // self.window)
+        previous, current = self.backend.get(f'{self.name}:{key}', window, amount)
+        elapsed = now / self.window - window
+        retry_after = math.ceil((1 - elapsed) * self.window)
+        return previous * (1 - elapsed) + current, retry_after
+
+    def check(self, key) -> None:
+        """
+        Raise a 429 error if the limit has been reached
+        """
+        if self.backend is None:
+            return
+        n, retry_after = self.count(key)
+        if n >= self.limit:
+            self.too_many_requests(retry_after)
+
+    def hit(self, key) -> None:
+        """
+        Count a hit, and raise a 429 error if this exceeds the limit
+        """
+        if self.backend is None:
+            return
+        n, retry_after = self.count(key, 1)
+        if n > self.limit:
+            self.too_many_requests(retry_after)
+
+    def reset(self, key) -> None:
+        if self.backend is not None:
+            self.backend.reset(f'{self.name}:{key}')
+
+    def too_many_requests(self, retry_after: int):
+        raise HTTPException(status_code=429, headers={'Retry-After': str(retry_after)},
+                            detail="Too many requests. You can try again in {minutes} minute(s)".format(minutes=math.ceil(retry_after / 60)))
+
+
+def client_ip(request: Request) -> str:
+    """
+    The IP address of the client, for limits per IP address (see above for running behind a proxy)
+    """
+    return request.client.host if request.client is not None else 'unknown'
+
+
+backend = get_backend()
+
+# failed password logins, per email address and per IP address
+login_email = RateLimiter('login_email', int(os.getenv('RATELIMIT_LOGIN_EMAIL', 5)), 15 * 60, backend)
+login_ip = RateLimiter('login_ip', int(os.getenv('RATELIMIT_LOGIN_IP', 50)), 15 * 60, backend)
+# magic link emails, per email address and per IP address
+magic_link = RateLimiter('magic_link', int(os.getenv('RATELIMIT_MAGIC_LINK', 1)), 10 * 60, backend)
+magic_link_ip = RateLimiter('magic_link_ip', int(os.getenv('RATELIMIT_MAGIC_LINK_IP', 20)), 60 * 60, backend)
+# redeeming job tokens, per IP address and per job token
+# (a whole class can redeem a job token at the same time from behind a single NAT)
+jobtoken_ip = RateLimiter('jobtoken_ip', int(os.getenv('RATELIMIT_JOBTOKEN_IP', 300)), 60, backend)
+jobtoken = RateLimiter('jobtoken', int(os.getenv('RATELIMIT_JOBTOKEN', 1000)), 60, backend)
+# getting units and posting annotations, per coder
+coder_units = RateLimiter('coder_units', int(os.getenv('RATELIMIT_CODER_UNITS', 300)), 60, backend)
@@ -1,10 +1,10 @@
 from typing import Optional, Tuple, List
 
 from sqlalchemy.orm import Session
-from sqlalchemy import func, or_, and_, desc
+from sqlalchemy import case, func, or_, and_, desc
 
 from annotinder.models import Unit, User, Annotation, CodingJob, JobSetUnit, JobSet, JobUser
-from annotinder.crud import crud_codingjob
+from annotinder.crud import crud_codingjob, crud_jobset, crud_unit
 from annotinder.utils import random_indices
 
 
@@ -23,10 +23,13 @@ class UnitServer:
     - What Q/A measures are in place?
     """
 
-    def __init__(self, db: Session, jobuser: JobUser, jobset: JobSet):
+    def __init__(self, db: Session, jobuser: JobUser, jobset: JobSet, config: crud_jobset.JobSetConfig):
         self.db = db
         self.jobuser = jobuser
         self.jobset = jobset
+        self.config = config
+        self.rules = config.rules
+        self._n_total = None
 
     def get_progress(self) -> dict:
         """
@@ -37,21 +40,21 @@ class UnitServer:
         # might think this would be wise. The only case I can think of is having a coder do more units
         # beyond the set, but then there should be better ways that doing other (partially overlapping) sets.
 
-        last_modified = (self.db.query(Annotation.modified, func.max(Annotation.modified))
-                         .filter(Annotation.coder_id == self.jobuser.user_id, Annotation.jobset_id == self.jobset.id)
-                         .group_by(Annotation.id)
-                         .first())
+        last_modified = (self.db.query(func.max(Annotation.modified))
+                         .filter(Annotation.codingjob_id == self.jobset.codingjob_id, Annotation.coder_id == self.jobuser.user_id,
+                                 Annotation.jobset_id == self.jobset.id)
+                         .scalar())
         
         progress = dict(
             n_total=self.n_total(),
             n_coded=self.coded().count(),
             seek_backwards=self.can_seek_backwards,
             seek_forwards=self.can_seek_forwards,
-            last_modified = last_modified.modified if last_modified is not None else None
+            last_modified = last_modified
         )
         
         damage = self.damage()
-        if self.jobset.rules.get('show_damage', False):
+        if self.rules.get('show_damage', False):
             progress['damage'] = damage['damage']
             progress['max_damage'] = damage['max_damage']
             progress['damage'] = damage['game_over']
@@ -63,7 +66,7 @@ class UnitServer:
         See current damage status
         """
         damage = self.jobuser.damage
-        max_damage = self.jobset.rules.get('max_damage')
+        max_damage = self.rules.get('max_damage')
         game_over = max_damage is not None and damage >= max_damage 
         return dict(damage=damage, max_damage=max_damage, game_over=game_over)
         
@@ -90,11 +93,12 @@ class UnitServer:
         get first unit with a particular status
         """
         ann = (self.db.query(Annotation.unit_id, Annotation.unit_index).join(JobSet)
-               .filter(JobSet.codingjob_id == self.jobset.codingjob_id, Annotation.coder_id == self.jobuser.user_id, Annotation.status.in_(statuses))
+               .filter(Annotation.codingjob_id == self.jobset.codingjob_id, JobSet.codingjob_id == self.jobset.codingjob_id,
+                       Annotation.coder_id == self.jobuser.user_id, Annotation.status.in_(statuses))
                .order_by(JobSet.id)
                .first())
         if ann:
-            return self.db.query(Unit).filter(Unit.id == ann.unit_id).first(), ann.unit_index
+            return crud_unit.load_unit(self.db, ann.unit_id), ann.unit_index
         return None, None
 
     def get_started_unit(self, index: int):
@@ -103,7 +107,8 @@ class UnitServer:
         Can only get units before the current unit if can_seek_backwards is True.
         """
         ann = (self.db.query(Annotation.unit_id, Annotation.unit_index).join(JobSet)
-               .filter(JobSet.codingjob_id == self.jobset.codingjob_id, Annotation.coder_id == self.jobuser.user_id, Annotation.unit_index == index)
+               .filter(Annotation.codingjob_id == self.jobset.codingjob_id, JobSet.codingjob_id == self.jobset.codingjob_id,
+                       Annotation.coder_id == self.jobuser.user_id, Annotation.unit_index == index)
                .order_by(JobSet.id)
                .first())
         if ann is None:
@@ -112,45 +117,54 @@ class UnitServer:
         max_index = self.started().count() - 1
         if index < max_index and not self.can_seek_backwards:
             return None
-        return self.db.query(Unit).filter(Unit.id == ann.unit_id).first()
+        return crud_unit.load_unit(self.db, ann.unit_id)
 
     def get_fixed_index_unit(self, unit_index: int):
         """
         Check if the current unit_index matches a unit with a fixed unit index (e.g., pre and post units).
-        Checks both the exact index and negative index (-1 means show this unit last)
+        Checks both the exact index and negative index (-1 means show this unit last).
+        The fixed indices are part of the cached jobset configuration, so this only needs a query (for n_total)
+        if the jobset has post units.
         """
-        unit = self.db.query(Unit).join(JobSetUnit).filter(JobSetUnit.jobset_id == self.jobset.id, JobSetUnit.fixed_index == unit_index).first()
-       
-        if not unit:
+        unit_id = self.config.pre_units.get(unit_index)
+        if unit_id is None and len(self.config.post_units) > 0:
             n = self.n_total()
-            unit = self.db.query(Unit).join(JobSetUnit).filter(JobSetUnit.jobset_id == self.jobset.id, JobSetUnit.fixed_index == (unit_index-n)).first()
-        return unit
+            # post units have negative indices (relative to the end). Beyond the end there are no units
+            if unit_index < n:
+                unit_id = self.config.post_units.get(unit_index - n)
+        return None if unit_id is None else crud_unit.load_unit(self.db, unit_id)
 
 
     @property
     def can_seek_backwards(self):
-        if 'can_seek_backwards' in self.jobset.rules:
-            return self.jobset.rules['can_seek_backwards']
+        if 'can_seek_backwards' in self.rules:
+            return self.rules['can_seek_backwards']
         return True
 
     @property
     def can_seek_forwards(self):
-        if 'can_seek_forwards' in self.jobset.rules:
-            return self.jobset.rules['can_seek_forwards']
+        if 'can_seek_forwards' in self.rules:
+            return self.rules['can_seek_forwards']
         return False
         
     def units(self):
         """
-        Get all units in a job
+        Get all units in a job, in the order in which they are served: pre units, other units, post units.
+        Units without a fixed index are ordered by when they were added (so units appended to a job come
+        after the existing units, but before the post units).
         """
-        return self.db.query(Unit).join(JobSetUnit).filter(JobSetUnit.jobset_id == self.jobset.id).order_by(JobSetUnit.id)
+        section = case((JobSetUnit.fixed_index >= 0, 0), (JobSetUnit.fixed_index == None, 1), else_=2)
+        return (self.db.query(Unit).join(JobSetUnit)
+                .filter(JobSetUnit.codingjob_id == self.jobset.codingjob_id, JobSetUnit.jobset_id == self.jobset.id)
+                .order_by(section, JobSetUnit.fixed_index, JobSetUnit.id))
 
     def coded(self):
         """
         Get coded units for a given job and user
         """
         return (self.db.query(Annotation).join(JobSet)
-                .filter(JobSet.codingjob_id == self.jobset.codingjob_id, Annotation.coder_id == self.jobuser.user_id, Annotation.status != 'IN_PROGRESS')
+                .filter(Annotation.codingjob_id == self.jobset.codingjob_id, JobSet.codingjob_id == self.jobset.codingjob_id,
+                        Annotation.coder_id == self.jobuser.user_id, Annotation.status != 'IN_PROGRESS')
                 .order_by(JobSet.id))
 
     def started(self):
@@ -158,21 +172,29 @@ class UnitServer:
         Get units that a user has already started in given job. 
         """
         return (self.db.query(Annotation).join(JobSet)
-                .filter(JobSet.codingjob_id == self.jobset.codingjob_id, Annotation.coder_id == self.jobuser.user_id)
+                .filter(Annotation.codingjob_id == self.jobset.codingjob_id, JobSet.codingjob_id == self.jobset.codingjob_id,
+                        Annotation.coder_id == self.jobuser.user_id)
                 .order_by(JobSet.id))
 
     def n_total(self):
         """
         Total number of units that a user can code.
-        This is separate from just unsing self.units().count() because a ruleset might specify an alternative (like units_per_coder in CrowdCoding)
+        This is separate from just unsing self.units().count() because a ruleset might specify an alternative (like units_per_coder in CrowdCoding).
+        It is counted once per UnitServer (i.e. per request), because it's needed for several decisions.
         """
+        if self._n_total is None:
+            self._n_total = self.count_total()
+        return self._n_total
+
+    def count_total(self):
         return self.units().count()
 
     def count_coders(self, unit: Unit):
         """
         Get total number of coders working on this unit (including IN_PROGRESS). The +1 is for the current coder (which we exclude from the annotations)
         """
-        return 1 + self.db.query(Annotation.unit_id).filter(Annotation.coder_id != self.jobuser.user_id, Annotation.unit_id == unit.id, Annotation.jobset_id == self.jobset.id).count()
+        return 1 + self.db.query(Annotation.unit_id).filter(Annotation.codingjob_id == self.jobset.codingjob_id, Annotation.coder_id != self.jobuser.user_id,
+                                                         Annotation.unit_id == unit.id, Annotation.jobset_id == self.jobset.id).count()
 
 
 
@@ -215,7 +237,7 @@ class FixedSet(UnitServer):
 
         return self.get_unit(index), index
 
-    def n_total(self):
+    def count_total(self):
         # If sets are specified, n is set length. Otherwise n is total number of units
 
         # We call units with assign_set = False to prevent that the user is assigned
@@ -228,13 +250,13 @@ class FixedSet(UnitServer):
     def get_unit(self, index: int):
         units = self.units()
         
-        if index < 0 or index >= units.count():
+        if index < 0 or index >= self.n_total():
             return None
-        if self.jobset.rules.get('randomize', False):
+        if self.rules.get('randomize', False):
             # randomize using coder id as seed, so that each coder has a unique and fixed order
-            random_mapping = random_indices(self.jobuser.id, units.count())
+            random_mapping = random_indices(self.jobuser.id, self.n_total())
             index = random_mapping[index]
-        return units[index]
+        return crud_unit.load_unit(self.db, units.with_entities(Unit.id)[index].id)
 
 
 class CrowdCoding(UnitServer):
@@ -263,28 +285,32 @@ class CrowdCoding(UnitServer):
         # (3) select an uncoded (by user) unit, and taking into account how often the unit has been coded by others
         uncoded_ids = (self.db.query(JobSetUnit.unit_id)
                   .outerjoin(Annotation, and_(JobSetUnit.unit_id == Annotation.unit_id,
+                                              Annotation.codingjob_id == self.jobset.codingjob_id,
                                               Annotation.coder_id == self.jobuser.user_id))
-                  .filter(JobSetUnit.jobset_id == self.jobset.id, JobSetUnit.blocked == False, Annotation.id == None)
+                  .filter(JobSetUnit.codingjob_id == self.jobset.codingjob_id, JobSetUnit.jobset_id == self.jobset.id,
+                          JobSetUnit.blocked == False, Annotation.id == None)
         )
         least_coded = (
             self.db.query(JobSetUnit.unit_id)
             .outerjoin(Annotation, and_(
+                                   Annotation.codingjob_id == self.jobset.codingjob_id,
                                    Annotation.jobset_id == self.jobset.id,
                                    Annotation.unit_id == JobSetUnit.unit_id))
-            .filter(JobSetUnit.unit_id.in_(uncoded_ids))
+            .filter(JobSetUnit.codingjob_id == self.jobset.codingjob_id, JobSetUnit.jobset_id == self.jobset.id,
+                    JobSetUnit.unit_id.in_(uncoded_ids))
             .group_by(JobSetUnit.unit_id)
         )
         # There are two 'crowd_priority' modes:
         #    - 'coders_per_unit' priorizes getting many coders per unit, by first serving units that have been coded most
         #    - 'number_of_units' priorizes coding many different units, but first serving units that have been coded least
-        priority = self.jobset.rules.get('crowd_priority', 'many_units')
+        priority = self.rules.get('crowd_priority', 'many_units')
         if priority == 'coders_per_unit':
             least_coded = least_coded.order_by(desc(func.count(Annotation.id))).first()
         else:
             least_coded = least_coded.order_by(func.count(Annotation.id)).first()
 
         if least_coded:
-            return self.db.query(Unit).filter(Unit.id == least_coded.unit_id).first(), unit_index
+            return crud_unit.load_unit(self.db, least_coded.unit_id), unit_index
 
         # No units were left without annotations by the coder, so done coding I guess?
         return None, unit_index
@@ -303,32 +329,35 @@ class CrowdCoding(UnitServer):
         #     (seek forward is impossible because the next unit is determined by the crowd)
         return self.get_started_unit(index), index
 
-    def n_total(self):
+    def count_total(self):
         """
         For CrowdCoding, the number of units can be limited with the units_per_coder setting.
         Also, units can be blocked (e.g., saturated, marked irrelevant), so we can ran out of units,
         and coders that join later might have a different n_total.
         """
-        n_units = self.units().count()
-
+        # blocked units only count if the coder already started them
+        started_ids = (self.db.query(Annotation.unit_id)
+                       .filter(Annotation.codingjob_id == self.jobset.codingjob_id, Annotation.jobset_id == self.jobset.id,
+                               Annotation.coder_id == self.jobuser.user_id))
         n_units = (
             self.db.query(JobSetUnit.unit_id)
-            .outerjoin(Annotation, JobSetUnit.unit_id == Annotation.unit_id)
-            .filter(JobSetUnit.jobset_id == self.jobset.id, or_(JobSetUnit.blocked == False, Annotation.coder_id != self.jobuser.user_id))
+            .filter(JobSetUnit.codingjob_id == self.jobset.codingjob_id, JobSetUnit.jobset_id == self.jobset.id,
+                    or_(JobSetUnit.blocked == False, JobSetUnit.unit_id.in_(started_ids)))
             .count()
         )
-        if 'units_per_coder' in self.jobset.rules:
-            n_units = min(self.jobset.rules['units_per_coder'], n_units)
+        if 'units_per_coder' in self.rules:
+            n_units = min(self.rules['units_per_coder'], n_units)
         return n_units
 
 
 def get_unitserver(db: Session, jobuser: JobUser) -> UnitServer:
     jobset = jobuser.jobset
+    config = crud_jobset.get_config(db, jobset)
     unitserver_class = {
         'crowdcoding': CrowdCoding,
         'fixedset': FixedSet,
-    }[jobset.rules['ruleset']]
-    return unitserver_class(db, jobuser, jobset)
+    }[config.rules['ruleset']]
+    return unitserver_class(db, jobuser, jobset, config)
 
 
 def serve_unit(db, jobuser: JobUser, index: Optional[int]) -> Optional[Unit]:
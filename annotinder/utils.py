@@ -1,7 +1,103 @@
+import base64
+import json
 import random
+from itertools import islice
+from typing import AsyncIterable, AsyncIterator, Iterable, Optional
+
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Query, Session
 
 def random_indices(seed: int, n: int) -> list:
     indices = [i for i in range(0, n)]
     random.seed(seed)
     random.shuffle(indices)
     return indices
+
+
+def chunks(iterable: Iterable, size: int) -> Iterable[list]:
+    """
+    Split an iterable into lists of at most size items
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+async def ndjson_chunks(stream: AsyncIterable[bytes], size: int) -> AsyncIterator[list]:
+    """
+    Parse a stream of newline delimited JSON objects (e.g., a request body) into lists of at most size items, without
+    reading the whole stream into memory. Raises a ValueError (with the line number) if a line is not a valid JSON object.
+    """
+    buffer, chunk, line_nr = b'', [], 0
+    async for data in stream:
+        *lines, buffer = (buffer + data).split(b'\n')
+        for line in lines:
+            line_nr += 1
+            if line.strip():
+                chunk.append(_parse_ndjson_line(line, line_nr))
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    if buffer.strip():
+        chunk.append(_parse_ndjson_line(buffer, line_nr + 1))
+    if len(chunk) > 0:
+        yield chunk
+
+
+def _parse_ndjson_line(line: bytes, line_nr: int):
+    try:
+        item = json.loads(line)
+    except ValueError:
+        raise ValueError(f'Line {line_nr} is not valid JSON')
+    if not isinstance(item, dict):
+        raise ValueError(f'Line {line_nr} is not a JSON object')
+    return item
+
+
+def encode_cursor(position: dict) -> str:
+    """
+    Encode a keyset position (e.g., the last seen id) as an opaque cursor token
+    """
+    data = json.dumps(position, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> dict:
+    """
+    Decode a cursor token created with encode_cursor. Raises a ValueError if the cursor is invalid
+    """
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        position = json.loads(data.decode('utf-8'))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(position, dict):
+        raise ValueError('Invalid cursor')
+    return position
+
+
+def estimate_count(db: Session, query: Query) -> Optional[int]:
+    """
+    Estimate the number of rows a query returns from the query planner statistics, which is much faster than counting
+    on large tables. Only supported for PostgreSQL. Returns None if no estimate could be made.
+    """
+    bind = db.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return None
+    compiled = query.statement.compile(dialect=bind.dialect)
+    plan = db.connection().exec_driver_sql('EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+def dialect_insert(db: Session, table):
+    """
+    Get a dialect specific insert construct, that supports on_conflict_do_nothing and on_conflict_do_update
+    """
+    if db.get_bind().dialect.name == 'sqlite':
+        return sqlite.insert(table)
+    return postgresql.insert(table)
@@ -0,0 +1,231 @@
+"""
+Group commit of the small writes of coders.
+
+Coders write a row whenever they open a new unit (an IN_PROGRESS annotation, see crud_codingjob.get_unit) and whenever
+they save an annotation. Committing each of these separately costs a WAL flush per write, which limits the number of
+coders that a server can handle. Instead, these writes are done by a background thread, that commits all writes that
+arrive within GROUP_COMMIT_MS milliseconds in a single transaction. This is off by default (every write is committed
+separately by the request), because it only pays off with many concurrent coders on a database with slow WAL flushes.
+
+Writes are either statements (an insert or update with parameters), or functions that take a session. Within a group,
+the statements are executed first, with a single executemany per statement, and then the functions, in order.
+Requests wait until their write is committed, so a coder always reads their own writes. If a group fails (e.g., because
+one of its writes violates a constraint), its writes are retried one by one, so that the other writes don't fail with it.
+If the background thread hasn't picked up a write within GROUP_COMMIT_TIMEOUT seconds (because it is stuck, e.g. waiting
+for a lock, or died), the request takes the write back and commits it itself. If the thread died while committing
+the write, it is unknown whether the write was committed, and the request fails with a 503.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.expression import Executable
+
+load_dotenv()
+
+GROUP_COMMIT_MS = os.getenv('GROUP_COMMIT_MS', 'off')
+GROUP_COMMIT_MS = None if GROUP_COMMIT_MS == 'off' else float(GROUP_COMMIT_MS)
+# the maximum number of writes per transaction
+GROUP_COMMIT_SIZE = int(os.getenv('GROUP_COMMIT_SIZE', 100))
+# seconds that a request waits for the background thread to pick up its write, before committing it itself
+GROUP_COMMIT_TIMEOUT = float(os.getenv('GROUP_COMMIT_TIMEOUT', 5))
+
+
+class Write:
+    def __init__(self, fn: Optional[Callable[[Session], Any]] = None, statement: Optional[Executable] = None,
+                 params: Optional[dict] = None):
+        self.fn = fn
+        self.statement = statement
+        self.params = params
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.state = 'queued'  # queued, claimed (by the background thread) or cancelled (by the request)
+        self.lock = threading.Lock()
+
+    def claim(self) -> bool:
+        return self._transition('claimed')
+
+    def cancel(self) -> bool:
+        return self._transition('cancelled')
+
+    def _transition(self, state: str) -> bool:
+        with self.lock:
+            if self.state != 'queued':
+                return False
+            self.state = state
+            return True
+
+
+class GroupCommitWriter:
+    """
+    Runs writes (statements or functions that take a session) in a background thread, and commits them in groups. After the first
+    write of a group arrives, the thread waits up to window seconds for more writes (and takes at most max_size).
+    """
+
+    def __init__(self, bind, window: float = 0.002, max_size: int = 100, timeout: float = 5):
+        self.bind = bind
+        self.window = window
+        self.max_size = max_size
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.n_writes = 0
+        self.n_commits = 0
+        self.n_failed = 0
+        self.n_timeouts = 0
+
+    def write(self, fn: Callable[[Session], Any]) -> Any:
+        """
+        Run fn(session) in the background thread, and wait until it is committed. Returns the result of fn,
+        or raises its exception
+        """
+        return self._submit(Write(fn=fn))
+
+    def execute(self, statement: Executable, params: dict) -> None:
+        """
+        Execute statement with params in the background thread, and wait until it is committed. Statements are grouped
+        by identity, so use the same statement object for writes that can be executed together
+        """
+        self._submit(Write(statement=statement, params=params))
+
+    def _submit(self, item: Write) -> Any:
+        self.queue.put(item)
+        self.start()
+        while not item.done.wait(self.timeout):
+            if item.cancel():
+                # the background thread is stuck or gone, so commit the write here (the thread skips cancelled writes)
+                logging.warning('Group commit thread did not pick up a write, committing it directly')
+                self.n_timeouts += 1
+                self._commit([item])
+                break
+            if not self.thread.is_alive():
+                raise HTTPException(status_code=503, detail='Could not save, please try again')
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def start(self) -> None:
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self._run, name='groupcommit', daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """
+        Commit the writes that are still in the queue, and stop the background thread
+        """
+        self.stopping.set()
+        if self.thread is not None:
+            self.queue.put(None)  # wake up the thread if it is waiting for writes
+            self.thread.join(timeout)
+
+    def metrics(self) -> dict:
+        return dict(queued=self.queue.qsize(), writes=self.n_writes, commits=self.n_commits, failed=self.n_failed,
+                    timeouts=self.n_timeouts)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1 if self.stopping.is_set() else 30)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    return
+                continue
+            group = [] if item is None or not item.claim() else [item]
+            deadline = time.monotonic() + self.window
+            while len(group) < self.max_size:
+                try:
+                    item = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is not None and item.claim():
+                    group.append(item)
+            if len(group) > 0:
+                self._commit(group)
+
+    def _commit(self, group: list) -> None:
+        try:
+            with Session(bind=self.bind) as session:
+                statements = {}
+                for item in group:
+                    if item.statement is not None:
+                        statements.setdefault(item.statement, []).append(item.params)
+                for statement, params in statements.items():
+                    session.execute(statement, params)
+                for item in group:
+                    if item.fn is not None:
+                        item.result = item.fn(session)
+                session.commit()
+            self.n_commits += 1
+            self.n_writes += len(group)
+        except Exception as e:
+            if len(group) > 1:
+                for item in group:
+                    self._commit([item])
+                return
+            logging.exception('Group commit write failed')
+            self.n_failed += 1
+            group[0].error = e
+        for item in group:
+            item.done.set()
+
+
+writers = {}
+writers_lock = threading.Lock()
+
+
+def get_writer(bind) -> GroupCommitWriter:
+    with writers_lock:
+        if bind not in writers:
+            writers[bind] = GroupCommitWriter(bind, window=GROUP_COMMIT_MS / 1000, max_size=GROUP_COMMIT_SIZE,
+                                              timeout=GROUP_COMMIT_TIMEOUT)
+        return writers[bind]
+
+
+def write(db: Session, fn: Callable[[Session], Any], group: bool = True) -> Any:
+    """
+    Run fn(session) and commit it, in a group commit if GROUP_COMMIT_MS isn't off. The transaction of db is committed
+    first, so that the writer never waits for locks that the request holds. Use group=False if fn has to be committed
+    together with changes in db (fn then simply runs in db).
+    """
+    if GROUP_COMMIT_MS is None or not group:
+        result = fn(db)
+        db.commit()
+        return result
+    db.commit()
+    return get_writer(db.get_bind()).write(fn)
+
+
+def execute(db: Session, statement: Executable, params: dict, group: bool = True) -> None:
+    """
+    Like write, but for a single statement, so that it can be executed together with the same statement of other writes
+    """
+    if GROUP_COMMIT_MS is None or not group:
+        db.execute(statement, params)
+        db.commit()
+        return
+    db.commit()
+    get_writer(db.get_bind()).execute(statement, params)
+
+
+def metrics() -> dict:
+    with writers_lock:
+        writers_metrics = [w.metrics() for w in writers.values()]
+    return {key: sum(m[key] for m in writers_metrics) for key in ['queued', 'writes', 'commits', 'failed', 'timeouts']}
+
+
+def stop(timeout: Optional[float] = None) -> None:
+    with writers_lock:
+        for w in writers.values():
+            w.stop(timeout)
@@ -31,6 +31,9 @@ setup(
         'email_validator',
     ],
     extras_require={
+        'zstd': ['zstandard'],
+        'export': ['pyarrow'],
+        'brotli': ['brotli'],
         'dev': [
             'pytest',
             'requests',
@@ -1,27 +1,27 @@
 import pytest
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+# By default, tests use the same database as the app. Note that all tables are dropped after testing.
+# For fast local runs, set TEST_DATABASE_URL=sqlite:///./annotinder_test.db. This is used for the app as well
+# (annotinder connects to its database on import), so then no other database settings are needed.
+if os.getenv('TEST_DATABASE_URL'):
+    os.environ['DATABASE_URL'] = os.environ['TEST_DATABASE_URL']
+
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
 from sqlalchemy_utils import database_exists, create_database
 from sqlalchemy.orm import sessionmaker, Session
 
 from annotinder.api import app
-from annotinder.database import Base, get_db
+from annotinder import database, partitions
+from annotinder.database import Base, create_db_engine, get_db, get_read_db
 from annotinder.crud import crud_user
 from annotinder.auth import get_token
 
-import os
-from dotenv import load_dotenv
-load_dotenv()
-DB_HOST = os.getenv('POSTGRES_HOST')
-DB_NAME = os.getenv('POSTGRES_NAME') 
-DB_PW = os.getenv('POSTGRES_PASSWORD') 
-
-#DATABASE_URL = "sqlite:///./annotinder.db"
-DATABASE_URL = f"postgresql://{DB_NAME}:{DB_PW}@{DB_HOST}/annotinder"
+DATABASE_URL = database.DATABASE_URL
 
-engine = create_engine(
-  DATABASE_URL, connect_args={}
-)
+engine = create_db_engine(DATABASE_URL)
 
 if not database_exists(engine.url):
     create_database(engine.url)
@@ -39,11 +39,19 @@ def override_get_db():
         db.close()
 
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
 
 @pytest.fixture(scope='session', autouse=True)
 def db():
     Base.metadata.create_all(bind=engine)
-    yield TestSessionLocal()
+    session = TestSessionLocal()
+    yield session
+    # close the session first, otherwise its open transaction blocks dropping the tables
+    session.close()
+    if partitions.PARTITION_BY_JOB:
+        # detached partitions that could not be dropped yet refer to the tables (see partitions.drop_detached)
+        with engine.begin() as con:
+            partitions.drop_detached(con)
     Base.metadata.drop_all(bind=engine)
 
 @pytest.fixture(scope='session')
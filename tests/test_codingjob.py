@@ -0,0 +1,597 @@
+import asyncio
+import datetime
+import io
+import json
+import pytest
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import event, func, text
+from annotinder import events, export
+from annotinder.cache import LRUCache
+from annotinder.api import compression
+from annotinder.crud import crud_archive, crud_codingjob, crud_jobset, crud_statistics, crud_unit
+from annotinder.models import Codebook, CodingJob, JobArchiveChunk, JobIngest, JobSet, JobSetUnit, JobUser, Unit, Annotation
+from annotinder.utils import encode_cursor
+from tests.conftest import client, engine
+from tests.test_unitserver import create_job, simulate_coding, newest_job
+
+
+@contextmanager
+def record_statements(statements: list):
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+
+
+def test_get_job_pages(admin, coders):
+    rules = dict(ruleset='crowdcoding')
+    coded = list(simulate_coding(admin, coders, rules, n_units=7, units_per_coder=2))
+    job_id = newest_job(admin)
+
+    full = client.get(f"/codingjob/{job_id}?annotations=true", headers=admin['headers'])
+    assert full.status_code == 200, full.text
+    full = full.json()
+    assert len(full['units']) == 7
+    assert len(full['annotations']) == len(coded)
+
+    units, annotations, cursor, pages = [], [], None, 0
+    while True:
+        params = dict(annotations=True, page_size=3)
+        if cursor is not None:
+            params['cursor'] = cursor
+        page = client.get(f"/codingjob/{job_id}", params=params, headers=admin['headers']).json()
+        units += page['units']
+        annotations += page['annotations']
+        pages += 1
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert pages == 3
+    assert units == full['units']
+    assert annotations == full['annotations']
+
+    res = client.get(f"/codingjob/{job_id}", params=dict(cursor='invalid'), headers=admin['headers'])
+    assert res.status_code == 400
+    res = client.get(f"/codingjob/{job_id}", params=dict(cursor=encode_cursor(dict(job=job_id))), headers=admin['headers'])
+    assert res.status_code == 400
+
+
+def test_stream_job(admin):
+    job = create_job('stream', dict(ruleset='fixedset'), False, 5)
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    res = client.get(f"/codingjob/{job_id}/stream", params=dict(annotations=True), headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    lines = [json.loads(line) for line in res.text.splitlines()]
+    assert lines[0]['job']['title'] == 'stream'
+    assert [line['unit']['external_id'] for line in lines[1:]] == [str(i) for i in range(0, 5)]
+
+
+def test_set_job_users(admin, coders):
+    job = create_job('restricted', dict(ruleset='fixedset'), False, 3)
+    job['authorization'] = dict(restricted=True, users=[coders[0]['user'].name, 'new_coder_1'])
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    users = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()['users']
+    assert sorted(users) == sorted([coders[0]['user'].name, 'new_coder_1'])
+
+    names = [coders[1]['user'].name, 'new_coder_1', 'new_coder_2']
+    res = client.post(f"/codingjob/{job_id}/users", json=dict(users=names), headers=admin['headers'])
+    assert res.status_code == 204, res.text
+    users = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()['users']
+    assert sorted(users) == sorted(names)
+
+    res = client.post(f"/codingjob/{job_id}/users", json=dict(users=[coders[0]['user'].name], only_add=True), headers=admin['headers'])
+    assert res.status_code == 204, res.text
+    users = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()['users']
+    assert sorted(users) == sorted(names + [coders[0]['user'].name])
+
+
+def test_assign_jobsets(admin, db):
+    job = create_job('weighted jobsets', dict(ruleset='fixedset'), True, 4)
+    job['jobsets'][1]['weight'] = 2
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    jobtoken = client.get(f"/codingjob/{job_id}/token", headers=admin['headers']).json()['token']
+
+    def open_job(i):
+        token = client.get("/guest/jobtoken", params=dict(token=jobtoken, user_id=f"guest_{i}")).json()['token']
+        res = client.get(f"/codingjob/{job_id}/progress", headers={"Authorization": f"Bearer {token}"})
+        assert res.status_code == 200, res.text
+        # a coder is only assigned once
+        client.get(f"/codingjob/{job_id}/progress", headers={"Authorization": f"Bearer {token}"})
+
+    def n_jobusers():
+        jobsets = db.query(JobSet.id).filter(JobSet.codingjob_id == job_id).order_by(JobSet.id).all()
+        n = [db.query(JobUser).filter(JobUser.jobset_id == js.id, JobUser.can_code == True).count() for js in jobsets]
+        # end the transaction, so that it doesn't hold locks on the tables
+        db.rollback()
+        return n
+
+    for i in range(0, 6):
+        open_job(i)
+    assert n_jobusers() == [2, 4]
+
+    # also when new coders arrive at the same time
+    with ThreadPoolExecutor(6) as pool:
+        list(pool.map(open_job, range(6, 12)))
+    assert n_jobusers() == [4, 8]
+
+    # coders that are removed from the job no longer count
+    jobset_id = db.query(func.max(JobSet.id)).filter(JobSet.codingjob_id == job_id).scalar()
+    removed = [id for id, in db.query(JobUser.id).filter(JobUser.jobset_id == jobset_id).limit(2)]
+    db.query(JobUser).filter(JobUser.id.in_(removed)).update({JobUser.can_code: False}, synchronize_session=False)
+    db.commit()
+    open_job(12)
+    assert n_jobusers() == [4, 7]
+
+
+def test_cold_storage(admin, coders, db):
+    rules = dict(ruleset='fixedset')
+    list(simulate_coding(admin, coders, rules, n_units=5, units_per_coder=2, with_jobsets=True))
+    job_id = newest_job(admin)
+    before = client.get(f"/codingjob/{job_id}?annotations=true", headers=admin['headers']).json()
+    details = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()
+
+    # coders cannot open an archived job or change its annotations
+    ann = db.query(Annotation).filter(Annotation.codingjob_id == job_id, Annotation.coder_id == coders[0]['user'].id).first()
+    client.post(f"/codingjob/{job_id}/settings", json=dict(archived=True), headers=admin['headers'])
+    assert client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers']).status_code == 404
+    body = dict(annotation=[dict(variable='dummy', value='changed')], status='DONE')
+    assert client.post(f"/codingjob/{job_id}/unit/{ann.unit_id}/annotation", json=body, headers=coders[0]['headers']).status_code == 404
+    # also not if the coder saw the job before it was archived
+    crud_codingjob.set_annotation(db, ann, coders[0]['user'], body['annotation'], 'DONE')
+    db.expire_all()
+    assert db.query(Annotation.annotation).filter(Annotation.id == ann.id).scalar() != body['annotation']
+    db.rollback()
+
+    res = client.post(f"/codingjob/{job_id}/archive", headers=admin['headers'])
+    assert res.status_code == 201, res.text
+    assert res.json()['n_annotations'] == len(before['annotations'])
+    assert db.query(Unit).filter(Unit.codingjob_id == job_id).count() == 0
+    assert db.query(Annotation).filter(Annotation.codingjob_id == job_id).count() == 0
+    # end the transaction, because detaching a partition concurrently waits for older transactions to finish
+    db.rollback()
+
+    # exports are read from the archive
+    assert client.get(f"/codingjob/{job_id}?annotations=true", headers=admin['headers']).json() == before
+    page = client.get(f"/codingjob/{job_id}", params=dict(annotations=True, page_size=3), headers=admin['headers']).json()
+    assert page['units'] == before['units'][:3]
+    assert page['annotations'] == before['annotations'][:3]
+    lines = client.get(f"/codingjob/{job_id}/stream", params=dict(annotations=True), headers=admin['headers']).text.splitlines()
+    assert len(lines) == 1 + len(before['units']) + len(before['annotations'])
+    cold_details = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()
+    assert cold_details['cold_storage']
+    assert cold_details['jobset_details'] == details['jobset_details']
+
+    res = client.post(f"/codingjob/{job_id}/settings", json=dict(archived=False), headers=admin['headers'])
+    assert res.status_code == 201, res.text
+    assert client.get(f"/codingjob/{job_id}?annotations=true", headers=admin['headers']).json() == before
+    assert not client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()['cold_storage']
+
+    # pages only read the chunks of the archive that have their rows
+    crud_archive.archive_job(db, db.query(CodingJob).filter(CodingJob.id == job_id).one(), batch_size=2)
+    assert db.query(JobArchiveChunk).filter(JobArchiveChunk.codingjob_id == job_id, JobArchiveChunk.kind == 'unit').count() == 3
+    db.rollback()
+    units, annotations, cursor = [], [], None
+    while True:
+        params = dict(annotations=True, page_size=3) if cursor is None else dict(annotations=True, cursor=cursor)
+        page = client.get(f"/codingjob/{job_id}", params=params, headers=admin['headers']).json()
+        units += page['units']
+        annotations += page['annotations']
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+    assert units == before['units']
+    assert annotations == before['annotations']
+    res = client.post(f"/codingjob/{job_id}/settings", json=dict(archived=False), headers=admin['headers'])
+    assert client.get(f"/codingjob/{job_id}?annotations=true", headers=admin['headers']).json() == before
+    res = client.get(f"/codingjob/{job_id}/unit", params=dict(index=0), headers=coders[0]['headers'])
+    assert res.status_code == 200, res.text
+
+
+def test_export_annotations(admin, coders):
+    pa = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+    coded = [c for c in simulate_coding(admin, coders, dict(ruleset='fixedset'), n_units=4, units_per_coder=2) if c[2] is not None]
+    job_id = newest_job(admin)
+
+    res = client.get(f"/codingjob/{job_id}/annotations/export", headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    table = pa.parquet.read_table(io.BytesIO(res.content))
+    assert table.num_rows == len(coded)
+    assert set(table.column('value').to_pylist()) == {'confirmed'}
+    assert sorted(table.column('coder').to_pylist()) == sorted(c['user'].name for c in coders for i in range(2))
+
+    res = client.get(f"/codingjob/{job_id}/annotations/export", params=dict(format='arrow'), headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    assert pa.ipc.open_stream(res.content).read_all().equals(table)
+
+    # annotations are stored as given by the client, so values can have any type
+    annotation = dict(id=1, jobset='All', unit_id='1', coder_id=1, coder='coder', status='DONE',
+                      annotation=[dict(variable=1, value=[1], field=2, offset='3', length='long'), dict(offset=4.0, length=True), 'value'])
+    table = pa.parquet.read_table(io.BytesIO(b''.join(export.write_annotations([annotation]))))
+    assert table.column('variable').to_pylist() == ['1', None, None]
+    assert table.column('value').to_pylist() == ['[1]', None, 'value']
+    assert table.column('offset').to_pylist() == [3, 4, None]
+    assert table.column('length').to_pylist() == [None, None, None]
+
+
+def test_delete_job(admin, coders, db):
+    list(simulate_coding(admin, coders, dict(ruleset='crowdcoding'), n_units=4, units_per_coder=2))
+    job_id = newest_job(admin)
+    res = client.delete(f"/codingjob/{job_id}", headers=admin['headers'])
+    assert res.status_code == 204, res.text
+    assert client.get(f"/codingjob/{job_id}", headers=admin['headers']).status_code == 404
+    assert db.query(Unit).filter(Unit.codingjob_id == job_id).count() == 0
+    assert db.query(Annotation).filter(Annotation.codingjob_id == job_id).count() == 0
+    db.rollback()
+    assert client.delete(f"/codingjob/{job_id}", headers=admin['headers']).status_code == 404
+
+
+def test_unit_cache(admin, coders):
+    job = create_job('unit cache', dict(ruleset='fixedset'), False, 2)
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    misses = crud_unit.cache.misses
+    for coder in coders[:3]:
+        unit = client.get(f"/codingjob/{job_id}/unit", headers=coder['headers']).json()
+        assert unit['unit'] == job['units'][0]['unit']
+    # the unit is only read from the database for the first coder
+    assert crud_unit.cache.misses == misses + 1
+    assert crud_unit.cache.get(unit['id']).codingjob_id == job_id
+
+    metrics = client.get("/host/metrics", headers=admin['headers']).json()['caches']
+    assert metrics['units']['hits'] >= 2
+    assert client.delete(f"/codingjob/{job_id}", headers=admin['headers']).status_code == 204
+    assert crud_unit.cache.get(unit['id']) is None
+
+    lru = LRUCache('test', max_bytes=10)
+    lru.put('a', b'12345')
+    lru.put('b', b'12345')
+    lru.get('a')
+    lru.put('c', b'123')
+    lru.put('d', b'12345678901')
+    assert (lru.get('a'), lru.get('b'), lru.get('c'), lru.get('d')) == (b'12345', None, b'123', None)
+    assert lru.metrics()['evictions'] == 1
+
+
+def test_jobset_settings(admin, coders, db):
+    job = create_job('jobset settings', dict(ruleset='fixedset'), False, 3)
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    jobset = client.get(f"/codingjob/{job_id}", headers=admin['headers']).json()['jobsets'][0]
+    progress = client.get(f"/codingjob/{job_id}/progress", headers=coders[0]['headers']).json()
+    assert not progress['seek_forwards']
+    hits = crud_jobset.cache.hits
+    client.get(f"/codingjob/{job_id}/progress", headers=coders[0]['headers'])
+    assert crud_jobset.cache.hits > hits
+    stale = crud_jobset.cache.get(jobset['id'])
+
+    rules = dict(ruleset='fixedset', can_seek_forwards=True)
+    res = client.post(f"/codingjob/{job_id}/jobset/{jobset['id']}", json=dict(rules=rules, debriefing=dict(message='thanks')), headers=admin['headers'])
+    assert res.status_code == 201, res.text
+    assert res.json()['rules'] == rules
+    assert db.query(JobSet.version).filter(JobSet.id == jobset['id']).scalar() == 1
+    db.rollback()
+    # a cached configuration of an older version (e.g., in another server process) is not used anymore
+    crud_jobset.cache.put(jobset['id'], stale)
+    progress = client.get(f"/codingjob/{job_id}/progress", headers=coders[0]['headers']).json()
+    assert progress['seek_forwards']
+
+    res = client.post(f"/codingjob/{job_id}/jobset/{jobset['id']}", json=dict(rules=dict(ruleset='unknown')), headers=admin['headers'])
+    assert res.status_code == 400
+    res = client.post(f"/codingjob/{job_id}/jobset/{jobset['id']}", json=dict(rules=rules), headers=coders[0]['headers'])
+    assert res.status_code == 401
+
+    # the ruleset can only be changed until coders have started
+    res = client.post(f"/codingjob/{job_id}/jobset/{jobset['id']}", json=dict(rules=dict(ruleset='crowdcoding')), headers=admin['headers'])
+    assert res.status_code == 201, res.text
+    client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers'])
+    res = client.post(f"/codingjob/{job_id}/jobset/{jobset['id']}", json=dict(rules=rules), headers=admin['headers'])
+    assert res.status_code == 400
+    res = client.post(f"/codingjob/{job_id}/jobset/{jobset['id']}", json=dict(rules=dict(ruleset='crowdcoding', can_seek_backwards=False)), headers=admin['headers'])
+    assert res.status_code == 201, res.text
+
+
+def test_codebooks(admin, coders, db):
+    job = create_job('codebooks', dict(ruleset='fixedset'), False, 4)
+    unit_codebook = dict(type='questions', questions=[dict(name='unit question', type='confirm')])
+    for unit in job['units'][:3]:
+        unit['unit']['codebook'] = unit_codebook
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+
+    # the job codebook and unit codebook are both stored once
+    jobsets = db.query(JobSet).filter(JobSet.codingjob_id == job_id).all()
+    units = db.query(Unit).filter(Unit.codingjob_id == job_id).order_by(Unit.id).all()
+    assert len({u.codebook_hash for u in units[:3]}) == 1 and units[3].codebook_hash is None
+    assert 'codebook' not in units[0].unit
+    assert db.query(Codebook).filter(Codebook.hash.in_([units[0].codebook_hash, jobsets[0].codebook_hash])).count() == 2
+    db.rollback()
+
+    headers = coders[0]['headers']
+    unit = client.get(f"/codingjob/{job_id}/unit", headers=headers).json()
+    assert unit['unit']['codebook'] == unit_codebook
+    unit = client.get(f"/codingjob/{job_id}/unit", params=dict(codebook_ref=True), headers=headers).json()
+    assert 'codebook' not in unit['unit']
+    res = client.get(f"/codingjob/{job_id}/codebook/{unit['unit']['codebook_hash']}", headers=headers)
+    assert res.status_code == 200, res.text
+    assert res.json() == unit_codebook
+    res = client.get(f"/codingjob/{job_id}/codebook/{unit['unit']['codebook_hash']}", headers={**headers, 'If-None-Match': res.headers['ETag']})
+    assert res.status_code == 304
+    assert client.get(f"/codingjob/{job_id}/codebook/doesnotexist", headers=headers).status_code == 404
+    # codebooks can only be read via a job that uses them, and that the user can code
+    other_id = client.post("/codingjob", json=create_job('other codebooks', dict(ruleset='fixedset'), False, 1), headers=admin['headers']).json()['id']
+    assert client.get(f"/codingjob/{other_id}/codebook/{unit['unit']['codebook_hash']}", headers=headers).status_code == 404
+    client.post(f"/codingjob/{other_id}/settings", json=dict(restricted=True), headers=admin['headers'])
+    assert client.get(f"/codingjob/{other_id}/codebook/{unit['unit']['codebook_hash']}", headers=coders[1]['headers']).status_code == 401
+    assert client.get("/host/metrics", headers=admin['headers']).json()['caches']['codebooks']['hits'] >= 1
+
+    res = client.get(f"/codingjob/{job_id}/codebook", headers=headers)
+    assert res.json() == job['codebook']
+    assert client.get(f"/codingjob/{job_id}/codebook", headers={**headers, 'If-None-Match': res.headers['ETag']}).status_code == 304
+
+    # exports include the full codebooks
+    exported = client.get(f"/codingjob/{job_id}", headers=admin['headers']).json()
+    assert [u['unit'] for u in exported['units']] == [u['unit'] for u in job['units']]
+    assert exported['jobsets'][0]['codebook'] == job['codebook']
+
+
+def test_compressed_units(admin, coders, db):
+    job = create_job('compressed', dict(ruleset='fixedset'), False, 2)
+    job['units'][0]['unit'] = dict(text_fields=[dict(name='text', value='a long document ' * 1000)])
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+
+    # the large unit is stored compressed, the small one as plain JSON
+    stored = db.execute(text("SELECT unit FROM unit WHERE codingjob_id = :job_id ORDER BY id"), dict(job_id=job_id)).scalars().all()
+    assert bytes(stored[0]).startswith(b'\x00') and len(stored[0]) < 1000
+    assert json.loads(bytes(stored[1])) == job['units'][1]['unit']
+    db.rollback()
+
+    unit = client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers']).json()
+    assert unit['unit'] == job['units'][0]['unit']
+
+
+def test_response_compression(admin, coders):
+    job = create_job('response compression', dict(ruleset='crowdcoding'), False, 2)
+    for unit in job['units']:
+        unit['unit'] = dict(text_fields=[dict(name='text', value=f'document {unit["id"]} ' * 1000)])
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+
+    # the compressed unit content is cached, and completed with the coder specific part of the response
+    served = []
+    for coder in coders[:2]:
+        res = client.get(f"/codingjob/{job_id}/unit", headers={**coder['headers'], 'Accept-Encoding': 'gzip'})
+        assert res.headers['content-encoding'] == 'gzip'
+        assert res.headers['vary'] == 'Accept-Encoding'
+        unit = res.json()
+        assert unit['unit'] == next(u['unit'] for u in job['units'] if unit['unit']['text_fields'][0]['value'].startswith(f'document {u["id"]} '))
+        assert unit['index'] == 0
+        assert (unit['id'], False, 'gzip') in compression.unit_cache.values
+        served.append(unit)
+
+    zstandard = pytest.importorskip('zstandard')
+    res = client.get(f"/codingjob/{job_id}/unit", headers={**coders[0]['headers'], 'Accept-Encoding': 'gzip;q=0.5, zstd'})
+    assert res.headers['content-encoding'] == 'zstd'
+    content = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(res.content), read_across_frames=True).read()
+    unit = json.loads(content)
+    assert (unit['id'], unit['unit'], unit['status']) == (served[0]['id'], served[0]['unit'], 'IN_PROGRESS')
+
+    # small responses are not compressed, large (streamed) responses are
+    res = client.get(f"/codingjob/{job_id}/progress", headers={**coders[0]['headers'], 'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in res.headers
+    res = client.get(f"/codingjob/{job_id}/stream", headers={**admin['headers'], 'Accept-Encoding': 'gzip'})
+    assert res.headers['content-encoding'] == 'gzip'
+    assert len(res.text.splitlines()) == 3
+    res = client.get(f"/codingjob/{job_id}/stream", headers={**admin['headers'], 'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in res.headers
+
+    assert compression.negotiate('gzip, zstd;q=0.5', ['zstd', 'gzip']) == 'gzip'
+    assert compression.negotiate('*', ['zstd', 'gzip']) == 'zstd'
+    assert compression.negotiate('identity', ['zstd', 'gzip']) is None
+
+
+def test_background_ingest(admin, coders, db):
+    job = create_job('background', dict(ruleset='crowdcoding'), True, 10)
+    res = client.post("/codingjob", params=dict(background=True), json=job, headers=admin['headers'])
+    assert res.status_code == 202, res.text
+    job_id = res.json()['id']
+
+    # the test client runs background tasks before returning
+    status = client.get(f"/codingjob/{job_id}/ingest", headers=admin['headers']).json()
+    assert status['status'] == 'done', status
+    assert status['n_done'] == status['n_units'] == 10
+    exported = client.get(f"/codingjob/{job_id}", headers=admin['headers']).json()
+    assert [u['unit'] for u in exported['units']] == [u['unit'] for u in job['units']]
+    res = client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers'])
+    assert res.status_code == 200, res.text
+
+    # if ingestion fails, the units are removed and the job is never visible to coders
+    job['jobsets'][0]['ids'].append('does not exist')
+    job_id = client.post("/codingjob", params=dict(background=True), json=job, headers=admin['headers']).json()['id']
+    status = client.get(f"/codingjob/{job_id}/ingest", headers=admin['headers']).json()
+    assert status['status'] == 'failed'
+    assert 'does not exist' in status['error']
+    assert db.query(Unit).filter(Unit.codingjob_id == job_id).count() == 0
+    db.rollback()
+    assert client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers']).status_code == 404
+    assert job_id not in [j['id'] for j in client.get("/users/me/codingjob", headers=coders[0]['headers']).json()['jobs']]
+
+    # an ingest that was interrupted (e.g., by a restart) fails once it made no progress for INGEST_TIMEOUT_SECONDS
+    job['jobsets'][0]['ids'].pop()
+    job_id = crud_codingjob.queue_codingjob(db, title='interrupted', creator=admin['user'], n_units=10).id
+    crud_codingjob.add_units(db, db.query(CodingJob).filter(CodingJob.id == job_id).one(), job['units'][:5])
+    db.query(JobIngest).filter(JobIngest.codingjob_id == job_id).update(dict(status='running', n_done=5))
+    db.commit()
+    assert crud_codingjob.fail_stale_ingests(db) == 0
+    db.query(JobIngest).filter(JobIngest.codingjob_id == job_id).update(
+        dict(updated=datetime.datetime.now() - datetime.timedelta(seconds=crud_codingjob.INGEST_TIMEOUT_SECONDS + 1)))
+    db.commit()
+    status = client.get(f"/codingjob/{job_id}/ingest", headers=admin['headers']).json()
+    assert status['status'] == 'failed' and status['error'] == 'The ingest was interrupted'
+    assert db.query(Unit).filter(Unit.codingjob_id == job_id).count() == 0
+    db.rollback()
+    # and an ingest that is still running (in another server process) stops at its next chunk
+    units = [dict(id=f'late {i}', unit=dict(text='late')) for i in range(3)]
+    crud_codingjob.ingest_codingjob(db.get_bind(), job_id, codebook=job['codebook'], jobsets=None, rules=job['rules'], units=units)
+    assert client.get(f"/codingjob/{job_id}/ingest", headers=admin['headers']).json()['status'] == 'failed'
+    assert db.query(Unit).filter(Unit.codingjob_id == job_id).count() == 0
+    db.rollback()
+
+
+def test_append_units(admin, coders):
+    job = create_job('append', dict(ruleset='fixedset'), False, 3)
+    job['units'] = [dict(id='pre', unit=dict(text='pre'), position='pre'), *job['units'],
+                    dict(id='post', unit=dict(text='post'), position='post')]
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    # cache the jobset configuration, which has to be replaced when pre and post units are added
+    client.get(f"/codingjob/{job_id}/progress", headers=coders[0]['headers'])
+
+    new_units = [dict(id='new_pre', unit=dict(text='new_pre'), position='pre'),
+                 dict(id='new_post', unit=dict(text='new_post'), position='post'),
+                 dict(id='new', unit=dict(text='new')),
+                 dict(id='0', unit=dict(text='already exists'))]
+    body = ''.join(json.dumps(u) + '\n' for u in new_units)
+    res = client.post(f"/codingjob/{job_id}/units", params=dict(batch_size=2), content=body,
+                      headers={**admin['headers'], 'Content-Type': 'application/x-ndjson'})
+    assert res.status_code == 201, res.text
+    assert res.json() == dict(n_added=3, n_skipped=1)
+    # repeating an upload is safe
+    res = client.post(f"/codingjob/{job_id}/units", content=body, headers=admin['headers'])
+    assert res.json() == dict(n_added=0, n_skipped=4)
+
+    # new units are served after the existing units of the same position
+    served, statements = [], []
+    for i in range(10):
+        with record_statements(statements):
+            unit = client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers']).json()
+        if i == 1:
+            # pre units are looked up in the cached jobset configuration
+            assert len(statements) > 0 and not any('fixed_index =' in statement for statement in statements)
+        if 'id' not in unit:
+            break
+        served.append(unit['unit'].get('text', unit['unit'].get('external_id')))
+        body = dict(annotation=[dict(variable='dummy', value='confirmed')], status='DONE')
+        client.post(f"/codingjob/{job_id}/unit/{unit['id']}/annotation", json=body, headers=coders[0]['headers'])
+    assert served == ['pre', 'new_pre', 0, 1, 2, 'new', 'post', 'new_post']
+
+    res = client.post(f"/codingjob/{job_id}/units", content='{"id": "x", "unit": {}}\nnot json\n', headers=admin['headers'])
+    assert res.status_code == 400 and 'Line 2' in res.text
+    for line in ['[1]', '"x"']:
+        res = client.post(f"/codingjob/{job_id}/units", content='{"id": "z", "unit": {}}\n' + line + '\n', headers=admin['headers'])
+        assert res.status_code == 400 and 'Line 2 is not a JSON object' in res.text
+    res = client.post(f"/codingjob/{job_id}/units", content=json.dumps(dict(id='y', unit={}, jobsets=['nope'])), headers=admin['headers'])
+    assert res.status_code == 400 and 'nope' in res.text
+
+    # units can be added to specific jobsets
+    job_id = client.post("/codingjob", json=create_job('append jobsets', dict(ruleset='fixedset'), True, 4), headers=admin['headers']).json()['id']
+    res = client.post(f"/codingjob/{job_id}/units", content=json.dumps(dict(id='new', unit={}, jobsets=[2])), headers=admin['headers'])
+    assert res.json()['n_added'] == 1
+    details = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()
+    assert [js['n_units'] for js in details['jobset_details']] == [2, 3]
+
+
+def test_clone_job(admin, coders, db):
+    job = create_job('original', dict(ruleset='fixedset'), True, 6)
+    job['units'].append(dict(id='post', unit=dict(text='post'), position='post'))
+    job_id = client.post("/codingjob", json=job, headers=admin['headers']).json()['id']
+    # units appended after another job was created, so that the unit ids of the original are not contiguous
+    client.post("/codingjob", json=create_job('other', dict(ruleset='fixedset'), False, 2), headers=admin['headers'])
+    body = ''.join(json.dumps(dict(id=f'appended {i}', unit=dict(text=f'appended {i}'))) + '\n' for i in range(2))
+    res = client.post(f"/codingjob/{job_id}/units", content=body, headers={**admin['headers'], 'Content-Type': 'application/x-ndjson'})
+    assert res.status_code == 201, res.text
+
+    res = client.post(f"/codingjob/{job_id}/clone", json=dict(title='clone', rules=dict(ruleset='crowdcoding')), headers=admin['headers'])
+    assert res.status_code == 201, res.text
+    clone_id = res.json()['id']
+    original = client.get(f"/codingjob/{job_id}", headers=admin['headers']).json()
+    clone = client.get(f"/codingjob/{clone_id}", headers=admin['headers']).json()
+    assert clone['title'] == 'clone'
+    assert clone['provenance'] == dict(cloned_from=job_id)
+    assert [u['unit'] for u in clone['units']] == [u['unit'] for u in original['units']]
+    assert [js['codebook'] for js in clone['jobsets']] == [js['codebook'] for js in original['jobsets']]
+    assert {js['rules']['ruleset'] for js in clone['jobsets']} == {'crowdcoding'}
+
+    details = client.get(f"/codingjob/{job_id}/details", headers=admin['headers']).json()
+    clone_details = client.get(f"/codingjob/{clone_id}/details", headers=admin['headers']).json()
+    assert [js['n_units'] for js in clone_details['jobset_details']] == [js['n_units'] for js in details['jobset_details']]
+
+    # every jobset of the clone has the copies of the units of the original jobset
+    def jobset_units(codingjob_id):
+        rows = (db.query(JobSetUnit.jobset_id, Unit.external_id, JobSetUnit.fixed_index).join(Unit, Unit.id == JobSetUnit.unit_id)
+                .filter(JobSetUnit.codingjob_id == codingjob_id).all())
+        jobset_ids = sorted({r.jobset_id for r in rows})
+        return [sorted((r.external_id, r.fixed_index or 0) for r in rows if r.jobset_id == js) for js in jobset_ids]
+    assert jobset_units(clone_id) == jobset_units(job_id)
+    assert any('appended 0' in [u for u, _ in units] for units in jobset_units(clone_id))
+    db.rollback()
+
+    res = client.get(f"/codingjob/{clone_id}/unit", headers=coders[0]['headers'])
+    assert res.status_code == 200, res.text
+    assert res.json()['unit']['external_id'] in range(6)
+
+
+def test_progress_events(admin, coders, db):
+    job_id = client.post("/codingjob", json=create_job('events', dict(ruleset='crowdcoding'), False, 4), headers=admin['headers']).json()['id']
+
+    def code_unit(coder):
+        unit = client.get(f"/codingjob/{job_id}/unit", headers=coder['headers']).json()
+        body = dict(annotation=[dict(variable='dummy', value='confirmed')], status='DONE')
+        client.post(f"/codingjob/{job_id}/unit/{unit['id']}/annotation", json=body, headers=coder['headers'])
+
+    async def listen():
+        async def snapshot():
+            return {}
+        stream = events.progress_stream(job_id, snapshot, interval=0)
+        assert (await stream.__anext__()).startswith('event: snapshot')
+        # coding happens in other threads, like requests handled by the threadpool
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, code_unit, coders[0])
+        await loop.run_in_executor(None, code_unit, coders[1])
+        message = await stream.__anext__()
+        await stream.aclose()
+        return message
+
+    message = asyncio.run(listen())
+    assert message.startswith('event: progress')
+    delta = json.loads(message.split('data: ')[1])
+    # the IN_PROGRESS and DONE changes of both coders are combined
+    assert list(delta['jobsets'].values()) == [{'DONE': 2}]
+    assert job_id not in events.bus.subscriptions
+
+    progress = crud_codingjob.get_job_progress(db, job_id)
+    db.rollback()
+    assert list(progress['jobsets'].values()) == [{'name': 'All', 'n_units': 4, 'DONE': 2}]
+    assert client.get(f"/codingjob/{job_id}/events", headers=coders[0]['headers']).status_code == 401
+
+
+def test_job_statistics(admin, coders, db, monkeypatch):
+    list(simulate_coding(admin, coders, dict(ruleset='crowdcoding'), n_units=6, units_per_coder=2, with_jobsets=True))
+    job_id = newest_job(admin)
+    res = client.get(f"/codingjob/{job_id}/statistics", headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    stats = res.json()
+    assert [js['n_units'] for js in stats['jobsets']] == [3, 3]
+    assert sum(js['done'] for js in stats['jobsets']) == 6
+    assert {c['coder'] for c in stats['coders']} == {c['user'].name for c in coders}
+    for c in stats['coders']:
+        assert (c['started'], c['done'], c['retry'], c['damage']) == (2, 2, 0, 0)
+        assert c['median_seconds'] is not None and c['median_seconds'] >= 0
+
+    # after the cache expires, only the coders that made changes are recomputed
+    monkeypatch.setattr(crud_statistics, 'STATISTICS_CACHE_SECONDS', 0)
+    unit = client.get(f"/codingjob/{job_id}/unit", headers=coders[0]['headers']).json()
+    stats = client.get(f"/codingjob/{job_id}/statistics", headers=admin['headers']).json()
+    coder = next(c for c in stats['coders'] if c['coder_id'] == coders[0]['user'].id)
+    assert (coder['started'], coder['done']) == (3, 2)
+    assert sum(js['started'] for js in stats['jobsets']) == 7
+
+    # concurrent requests refresh the statistics one at a time, and coders whose annotations were deleted are removed
+    db.query(Annotation).filter(Annotation.codingjob_id == job_id, Annotation.coder_id == coders[1]['user'].id).delete()
+    db.commit()
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lambda i: client.get(f"/codingjob/{job_id}/statistics", headers=admin['headers']).json(), range(4)))
+    for stats in results:
+        assert coders[1]['user'].id not in {c['coder_id'] for c in stats['coders']}
+        assert sum(js['started'] for js in stats['jobsets']) == 5
+
+    assert client.get(f"/codingjob/{job_id}/statistics", headers=coders[0]['headers']).status_code == 401
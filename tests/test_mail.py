@@ -0,0 +1,48 @@
+import smtplib
+from annotinder.mail import MailQueue
+from tests.conftest import client
+
+
+class LocalSMTP:
+    """Stands in for an SMTP server connection. Fails on the first send if fail_first is True"""
+    def __init__(self, inbox: list, fail_first: bool):
+        self.inbox = inbox
+        self.fail = fail_first
+
+    def sendmail(self, sender, to, message):
+        if self.fail:
+            self.fail = False
+            raise smtplib.SMTPServerDisconnected('connection lost')
+        self.inbox.append(to)
+
+    def quit(self):
+        pass
+
+
+def test_mail_queue():
+    inbox, connections = [], []
+    def connect():
+        connections.append(1)
+        return LocalSMTP(inbox, fail_first=len(connections) == 1)
+
+    queue = MailQueue(connect=connect, backoff=0.01)
+    for i in range(0, 5):
+        queue.put(f"coder_{i}@test.com", "subject", "body")
+    assert queue.flush(timeout=5)
+    assert inbox == [f"coder_{i}@test.com" for i in range(0, 5)]
+
+    # the first connection failed, after that all mails are sent over one connection
+    metrics = queue.metrics()
+    assert metrics['connections'] == 2
+    assert metrics['retries'] == 1
+    assert metrics['sent'] == 5 and metrics['queued'] == 0
+    queue.stop()
+    assert not queue.metrics()['connected']
+
+
+def test_metrics(admin, coders):
+    res = client.get("/host/metrics", headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    assert 'queued' in res.json()['mail']
+    res = client.get("/host/metrics", headers=coders[0]['headers'])
+    assert res.status_code == 401
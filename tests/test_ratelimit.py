@@ -0,0 +1,36 @@
+import pytest
+from fastapi import HTTPException
+from annotinder.ratelimit import RateLimiter, MemoryBackend, SharedBackend
+from tests.conftest import client
+
+
+@pytest.mark.parametrize("backend", ["memory", "shared"])
+def test_ratelimiter(backend, tmp_path):
+    backend = MemoryBackend() if backend == 'memory' else SharedBackend(str(tmp_path / 'ratelimit.db'))
+    limiter = RateLimiter('test', 2, 60, backend)
+    limiter.hit('a')
+    limiter.hit('a')
+    limiter.hit('b')
+    with pytest.raises(HTTPException) as e:
+        limiter.hit('a')
+    assert e.value.status_code == 429
+    with pytest.raises(HTTPException):
+        limiter.check('a')
+    limiter.check('b')
+    limiter.reset('a')
+    limiter.check('a')
+
+
+def test_failed_logins(coders):
+    email = coders[2]['user'].email
+    for i in range(0, 5):
+        res = client.post("/users/me/token", data=dict(username=email, password='wrong'))
+        assert res.status_code == 401
+    res = client.post("/users/me/token", data=dict(username=email, password='supersecret'))
+    assert res.status_code == 429
+    assert 'Retry-After' in res.headers
+
+
+def test_invalid_login_email():
+    res = client.post("/users/me/token", data=dict(username='not an email address', password='wrong'))
+    assert res.status_code == 401
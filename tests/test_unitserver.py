@@ -14,6 +14,11 @@ def create_job(title: str, rules: dict, with_jobsets: bool, n: int = 10) -> dict
     return job
 
 
+def newest_job(admin) -> int:
+    # jobs are sorted by creation time, which can be the same for jobs created within a second
+    return max(job['id'] for job in client.get("/codingjob", headers=admin['headers']).json()['jobs'])
+
+
 def simulate_coding(admin, coders,  rules, n_units=10, units_per_coder=3, with_jobsets=False):
     job = create_job('test', rules, with_jobsets, n_units)
     res = client.post("/codingjob", json=job, headers=admin['headers'])
@@ -68,3 +73,14 @@ def test_fixed_set(admin, coders):
         assert unit == order[i]  
 
     
+
+def test_saturation(admin, coders):
+    # with coders_per_unit = 1, units are blocked once coded, so every unit is coded exactly once
+    rules = dict(ruleset = 'crowdcoding', coders_per_unit=1)
+    coded = [unit for i, coder, unit in simulate_coding(admin, coders,  rules, 5, 3) if unit is not None]
+    assert sorted(coded) == [0,1,2,3,4]
+
+    # with an agreement threshold, units are blocked once enough coders agree
+    rules = dict(ruleset = 'crowdcoding', crowd_priority='coders_per_unit', saturation_agreement=1, saturation_min_coders=2)
+    coded = [unit for i, coder, unit in simulate_coding(admin, coders,  rules, 5, 3) if unit is not None]
+    assert coded.count(0) == 2
@@ -1,4 +1,4 @@
-from tests.conftest import client
+from tests.conftest import client, engine
     
 def test_login(coders, admin):
     res = client.get("/users/me/login", headers=admin['headers'])
@@ -11,3 +11,40 @@ def test_login(coders, admin):
    
     
     
+
+def test_get_users(coders, admin):
+    res = client.get("/users", params=dict(search='coder_'), headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    data = res.json()
+    assert data['total'] == len(coders)
+    assert [u['name'] for u in data['users']] == [c['user'].name for c in coders]
+
+    names = []
+    params = dict(search='coder_', n=2)
+    while True:
+        page = client.get("/users", params=params, headers=admin['headers']).json()
+        assert len(page['users']) <= 2
+        names += [u['name'] for u in page['users']]
+        if len(page['users']) < 2:
+            break
+        params['after'] = page['last_id']
+    assert names == [c['user'].name for c in coders]
+
+    res = client.get("/users", params=dict(approximate_total=True), headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    # estimates are only available for PostgreSQL
+    assert res.json()['total_is_estimate'] == (engine.dialect.name == 'postgresql')
+
+
+def test_add_users(coders, admin):
+    users = [dict(name='bulk 1', email='bulk_1@test.com', password='secret'),
+             dict(name='bulk 2', email='bulk_2@test.com'),
+             dict(name='bulk 1 again', email='bulk_1@test.com'),
+             dict(name='existing', email=coders[0]['user'].email),
+             dict(name='invalid', email='not an email')]
+    res = client.post("/users", json=dict(users=users), headers=admin['headers'])
+    assert res.status_code == 200, res.text
+    assert [r['status'] for r in res.json()] == ['created', 'created', 'duplicate', 'exists', 'invalid']
+
+    res = client.post("/users/me/token", data=dict(username='bulk_1@test.com', password='secret'))
+    assert res.status_code == 200, res.text
@@ -0,0 +1,78 @@
+import pytest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import HTTPException
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+from annotinder.models import User
+from annotinder.writer import GroupCommitWriter
+from tests.conftest import engine, TestSessionLocal
+
+
+def test_group_commit(db):
+    writer = GroupCommitWriter(engine, window=0.05)
+    emails = [f'writer_{i}@test.com' for i in range(10)]
+
+    def add_user(email):
+        writer.write(lambda session: session.add(User(name=email, email=email)))
+        # the write is committed before write returns
+        with TestSessionLocal() as session:
+            return session.query(User).filter(User.email == email).count()
+
+    with ThreadPoolExecutor(10) as pool:
+        assert list(pool.map(add_user, emails)) == [1] * 10
+    assert writer.metrics()['writes'] == 10
+    assert writer.metrics()['commits'] < 10
+
+    # a failing write doesn't fail the other writes in its group
+    with ThreadPoolExecutor(2) as pool:
+        ok = pool.submit(writer.write, lambda session: session.add(User(name='writer_new', email='writer_new@test.com')))
+        duplicate = pool.submit(writer.write, lambda session: session.add(User(name='duplicate', email=emails[0])))
+        ok.result()
+        with pytest.raises(IntegrityError):
+            duplicate.result()
+    assert writer.metrics()['failed'] == 1
+    with TestSessionLocal() as session:
+        assert session.query(User).filter(User.email == 'writer_new@test.com').count() == 1
+    # statements are executed with a single executemany per group
+    insert_user = insert(User.__table__)
+    with ThreadPoolExecutor(5) as pool:
+        emails = [f'writer_statement_{i}@test.com' for i in range(5)]
+        list(pool.map(lambda email: writer.execute(insert_user, dict(name=email, email=email, is_admin=False)), emails))
+    with TestSessionLocal() as session:
+        assert session.query(User).filter(User.email.in_(emails)).count() == 5
+
+    writer.stop(timeout=5)
+    assert not writer.thread.is_alive()
+
+
+def test_group_commit_timeout(db):
+    writer = GroupCommitWriter(engine, window=0, timeout=0.2)
+    blocked, release = threading.Event(), threading.Event()
+
+    def block(session):
+        blocked.set()
+        release.wait(10)
+
+    # if the thread is stuck, a request commits its write itself
+    with ThreadPoolExecutor(1) as pool:
+        stuck = pool.submit(writer.write, block)
+        blocked.wait(5)
+        writer.write(lambda session: session.add(User(name='writer_timeout', email='writer_timeout@test.com')))
+        assert writer.metrics()['timeouts'] == 1
+        release.set()
+        stuck.result()
+    with TestSessionLocal() as session:
+        # and the thread doesn't commit it again
+        assert session.query(User).filter(User.email == 'writer_timeout@test.com').count() == 1
+
+    # if the thread dies while committing a write, it is unknown whether it was committed
+    class Crash(BaseException):
+        pass
+
+    def crash(session):
+        raise Crash()
+    with pytest.raises(HTTPException) as e:
+        writer.write(crash)
+    assert e.value.status_code == 503
+    writer.stop(timeout=5)